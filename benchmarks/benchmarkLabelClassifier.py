@@ -0,0 +1,66 @@
+import time # Import time for performance metrics
+import argparse # Import argparse for command-line parsing
+
+from services.LabelServices import load_classifier, candidate_labels, classifier_backends
+
+# Fixed set of abstract labels used to compare the backends. Mostly labels the dictionary does not know,
+# which are the ones that still reach the classifier.
+benchmark_labels = [
+    'BACKGROUND', 'METHODS', 'RESULTS', 'CONCLUSIONS', 'OBJECTIVE', 'UNLABELLED',
+    'CASE PRESENTATION', 'CASE REPORT', 'CASE DESCRIPTION', 'CLINICAL PRESENTATION', 'CASE SUMMARY',
+    'EVIDENCE ACQUISITION', 'EVIDENCE SYNTHESIS', 'EVIDENCE REVIEW', 'LIMITATIONS', 'STRENGTHS AND LIMITATIONS',
+    'TRIAL REGISTRATION', 'REGISTRATION', 'FUNDING', 'WHAT IS KNOWN', 'WHAT THIS STUDY ADDS', 'WHAT IS NEW',
+    'RECENT FINDINGS', 'SCOPE OF REVIEW', 'MAJOR CONCLUSIONS', 'GENERAL SIGNIFICANCE', 'AREAS COVERED',
+    'EXPERT OPINION', 'EXPERT COMMENTARY', 'PATIENT CONCERNS', 'DIAGNOSES', 'LESSONS', 'OUTCOME',
+    'PROBLEM', 'INNOVATION', 'IMPORTANCE', 'OBSERVATIONS', 'LEVEL OF EVIDENCE', 'STUDY TYPE', 'ANIMALS',
+    'SAMPLE', 'PROCEDURE', 'TECHNIQUE', 'ANALYSIS', 'STATISTICAL ANALYSIS', 'CLINICAL TRIAL', 'NEW METHOD',
+    'COMPARISON WITH EXISTING METHODS', 'AVAILABILITY AND IMPLEMENTATION', 'SUPPLEMENTARY INFORMATION',
+    'Hintergrund', 'Ergebnisse', 'Objetivo', 'Métodos', 'Résultats', 'Conclusión',
+]
+
+
+def benchmark_backend(backend, labels, repeat=3, batch_size=16):
+    """
+    Classifies the labels with one backend and measures its throughput.
+    
+    Parameters:
+    - backend (str): The classifier backend ('torch', 'int8' or 'onnx').
+    - labels (list): The labels to classify.
+    - repeat (int): Number of timed passes over the labels.
+    - batch_size (int): Number of labels sent together to the pipeline.
+    
+    Returns:
+    - Tuple containing the section predicted for each label, the load time and the labels per second.
+    """
+    start_time = time.time()
+    classify = load_classifier(backend)
+    load_time = time.time() - start_time
+
+    # Warm up pass, not timed
+    classify(labels[:batch_size], candidate_labels=candidate_labels, batch_size=batch_size)
+
+    start_time = time.time()
+    for _ in range(repeat):
+        results = classify(labels, candidate_labels=candidate_labels, batch_size=batch_size)
+    elapsed_time = time.time() - start_time
+    sections = [result['labels'][0] for result in results]
+    return sections, load_time, len(labels) * repeat / elapsed_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares agreement and throughput of the abstract label classifier backends")
+    parser.add_argument('--backends', nargs='+', choices=classifier_backends, default=list(classifier_backends), help='Backends to compare, the first one is the reference')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed passes over the label set')
+    parser.add_argument('--batch-size', type=int, default=16, help='Number of labels sent together to the pipeline')
+    args = parser.parse_args()
+
+    reference_sections = None
+    for backend in args.backends:
+        sections, load_time, labels_per_second = benchmark_backend(backend, benchmark_labels, args.repeat, args.batch_size)
+        if reference_sections is None:
+            reference_sections = sections
+        agreement = sum(a == b for a, b in zip(sections, reference_sections)) / len(benchmark_labels)
+        print(f'{backend}: load {load_time:.1f} s, {labels_per_second:.1f} labels/s, agreement with {args.backends[0]} {agreement:.1%}')
+        for label, section, reference_section in zip(benchmark_labels, sections, reference_sections):
+            if section != reference_section:
+                print(f'    {label}: {section} ({args.backends[0]}: {reference_section})')
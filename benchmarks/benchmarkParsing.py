@@ -0,0 +1,97 @@
+import time # Import time for performance metrics
+import argparse # Import argparse for command-line parsing
+
+from services.XMLServices import load_XML, parse_publication, set_XML_path, set_label_classifier, list_XML_files
+
+
+def legacy_parse_publication(pub_XML_element):
+    """
+    parse_publication before the single walk: one descendant search per piece, kept to compare against.
+
+    Parameters:
+    - pub_XML_element (Element): The XML element to parse.
+
+    Returns:
+    - Dictionary containing parsed publication data.
+    """
+    xml_dict = {}
+    xml_dict['date_completed'] = pub_XML_element.find('.//DateCompleted')
+    xml_dict['reference_list'] = pub_XML_element.findall('.//ReferenceList//ArticleIdList')
+    xml_dict['PublicationStatus'] = pub_XML_element.find('.//PublicationStatus')
+    xml_dict['MedlineCitation'] = pub_XML_element.find('MedlineCitation')
+    xml_dict['PubmedData'] = pub_XML_element.find('.//PubmedData')
+    xml_dict['CoiStatement'] = pub_XML_element.find('.//CoiStatement')
+    xml_dict['MedlineJournalInfo'] = pub_XML_element.find('.//MedlineJournalInfo')
+    xml_dict['Journal'] = pub_XML_element.find('.//Journal')
+    xml_dict['ArticleIdList'] = pub_XML_element.find('.//PubmedData/ArticleIdList')
+    xml_dict['DataBankList'] = pub_XML_element.find('.//DataBankList')
+    xml_dict['OtherID'] = pub_XML_element.findall('.//OtherID')
+    xml_dict['Article'] = pub_XML_element.find('.//Article')
+    return xml_dict
+
+
+def check_parity(articles):
+    """
+    Checks that both versions find the same elements for every article.
+
+    Parameters:
+    - articles (list): PubmedArticle elements.
+
+    Returns:
+    - Number of articles with a difference.
+    """
+    mismatches = 0
+    for each_article in articles:
+        legacy = legacy_parse_publication(each_article)
+        new = parse_publication(each_article)
+        if legacy.keys() != new.keys() or any(
+                (legacy[key] is not new[key]) if not isinstance(legacy[key], list)
+                else [id(element) for element in legacy[key]] != [id(element) for element in new[key]]
+                for key in legacy):
+            mismatches += 1
+    return mismatches
+
+
+def benchmark_parse(articles, parse_function, repeat):
+    """
+    Measures the articles per second of a parse function. transform_XML is not timed, both versions
+    would share the current one and the difference would only be diluted.
+
+    Parameters:
+    - articles (list): PubmedArticle elements.
+    - parse_function (function): legacy_parse_publication or parse_publication.
+    - repeat (int): Number of passes over the articles, the best one is kept.
+
+    Returns:
+    - Articles per second.
+    """
+    best_time = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for each_article in articles:
+            parse_function(each_article)
+        elapsed = time.perf_counter() - start_time
+        best_time = elapsed if best_time is None else min(best_time, elapsed)
+    return len(articles) / best_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the articles/sec of parse_publication with the previous one descendant search per piece version")
+    parser.add_argument('xml_path', type=str, help='Path to pubmed XML files')
+    parser.add_argument('--file', type=str, default=None, help='XML file to parse (the first one of the folder by default)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of passes over the articles, the best one is reported')
+    args = parser.parse_args()
+
+    set_XML_path(args.xml_path)
+    # Only the parsing is compared, abstract labels are not classified
+    set_label_classifier('none')
+    xml_file = args.file or sorted(list_XML_files())[0]
+    articles = load_XML(xml_file).findall('PubmedArticle')
+    print(f'{xml_file}: {len(articles)} articles')
+
+    mismatches = check_parity(articles)
+    print(f'Parity: {len(articles) - mismatches}/{len(articles)} articles with the same elements')
+
+    legacy_rate = benchmark_parse(articles, legacy_parse_publication, args.repeat)
+    new_rate = benchmark_parse(articles, parse_publication, args.repeat)
+    print(f'parse_publication: before {legacy_rate:.0f} articles/s, after {new_rate:.0f} articles/s, speedup {new_rate / legacy_rate:.2f}x')
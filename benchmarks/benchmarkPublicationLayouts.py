@@ -0,0 +1,154 @@
+import os # Import os for file paths
+import time # Import time for performance metrics
+import argparse # Import argparse for command-line parsing
+import tempfile # Import tempfile for the throwaway databases
+import multiprocessing # Import multiprocessing to load each layout in a fresh process
+import sqlite3 # Import sqlite3 to time the queries without SQLAlchemy overhead
+
+from models.database import set_db_path, set_sparse_attributes, set_text_compression, set_typed_schema, RecordReader
+from services.XMLServices import set_XML_path, set_label_classifier, list_XML_files
+from benchmarks.benchmarkSQLiteLoad import parse_files
+from pubmedXML2DB import store_file
+
+# Common queries reading the publications table from start to end
+scan_queries = {
+    'count by language': "SELECT COUNT(*) FROM publications WHERE Language = 'eng'",
+    'publications per year': 'SELECT Journal_JournalIssue_PubDate_Year, COUNT(*) FROM publications GROUP BY Journal_JournalIssue_PubDate_Year',
+    'title search': "SELECT PMID FROM publications WHERE ArticleTitle LIKE '%cancer%'",
+    'journal and title': 'SELECT PMID, Journal_Title, ArticleTitle FROM publications',
+}
+
+# Layouts of the publications compared: name, sparse attributes and text compression
+layouts = [
+    ('columns', False, None),
+    ('sparse attributes', True, None),
+    ('compressed zlib', False, 'zlib'),
+    ('compressed zstd', False, 'zstd'),
+    ('sparse attributes + compressed zstd', True, 'zstd'),
+]
+
+# Tables holding the publications in each layout, with their indexes (dbstat names)
+layout_tables = {
+    'publications': ['publications', 'sqlite_autoindex_publications_1'],
+    'attributes': ['publication_attributes', 'ix_publication_attributes_attr'],
+    'texts': ['publication_texts', 'sqlite_autoindex_publication_texts_1', 'compression_dictionaries'],
+}
+
+
+def load_layout(parsed_files, db_path, sparse, compression, typed, read_size):
+    """
+    Stores the parsed files in a new database with one of the layouts and reads publications back with RecordReader.
+
+    Parameters:
+    - parsed_files (list): Data frames returned by parse_files.
+    - db_path (str): Path of the new SQLite database.
+    - sparse (bool): If True, the database is created in the sparse attributes mode.
+    - compression (str): Codec of the compressed text mode ('zlib' or 'zstd'), or None.
+    - typed (bool): If True, the database is created with the typed schema.
+    - read_size (int): Number of publications read back by PMID.
+
+    Returns:
+    - Tuple containing the number of columns of the publications table, the codec used, the time to read the
+      publications back in seconds and the records read (to check all the layouts agree).
+    """
+    set_db_path(db_path)
+    set_typed_schema(typed)
+    set_sparse_attributes(sparse)
+    codec = set_text_compression(compression)
+    for parsed_file in parsed_files:
+        # store_file renames columns in place, so each run gets its own copies
+        store_file(*[each_df.copy() for each_df in parsed_file])
+    with sqlite3.connect(db_path) as conn:
+        num_columns = len(conn.execute('PRAGMA table_info(publications)').fetchall())
+        pmids = [row[0] for row in conn.execute('SELECT PMID FROM publications ORDER BY PMID LIMIT ?', (read_size,))]
+    start_time = time.perf_counter()
+    records_df, _ = RecordReader('publications').get(['PMID'], [pmids])
+    read_time = time.perf_counter() - start_time
+    records_df['PMID'] = records_df['PMID'].astype(str)
+    records_df = records_df.set_index('PMID').sort_index()
+    # Columns every layout has, NULL values compared as None
+    records = {column: records_df[column].astype(object).where(records_df[column].notna(), None).astype(str).tolist() for column in records_df.columns if records_df[column].notna().any()}
+    return num_columns, codec, read_time, records
+
+
+def table_sizes(db_path):
+    """
+    Returns the size in bytes of the tables holding the publications in each layout (see layout_tables).
+
+    Parameters:
+    - db_path (str): Path of the SQLite database.
+
+    Returns:
+    - Dictionary with the size of each group of tables, None if SQLite was built without the dbstat table.
+    """
+    with sqlite3.connect(db_path) as conn:
+        try:
+            sizes = dict(conn.execute('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name').fetchall())
+        except sqlite3.OperationalError:
+            return None
+    return {group: sum(sizes.get(name, 0) for name in names) for group, names in layout_tables.items()}
+
+
+def time_queries(db_path, repeat):
+    """
+    Measures the time of the scan queries, keeping the best of several runs (with a warm page cache).
+
+    Parameters:
+    - db_path (str): Path of the SQLite database.
+    - repeat (int): Number of runs of each query.
+
+    Returns:
+    - Dictionary with the time of each query in seconds, and their results to check the layouts agree.
+    """
+    times = {}
+    results = {}
+    with sqlite3.connect(db_path) as conn:
+        for name, query in scan_queries.items():
+            best_time = None
+            for _ in range(repeat):
+                start_time = time.perf_counter()
+                rows = conn.execute(query).fetchall()
+                elapsed = time.perf_counter() - start_time
+                best_time = elapsed if best_time is None else min(best_time, elapsed)
+            times[name] = best_time
+            results[name] = sorted(rows, key=repr)
+    return times, results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the size and scan times of the publications layouts: one column per key, sparse attributes and compressed texts")
+    parser.add_argument('xml_path', type=str, help='Path to pubmed XML files')
+    parser.add_argument('--files', type=int, default=1, help='Number of XML files to load')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs of each query, the best one is reported')
+    parser.add_argument('--read-size', type=int, default=10000, help='Number of publications read back with RecordReader')
+    parser.add_argument('--typed-schema', action='store_true', help='Create all the databases with the typed schema')
+    parser.add_argument('--label-classifier', choices=['model', 'none'], default='none', help="'model' stores the labelled abstract sections under Abstract_* keys, 'none' keeps all the abstract text in Abstract")
+    args = parser.parse_args()
+
+    set_XML_path(args.xml_path)
+    set_label_classifier(args.label_classifier)
+    xml_files = sorted(list_XML_files())[:args.files]
+    parsed_files = parse_files(xml_files)
+    num_publications = sum(len(each_file[0]) for each_file in parsed_files)
+    print(f'{len(xml_files)} files, {num_publications} publications')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        base_times = None
+        base_results = None
+        base_records = None
+        for name, sparse, compression in layouts:
+            db_path = os.path.join(tmp_dir, f"{name.replace(' ', '_').replace('+', 'and')}.db")
+            # The dynamic models can only be created once per process, so each layout is loaded in its own process
+            with multiprocessing.Pool(1) as pool:
+                num_columns, codec, read_time, records = pool.apply(load_layout, (parsed_files, db_path, sparse, compression, args.typed_schema, args.read_size))
+            if compression is not None and codec != compression:
+                name = f'{name} ({codec})'
+            sizes = table_sizes(db_path)
+            times, results = time_queries(db_path, args.repeat)
+            if base_times is None:
+                base_times, base_results, base_records = times, results, records
+            sizes_text = ', '.join(f'{group} {size / 2**20:.1f} MiB' for group, size in sizes.items()) if sizes is not None else 'table sizes not available'
+            print(f'{name}: {num_columns} publications columns, database {os.path.getsize(db_path) / 2**20:.1f} MiB ({sizes_text})')
+            for query_name, query_time in times.items():
+                print(f"  {query_name}: {query_time * 1000:.1f} ms, speedup {base_times[query_name] / query_time:.2f}x{'' if results[query_name] == base_results[query_name] else ', DIFFERENT RESULTS'}")
+            print(f"  RecordReader: {len(records.get('Journal_Title', []))} publications in {read_time * 1000:.0f} ms{'' if records == base_records else ', DIFFERENT RECORDS'}")
@@ -0,0 +1,94 @@
+import os # Import os for file paths
+import time # Import time for performance metrics
+import argparse # Import argparse for command-line parsing
+import tempfile # Import tempfile for the throwaway databases
+import multiprocessing # Import multiprocessing to load each profile in a fresh process
+
+from models.database import set_db_path, create_secondary_indexes, set_typed_schema
+from services.XMLServices import list_XML_files, process_XML, set_XML_path, set_label_classifier
+from pubmedXML2DB import store_file
+
+
+def parse_files(xml_files):
+    """
+    Parses the XML files once so only the storage is timed.
+
+    Parameters:
+    - xml_files (list): Names of the XML files to parse.
+
+    Returns:
+    - List with the (publications_df, authors_df, affiliations_df, author_affiliations_df, citations_df, publication_authors_df) of each file.
+    """
+    AuthorIDCounter = 0
+    AffiliationIDCounter = 0
+    affiliation_ids = {}
+    parsed_files = []
+    for each_XML_file in xml_files:
+        publications_df, authors_df, affiliations_df, author_affiliations_df, citations_df, publication_authors_df, AuthorIDCounter, AffiliationIDCounter, _ = process_XML(each_XML_file, AuthorIDCounter, AffiliationIDCounter, affiliation_ids)
+        parsed_files.append((publications_df, authors_df, affiliations_df, author_affiliations_df, citations_df, publication_authors_df))
+    return parsed_files
+
+
+def benchmark_load(parsed_files, db_path, bulk, journal_mode, typed=False):
+    """
+    Stores the parsed files in a new database and measures the time it takes.
+
+    Parameters:
+    - parsed_files (list): Data frames returned by parse_files.
+    - db_path (str): Path of the new SQLite database.
+    - bulk (bool): If True, the bulk load profile is used and the secondary indexes are created at the end.
+    - journal_mode (str): Journal mode of the bulk load profile ('WAL' or 'OFF').
+    - typed (bool): If True, the database is created with the typed schema.
+
+    Returns:
+    - Tuple containing the total time and the time spent creating the secondary indexes, in seconds.
+    """
+    set_db_path(db_path, bulk=bulk, journal_mode=journal_mode)
+    set_typed_schema(typed)
+    start_time = time.time()
+    for parsed_file in parsed_files:
+        # store_file renames columns in place, so each run gets its own copies
+        store_file(*[each_df.copy() for each_df in parsed_file])
+    index_time = 0
+    if bulk:
+        index_start_time = time.time()
+        create_secondary_indexes()
+        index_time = time.time() - index_start_time
+    return time.time() - start_time, index_time
+
+
+def database_size(db_path):
+    """
+    Returns the size of a database in bytes, including the pages not yet checkpointed from its WAL file.
+    """
+    return sum(os.path.getsize(path) for path in (db_path, f'{db_path}-wal') if os.path.exists(path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the time to store parsed pubmed XML files with the default and the bulk load SQLite profiles")
+    parser.add_argument('xml_path', type=str, help='Path to pubmed XML files')
+    parser.add_argument('--files', type=int, default=1, help='Number of XML files to load')
+    parser.add_argument('--typed-schema', action='store_true', help='Also load each profile with the typed schema, to compare the database sizes')
+    parser.add_argument('--journal-modes', nargs='+', choices=['WAL', 'OFF'], default=['WAL', 'OFF'], help='Journal modes of the bulk load profile to compare')
+    args = parser.parse_args()
+
+    set_XML_path(args.xml_path)
+    # Only the storage is compared, abstract labels are not classified
+    set_label_classifier('none')
+    xml_files = sorted(list_XML_files())[:args.files]
+    parsed_files = parse_files(xml_files)
+    num_publications = sum(len(each_file[0]) for each_file in parsed_files)
+    print(f'{len(xml_files)} files, {num_publications} publications')
+
+    profiles = [('default', False, None)] + [(f'bulk {journal_mode}', True, journal_mode) for journal_mode in args.journal_modes]
+    profiles = [profile + (False,) for profile in profiles] + ([(f'{name} typed', bulk, journal_mode, True) for name, bulk, journal_mode in profiles] if args.typed_schema else [])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        default_time = None
+        for name, bulk, journal_mode, typed in profiles:
+            db_path = os.path.join(tmp_dir, f"{name.replace(' ', '_')}.db")
+            # The dynamic models can only be created once per process, so each profile is loaded in its own process
+            with multiprocessing.Pool(1) as pool:
+                load_time, index_time = pool.apply(benchmark_load, (parsed_files, db_path, bulk, journal_mode, typed))
+            if default_time is None:
+                default_time = load_time
+            print(f'{name}: {load_time:.2f} s ({index_time:.2f} s creating indexes), {num_publications / load_time:.0f} publications/s, speedup {default_time / load_time:.2f}x, {database_size(db_path) / 2**20:.1f} MiB')
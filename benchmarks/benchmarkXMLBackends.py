@@ -0,0 +1,44 @@
+import time # Import time for performance metrics
+import argparse # Import argparse for command-line parsing
+
+from services.XMLServices import list_XML_files, process_XML, set_XML_path, set_XML_backend, set_label_classifier
+
+
+def process_with_backend(xml_file, backend, streaming):
+    """
+    Processes an XML file with a parser backend and measures the time it takes.
+
+    Parameters:
+    - xml_file (str): Name of the XML file.
+    - backend (str): 'etree' or 'lxml'.
+    - streaming (bool): If True, the file is streamed with iterparse.
+
+    Returns:
+    - Tuple containing the output of process_XML and the time in seconds.
+    """
+    set_XML_backend(backend)
+    start_time = time.perf_counter()
+    result = process_XML(xml_file, 0, 0, {}, streaming=streaming)
+    return result, time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+    # That both backends give the same output is checked by tests/test_XML_backends.py on the bundled fixtures
+    parser = argparse.ArgumentParser(description="Compares the speed of the lxml and ElementTree backends")
+    parser.add_argument('xml_path', type=str, help='Path to pubmed XML files')
+    parser.add_argument('--files', type=int, default=1, help='Number of XML files to process')
+    args = parser.parse_args()
+
+    set_XML_path(args.xml_path)
+    # Only the parsing is compared, abstract labels are not classified
+    set_label_classifier('none')
+    if set_XML_backend('lxml') != 'lxml':
+        raise SystemExit('lxml is required to compare the backends')
+
+    for xml_file in sorted(list_XML_files())[:args.files]:
+        for streaming in (False, True):
+            etree_result, etree_time = process_with_backend(xml_file, 'etree', streaming)
+            lxml_result, lxml_time = process_with_backend(xml_file, 'lxml', streaming)
+            num_publications = len(etree_result[0])
+            mode = 'streaming' if streaming else 'whole tree'
+            print(f"{xml_file} ({mode}): etree {num_publications / etree_time:.0f} articles/s, lxml {num_publications / lxml_time:.0f} articles/s, speedup {etree_time / lxml_time:.2f}x")
@@ -1,10 +1,13 @@
 # models.py
-from sqlalchemy import create_engine, Column, Integer, Text, Float, DateTime, ForeignKey, text, MetaData, select, func
+from sqlalchemy import create_engine, Column, Integer, Text, Float, DateTime, ForeignKey, text, MetaData, Table, select, func, inspect, bindparam, event, column, tuple_
+from sqlalchemy.engine import Connection
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship
-from sqlalchemy.exc import OperationalError
+from contextlib import contextmanager
+from collections import OrderedDict
+from itertools import product
+import zlib
 import pandas as pd
-import re
 import pdb
 
 
@@ -12,16 +15,536 @@ import pdb
 Base = declarative_base()
 db_path_debug = 'PubMed_june_2024.db' #Database path DEBUG
 
-#Database path
+#Database path (see set_db_path)
 db_path = db_path_debug
-# Create SQLite engine
+
+# Bulk load profile: SQLite settings applied to every new connection when bulk_load is enabled (see set_db_path)
+bulk_load = False
+bulk_load_pragmas = {
+    'journal_mode': 'WAL', # WAL or OFF
+    'synchronous': 'OFF',
+    'cache_size': -1048576, # Negative values are KiB, 1 GiB of page cache
+    'temp_store': 'MEMORY',
+    'mmap_size': 30000000000,
+}
+
+# Typed schema mode (see set_typed_schema): known columns are stored as integers instead of the types inferred from pandas
+typed_schema = False
+# Columns stored as integers in the typed schema and how their values are encoded: 'int' (number), 'date' ('YYYY-MM-DD'
+# dates as YYYYMMDD), 'month' (month number, from 'Jan'... or digits) and 'flag' (Y/N or booleans as 1/0)
+typed_schema_columns = {
+    'PMID': 'int',
+    'PMIDVersion': 'int',
+    'Num_Authors': 'int',
+    'CompleteYN': 'flag',
+    'ArticleDate': 'date',
+    'Journal_JournalIssue_PubDate_Year': 'int',
+    'Journal_JournalIssue_PubDate_Month': 'month',
+    'Journal_JournalIssue_PubDate_Day': 'int',
+    'AUOrder': 'int',
+    'isFirstAu': 'flag',
+    'isLastAu': 'flag',
+}
+# Prefixes of the dynamic columns stored as integers in the typed schema (History_received, History_pubmed...)
+typed_schema_prefixes = {
+    'History_': 'date',
+}
+month_numbers = {month: number for number, month in enumerate(['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'], start=1)}
+flag_values = {'Y': 1, 'N': 0, True: 1, False: 0, 'True': 1, 'False': 0, '1': 1, '0': 0, 1: 1, 0: 0}
+
+# Sparse attributes mode (see set_sparse_attributes): the open-ended keys of transform_XML are stored as (pmid, attr, value)
+# rows of publication_attributes instead of columns of publications, which keeps the fixed core schema below
+sparse_attributes = False
+sparse_attribute_prefixes = ('History_', 'ArticleId_', 'Abstract_')
+# Core columns: the fixed keys transform_XML emits (the keys it only has commented out code for are left out)
+publication_core_columns = [
+    'PMID', 'Abstract', 'ArticleDate', 'ArticleTitle', 'Article_ELocationID', 'Article_MedlinePgn', 'Article_PubModel',
+    'CoiStatement', 'CompleteYN', 'Journal_ISOAbbreviation', 'Journal_ISSN',
+    'Journal_ISSN_Type', 'Journal_JournalIssue_CitedMedium', 'Journal_JournalIssue_Issue', 'Journal_JournalIssue_PubDate_Day',
+    'Journal_JournalIssue_PubDate_MedlineDate', 'Journal_JournalIssue_PubDate_Month', 'Journal_JournalIssue_PubDate_Season',
+    'Journal_JournalIssue_PubDate_Year', 'Journal_JournalIssue_Volume', 'Journal_Title', 'Language', 'MedlineJournalInfo_Country',
+    'MedlineJournalInfo_ISSNLinking', 'MedlineJournalInfo_MedlineTA', 'MedlineJournalInfo_NlmUniqueID', 'Num_Authors', 'OtherAbtract',
+    'OtherAbtractLanguage', 'OtherAbtractType', 'PMIDVersion', 'XML_file_name',
+]
+# Condition of the partial ix_publication_attributes_attr index: the abstract sections are not searched by value, so their
+# text is not copied into the index. Queries must include it to use the index (see get_publications_by_attribute)
+indexed_attributes_condition = "attr NOT GLOB 'Abstract_*'"
+
+# Compressed text mode (see set_text_compression): the large text fields of publications are stored compressed in the
+# publication_texts blob table, with 'zlib' or 'zstd' (with a dictionary trained on the texts of the database)
+text_compression = None
+text_compression_codecs = ['zlib', 'zstd']
+compressed_text_columns = ['Abstract', 'OtherAbtract', 'CoiStatement']
+compressed_text_prefixes = ('Abstract_',)
+zlib_level = 9
+zstd_level = 9
+# The zstd dictionary is trained once per database, on the texts of the first file with enough of them
+zstd_dictionary_size = 112640
+zstd_dictionary_min_samples = 1000
+# zstandard module, imported by set_text_compression('zstd') only
+zstandard = None
+# Loaded zstd dictionaries with their compressor and decompressor (dictionary_id -> (ZstdCompressor, ZstdDecompressor))
+zstd_dictionaries = {}
+
+# Secondary indexes, dropped while bulk loading and created again at the end (see drop_secondary_indexes)
+secondary_indexes = {
+    'ix_authors_PMID': 'CREATE INDEX IF NOT EXISTS ix_authors_PMID ON authors (PMID)',
+    'ix_author_affiliations_Affiliation_ID': 'CREATE INDEX IF NOT EXISTS ix_author_affiliations_Affiliation_ID ON author_affiliations (Affiliation_ID, Author_ID)',
+    'ix_citations_cited_id': 'CREATE INDEX IF NOT EXISTS ix_citations_cited_id ON citations (cited_id, id_type, citing_pmid)',
+    'ix_publication_authors_author_id': 'CREATE INDEX IF NOT EXISTS ix_publication_authors_author_id ON publication_authors (author_id, pmid, au_order, is_first, is_last)',
+    'ix_publication_attributes_attr': f'CREATE INDEX IF NOT EXISTS ix_publication_attributes_attr ON publication_attributes (attr, value, pmid) WHERE {indexed_attributes_condition}',
+}
+
+def apply_pragmas(dbapi_connection, connection_record):
+    """
+    Applies the bulk load profile to a new SQLite connection (connect event listener).
+    """
+    if not bulk_load:
+        return
+    cursor = dbapi_connection.cursor()
+    for pragma, value in bulk_load_pragmas.items():
+        cursor.execute(f'PRAGMA {pragma} = {value}')
+    cursor.close()
+
+def create_sqlite_engine(path):
+    """
+    Creates an SQLAlchemy engine for a SQLite database, applying the bulk load profile on connect when enabled.
+    
+    Parameters:
+    - path: Path of the SQLite database file.
+    
+    Returns:
+    - The SQLAlchemy engine.
+    """
+    new_engine = create_engine(f'sqlite:///{path}')
+    event.listen(new_engine, 'connect', apply_pragmas)
+    return new_engine
 
 # Create an SQLAlchemy engine that provides connectivity to the SQLite database.
-engine = create_engine(f'sqlite:///{db_path}')
+engine = create_sqlite_engine(db_path)
 
 # Create a sessionmaker object that will create new Session objects bound to the engine.
 Session = sessionmaker(bind=engine)
 
+def set_db_path(new_path, bulk=False, journal_mode=None):
+    """
+    Points the module to a different SQLite database, optionally with the bulk load profile.
+    
+    Parameters:
+    - new_path: Path of the SQLite database file.
+    - bulk: If True, new connections use the bulk load profile (bulk_load_pragmas).
+    - journal_mode: Optional. Journal mode used by the bulk load profile ('WAL' or 'OFF').
+    """
+    global db_path, engine, Session, bulk_load
+    engine.dispose()
+    db_path = new_path
+    bulk_load = bulk
+    if journal_mode is not None:
+        bulk_load_pragmas['journal_mode'] = journal_mode
+    engine = create_sqlite_engine(db_path)
+    Session = sessionmaker(bind=engine)
+    clear_table_caches()
+
+def set_typed_schema(enabled):
+    """
+    Enables the typed schema mode: PMIDs, counts, dates and flags of the publications and authors tables are stored as
+    integers (see typed_schema_columns) instead of TEXT. Dates are encoded as YYYYMMDD, so range filters compare integers.
+    A database keeps the mode it was created with (see get_typed_schema).
+    
+    Parameters:
+    - enabled (bool): True for the typed schema, False for the types inferred from the first file.
+    """
+    global typed_schema
+    typed_schema = enabled
+
+def get_typed_schema():
+    """
+    Returns the schema mode of the database, from the declared type of publications.PMID.
+    
+    Returns:
+    - True if the database uses the typed schema, False if not, None if the publications table does not exist yet.
+    """
+    inspector = inspect(engine)
+    if not inspector.has_table('publications'):
+        return None
+    column_types = {column['name']: str(column['type']) for column in inspector.get_columns('publications')}
+    return column_types.get('PMID') == 'INTEGER'
+
+def typed_column_encoding(column_name):
+    """
+    Returns how a column is encoded in the typed schema ('int', 'date', 'month' or 'flag'), or None if it is kept as it is.
+    """
+    encoding = typed_schema_columns.get(column_name)
+    if encoding is None:
+        for prefix, prefix_encoding in typed_schema_prefixes.items():
+            if column_name.startswith(prefix):
+                return prefix_encoding
+    return encoding
+
+def encode_typed_column(values, encoding):
+    """
+    Encodes the values of a column as nullable integers. Values that cannot be encoded are stored as NULL.
+    
+    Parameters:
+    - values (Series): The values of the column.
+    - encoding (str): 'int', 'date', 'month' or 'flag'.
+    
+    Returns:
+    - Series of Int64 values.
+    """
+    if encoding == 'int':
+        return pd.to_numeric(values, errors='coerce').astype('Int64')
+    if encoding == 'flag':
+        return values.map(flag_values).astype('Int64')
+    if encoding == 'month':
+        months = values.astype('string').str.strip().str.lower().str[:3].map(month_numbers)
+        return months.fillna(pd.to_numeric(values, errors='coerce')).astype('Int64')
+    # Dates as YYYYMMDD, the months and days of the XML are not always zero padded
+    parts = values.astype('string').str.split('-', expand=True).reindex(columns=range(3))
+    year, month, day = (pd.to_numeric(parts[part], errors='coerce') for part in range(3))
+    return (year * 10000 + month * 100 + day).astype('Int64')
+
+def apply_typed_schema(df):
+    """
+    Encodes the typed columns of a DataFrame before storing it, when the typed schema mode is enabled.
+    
+    Parameters:
+    - df: DataFrame of publications or authors.
+    
+    Returns:
+    - The DataFrame with its typed columns encoded as integers (unchanged if the mode is disabled).
+    """
+    if not typed_schema or len(df) == 0:
+        return df
+    df = df.copy()
+    for column_name in df.columns:
+        encoding = typed_column_encoding(column_name)
+        if encoding is not None:
+            df[column_name] = encode_typed_column(df[column_name], encoding)
+    return df
+
+def set_sparse_attributes(enabled):
+    """
+    Enables the sparse attributes mode: the History_*, ArticleId_* and Abstract_* keys of each publication are stored as
+    (pmid, attr, value) rows of the publication_attributes table, and publications keeps a fixed set of columns
+    (publication_core_columns), so it is not altered while loading and its rows stay narrow.
+    A database keeps the mode it was created with (see get_sparse_attributes).
+    
+    Parameters:
+    - enabled (bool): True for the side table, False for one publications column per key.
+    """
+    global sparse_attributes
+    sparse_attributes = enabled
+
+def get_sparse_attributes():
+    """
+    Returns the attributes mode of the database, from the presence of the publication_attributes table.
+    
+    Returns:
+    - True if the database stores the attributes in publication_attributes, False if not, None if the publications table does not exist yet.
+    """
+    inspector = inspect(engine)
+    if not inspector.has_table('publications'):
+        return None
+    return inspector.has_table('publication_attributes')
+
+def split_sparse_attributes(publications_df):
+    """
+    Moves the History_*, ArticleId_* and Abstract_* columns of the publications to (pmid, attr, value) rows, when the
+    sparse attributes mode is enabled. The attributes keep the column names they would have in publications.
+    
+    Parameters:
+    - publications_df: DataFrame of publications (after apply_typed_schema).
+    
+    Returns:
+    - Tuple containing the publications with the core columns (the ones missing in the file added as NULL, so the
+      table is created with all of them) and the attributes DataFrame (empty if the mode is disabled).
+    """
+    attributes = {'pmid': [], 'attr': [], 'value': []}
+    if not sparse_attributes or len(publications_df) == 0:
+        return publications_df, pd.DataFrame(attributes)
+    attribute_columns = [column_name for column_name in publications_df.columns if column_name.startswith(sparse_attribute_prefixes)]
+    pmids = [int(pmid) for pmid in publications_df['PMID'].tolist()]
+    for column_name in attribute_columns:
+        attr = column_name.replace('-', '_')
+        # tolist gives Python values to bind, also for the nullable integers of the typed schema
+        for pmid, value in zip(pmids, publications_df[column_name].tolist()):
+            if not pd.isna(value):
+                attributes['pmid'].append(pmid)
+                attributes['attr'].append(attr)
+                attributes['value'].append(value)
+    publications_df = publications_df.drop(columns=attribute_columns)
+    for column_name in publication_core_columns:
+        # Compressed text fields are stored in publication_texts instead
+        if column_name not in publications_df.columns and not (text_compression and is_compressed_text_column(column_name)):
+            publications_df[column_name] = pd.Series(None, index=publications_df.index, dtype=object)
+    return publications_df, pd.DataFrame({'pmid': attributes['pmid'], 'attr': attributes['attr'], 'value': pd.Series(attributes['value'], dtype=object)})
+
+def set_text_compression(codec):
+    """
+    Enables the compressed text mode: the abstract sections, OtherAbtract and CoiStatement of each publication are stored
+    compressed in the publication_texts table instead of as TEXT columns of publications (see split_compressed_texts).
+    RecordReader decompresses them back into columns. A database keeps the mode it was created with (see get_text_compression).
+    
+    Parameters:
+    - codec (str): 'zlib', 'zstd' (compressed with a dictionary trained on the texts of the database, requires
+      'pip install zstandard', zlib is used if it is not installed) or None to store the texts in publications.
+    
+    Returns:
+    - The codec in use.
+    """
+    global text_compression
+    if codec is not None and codec not in text_compression_codecs:
+        raise ValueError(f"Unsupported text compression: {codec}")
+    if codec == 'zstd' and import_zstandard() is None:
+        print('zstandard is not installed, falling back to zlib')
+        codec = 'zlib'
+    text_compression = codec
+    return text_compression
+
+def import_zstandard():
+    """
+    Imports zstandard the first time it is needed (to compress with zstd or to read texts compressed with it).
+    
+    Returns:
+    - The zstandard module, or None if it is not installed.
+    """
+    global zstandard
+    if zstandard is None:
+        try:
+            import zstandard as zstandard_module # Importing zstandard only when it is used
+            zstandard = zstandard_module
+        except ImportError:
+            pass
+    return zstandard
+
+def get_text_compression():
+    """
+    Returns the compressed text mode of the database, from the codec recorded in compression_settings when the
+    publication_texts table was created.
+    
+    Returns:
+    - The codec of the database if it stores its texts in publication_texts, False if it stores them in publications,
+      None if the publications table does not exist yet.
+    """
+    inspector = inspect(engine)
+    if inspector.has_table('compression_settings'):
+        with engine.connect() as conn:
+            codec = conn.execute(text('SELECT codec FROM compression_settings WHERE id = 1')).scalar()
+        if codec is not None:
+            return codec
+    if not inspector.has_table('publications'):
+        return None
+    if not inspector.has_table('publication_texts'):
+        return False
+    # Databases created before compression_settings: the codec of the last text stored
+    with engine.connect() as conn:
+        return conn.execute(text('SELECT codec FROM publication_texts ORDER BY rowid DESC LIMIT 1')).scalar() or 'zlib'
+
+def is_compressed_text_column(column_name):
+    """
+    Returns True if a publications column is one of the large text fields stored compressed in the compressed text mode.
+    """
+    return column_name in compressed_text_columns or column_name.startswith(compressed_text_prefixes)
+
+def split_compressed_texts(publications_df):
+    """
+    Moves the large text fields of the publications (see is_compressed_text_column) to (pmid, field, text) rows, when the
+    compressed text mode is enabled. They are compressed by compress_texts before being stored.
+    
+    Parameters:
+    - publications_df: DataFrame of publications.
+    
+    Returns:
+    - Tuple containing the publications without the text fields and the texts DataFrame (empty if the mode is disabled).
+    """
+    texts = {'pmid': [], 'field': [], 'text': []}
+    if not text_compression or len(publications_df) == 0:
+        return publications_df, pd.DataFrame(texts)
+    text_columns = [column_name for column_name in publications_df.columns if is_compressed_text_column(column_name)]
+    pmids = [int(pmid) for pmid in publications_df['PMID'].tolist()]
+    for column_name in text_columns:
+        field = column_name.replace('-', '_')
+        for pmid, value in zip(pmids, publications_df[column_name].tolist()):
+            if not pd.isna(value):
+                texts['pmid'].append(pmid)
+                texts['field'].append(field)
+                texts['text'].append(value)
+    return publications_df.drop(columns=text_columns), pd.DataFrame(texts)
+
+def load_zstd_dictionary(dictionary_id, dictionary_data=None):
+    """
+    Returns the zstd compressor and decompressor of a dictionary, loading it from compression_dictionaries the first time.
+    
+    Parameters:
+    - dictionary_id: The ID of the dictionary.
+    - dictionary_data: Optional. The content of the dictionary, when it is already known.
+    
+    Returns:
+    - Tuple containing the ZstdCompressor and the ZstdDecompressor.
+    """
+    if dictionary_id not in zstd_dictionaries:
+        if import_zstandard() is None:
+            raise ValueError('The texts are compressed with zstd, install zstandard to read them')
+        if dictionary_data is None:
+            with engine.connect() as conn:
+                dictionary_data = conn.execute(text('SELECT dictionary FROM compression_dictionaries WHERE dictionary_id = :dictionary_id'),
+                                               {'dictionary_id': dictionary_id}).scalar()
+        dictionary = zstandard.ZstdCompressionDict(dictionary_data)
+        zstd_dictionaries[dictionary_id] = (zstandard.ZstdCompressor(level=zstd_level, dict_data=dictionary), zstandard.ZstdDecompressor(dict_data=dictionary))
+    return zstd_dictionaries[dictionary_id]
+
+def get_zstd_dictionary(samples):
+    """
+    Returns the zstd dictionary of the database, recorded in compression_settings. The first time there are enough
+    samples, a dictionary is trained on them, stored in compression_dictionaries and recorded (in its own transaction,
+    it is used by the texts of every later file).
+    
+    Parameters:
+    - samples (list): Texts of the file being stored, as bytes.
+    
+    Returns:
+    - The ID of the dictionary, or None if there is no dictionary yet (texts are compressed without one).
+    """
+    with engine.begin() as conn:
+        dictionary_id = conn.execute(text('SELECT dictionary_id FROM compression_settings WHERE id = 1')).scalar()
+        if dictionary_id is None:
+            # Databases created before compression_settings recorded the dictionary
+            dictionary_id = conn.execute(text('SELECT MAX(dictionary_id) FROM compression_dictionaries')).scalar()
+            if dictionary_id is not None:
+                conn.execute(text('UPDATE compression_settings SET dictionary_id = :dictionary_id WHERE id = 1'), {'dictionary_id': dictionary_id})
+        if dictionary_id is not None or len(samples) < zstd_dictionary_min_samples:
+            return dictionary_id
+        try:
+            dictionary_data = zstandard.train_dictionary(zstd_dictionary_size, samples, level=zstd_level).as_bytes()
+        except zstandard.ZstdError as e:
+            print(f'Could not train a zstd dictionary, compressing without one: {e}')
+            return None
+        dictionary_id = conn.execute(text('INSERT INTO compression_dictionaries (dictionary) VALUES (:dictionary)'), {'dictionary': dictionary_data}).lastrowid
+        conn.execute(text('UPDATE compression_settings SET dictionary_id = :dictionary_id WHERE id = 1'), {'dictionary_id': dictionary_id})
+    load_zstd_dictionary(dictionary_id, dictionary_data)
+    return dictionary_id
+
+def compress_texts(texts_df):
+    """
+    Compresses the texts returned by split_compressed_texts with the codec of the compressed text mode.
+    
+    Parameters:
+    - texts_df: DataFrame with the pmid, field and text of each text.
+    
+    Returns:
+    - DataFrame with the pmid, field, codec, dictionary_id (zstd only, None without a dictionary) and compressed data of each text.
+    """
+    encoded_texts = [each_text.encode('utf-8') for each_text in texts_df['text'].tolist()]
+    dictionary_id = None
+    if text_compression == 'zstd':
+        dictionary_id = get_zstd_dictionary(encoded_texts) if len(encoded_texts) > 0 else None
+        compressor = load_zstd_dictionary(dictionary_id)[0] if dictionary_id is not None else zstandard.ZstdCompressor(level=zstd_level)
+        compressed = [compressor.compress(each_text) for each_text in encoded_texts]
+    else:
+        compressed = [zlib.compress(each_text, zlib_level) for each_text in encoded_texts]
+    return pd.DataFrame({'pmid': texts_df['pmid'], 'field': texts_df['field'], 'codec': text_compression,
+                         'dictionary_id': pd.Series([dictionary_id] * len(texts_df), index=texts_df.index, dtype=object), 'data': compressed})
+
+def decompress_text(codec, dictionary_id, data):
+    """
+    Decompresses a text of publication_texts.
+    
+    Parameters:
+    - codec (str): 'zlib' or 'zstd'.
+    - dictionary_id: The ID of the zstd dictionary, or None.
+    - data (bytes): The compressed text.
+    
+    Returns:
+    - The text.
+    """
+    if codec == 'zlib':
+        return zlib.decompress(data).decode('utf-8')
+    if dictionary_id is None:
+        if import_zstandard() is None:
+            raise ValueError('The texts are compressed with zstd, install zstandard to read them')
+        return zstandard.ZstdDecompressor().decompress(data).decode('utf-8')
+    return load_zstd_dictionary(dictionary_id)[1].decompress(data).decode('utf-8')
+
+def dispose_engine():
+    """
+    Drops the pooled connections of the engine without closing them. Called in worker processes
+    so connections inherited from the parent process are never reused.
+    """
+    engine.dispose(close=False)
+
+@contextmanager
+def begin_transaction():
+    """
+    Begins a transaction, used to store all the tables of a file at once.
+    
+    Yields a connection, committed on exit (rolled back on error). On rollback the cached table columns are cleared,
+    since the columns added in the transaction (see add_missing_columns) are rolled back with it.
+    """
+    try:
+        with engine.begin() as conn:
+            yield conn
+    except BaseException:
+        clear_table_caches()
+        raise
+
+def clear_table_caches():
+    """
+    Clears the cached columns and reflected tables, so they are read again from the database.
+    """
+    table_columns_cache.clear()
+    reflected_tables.clear()
+
+@contextmanager
+def connection_scope(connectable):
+    """
+    Yields a connection to run statements in: the given connection itself (its transaction is reused)
+    or, for an engine, a new transaction committed on exit.
+    
+    Parameters:
+    - connectable: SQLAlchemy engine or connection.
+    """
+    if isinstance(connectable, Connection):
+        yield connectable
+    else:
+        with connectable.begin() as conn:
+            yield conn
+
+# Columns identifying a record of each table, used to resolve duplicates with INSERT ... ON CONFLICT.
+table_conflict_keys = {
+    'publications': ['PMID'],
+    'authors': ['Author_ID'],
+    'affiliations': ['affiliation'],
+    'author_affiliations': ['Author_ID', 'Affiliation_ID'],
+    'citations': ['citing_pmid', 'cited_id', 'id_type'],
+    'publication_authors': ['pmid', 'au_order', 'author_id'],
+    'publication_attributes': ['pmid', 'attr'],
+    'publication_texts': ['pmid', 'field'],
+}
+
+# Cache of the columns of each table (table name -> set of column names), kept up to date by add_missing_columns
+# and cleared when a transaction is rolled back (see begin_transaction)
+table_columns_cache = {}
+
+# Cache of the reflected tables used to read records (table name -> Table), see get_reflected_table
+reflected_tables = {}
+
+# Maximum number of values bound in a single IN (...) list, below SQLite's bound parameter limit
+sql_chunk_size = 500
+
+# How duplicates are resolved per table: 'update' (the latest record wins) or 'ignore' (the stored record is kept).
+# Tables not listed here are inserted without conflict handling.
+conflict_modes = {
+    'publications': 'update',
+    'authors': 'update',
+    'affiliations': 'ignore',
+    'citations': 'ignore',
+    'publication_authors': 'ignore',
+    'publication_attributes': 'ignore',
+    'publication_texts': 'ignore',
+    'author_affiliations': 'ignore',
+}
+
 def create_dynamic_model(df, class_name, table_name, primary_key_column, index_column = None, relationships=None):
     """
     Dynamically creates a SQLAlchemy model based on the provided DataFrame structure.
@@ -54,7 +577,9 @@ def create_dynamic_model(df, class_name, table_name, primary_key_column, index_c
     
     # Dynamically add columns to the model based on the DataFrame's schema.
     for col_name, dtype in zip(df.columns, df.dtypes):
-        if col_name == "Affiliation_ID": # Special handling for affiliation IDs as text to support merging in custom triggers.
+        if typed_schema and typed_column_encoding(col_name) is not None: # Integer columns of the typed schema
+            columns[col_name] = Column(Integer, primary_key=(col_name == primary_key_column))
+        elif col_name == "Affiliation_ID": # Special handling for affiliation IDs as text to support merging in custom triggers.
             columns[col_name] = Column(Text, primary_key=(col_name == primary_key_column))
         elif "int" in str(dtype): # Integer columns
             columns[col_name] = Column(Integer, primary_key=(col_name == primary_key_column))
@@ -126,10 +651,11 @@ def create_table(className, tableName, tableColumns):
     Base.metadata.create_all(engine)
 
 
-def create_dynamic_tables(publications_df,authors_df,affiliations_df):
+def create_dynamic_tables(publications_df,authors_df):
     
     """
-    Creates database tables dynamically based on DataFrames for publications, authors, and affiliations.
+    Creates database tables dynamically based on DataFrames for publications and authors, and the
+    affiliation dictionary tables (see create_affiliation_tables).
     
     This function first creates models dynamically using the create_dynamic_model function, then
     initializes these tables in the database.
@@ -137,12 +663,10 @@ def create_dynamic_tables(publications_df,authors_df,affiliations_df):
     Parameters:
     - publications_df: DataFrame containing publication data.
     - authors_df: DataFrame containing author data.
-    - affiliations_df: DataFrame containing affiliation data.
     """
 
     
-    # Create Authors and Affiliations models
-    Affiliation = create_dynamic_model(affiliations_df, 'Affiliation', 'affiliations','affiliation')
+    # Create Authors model
     Author = create_dynamic_model(authors_df, 'Author', 'authors','Author_ID','PMID')    
     # Define relationships for Publications model
     # publication_relationships = [
@@ -177,13 +701,294 @@ def create_dynamic_tables(publications_df,authors_df,affiliations_df):
     table = Base.metadata.tables['publications']
     column_names = [column.name for column in table.columns]
     
-    create_database_triggers()
+    create_affiliation_tables()
+    create_citations_table()
+    create_publication_authors_table()
+    if sparse_attributes:
+        create_publication_attributes_table()
+    if text_compression:
+        create_publication_texts_table()
+    drop_database_triggers()
+    if bulk_load:
+        drop_secondary_indexes()
+
+def create_affiliation_tables():
+    """
+    Creates the affiliation dictionary tables.
+    
+    - affiliations: Each distinct affiliation text stored once with an integer Affiliation_ID (unique index on the text).
+    - author_affiliations: Links between authors and affiliations, indexed in both directions.
+    
+    The affiliations of databases created by previous versions (comma-joined Affiliation_IDs per text) are migrated to
+    these tables, with new integer IDs (see migrate_legacy_affiliations).
+    """
+    affiliations_table = """
+    CREATE TABLE IF NOT EXISTS affiliations (
+        Affiliation_ID INTEGER PRIMARY KEY,
+        affiliation TEXT NOT NULL UNIQUE
+    )
+    """
+
+    author_affiliations_table = """
+    CREATE TABLE IF NOT EXISTS author_affiliations (
+        Author_ID INTEGER NOT NULL,
+        Affiliation_ID INTEGER NOT NULL,
+        PRIMARY KEY (Author_ID, Affiliation_ID)
+    ) WITHOUT ROWID
+    """
+
+    with engine.begin() as conn:
+        # Databases created by previous versions are migrated to the dictionary tables first
+        legacy_affiliations = migrate_legacy_affiliations(conn)
+        conn.execute(text(affiliations_table))
+        conn.execute(text(author_affiliations_table))
+        conn.execute(text(secondary_indexes['ix_author_affiliations_Affiliation_ID']))
+        if legacy_affiliations is not None:
+            store_legacy_affiliations(conn, *legacy_affiliations)
+
+def split_legacy_affiliation_ids(joined_ids):
+    """
+    Splits the comma-joined Affiliation_IDs of previous versions ('1,5,9' or '1, 5') into integers.
+    """
+    if joined_ids is None:
+        return []
+    return [int(each_id) for each_id in str(joined_ids).split(',') if each_id.strip() != '']
+
+def migrate_legacy_affiliations(conn):
+    """
+    Reads and drops the affiliations table of previous versions, where the text was the primary key and Affiliation_ID
+    the comma-joined list of the IDs given to each occurrence of the text (merged by the update_affiliation_ids trigger)
+    and authors.AffiliationList the comma-joined IDs of each author.
+    
+    Parameters:
+    - conn: Connection whose transaction is used, the migration is committed with the new tables (see create_affiliation_tables).
+    
+    Returns:
+    - None if the database has no affiliations table of previous versions, otherwise a tuple containing the affiliation
+      texts with their new Affiliation_ID (1, 2... in the order of their first occurrence), the author-affiliation links
+      with the new IDs and the new ID of each joined Affiliation_ID (to update affiliations_parsed).
+    """
+    tables = inspect(conn).get_table_names()
+    if 'affiliations' not in tables:
+        return None
+    primary_keys = [row[1] for row in conn.execute(text('PRAGMA table_info(affiliations)')) if row[5] > 0]
+    if primary_keys != ['affiliation']:
+        return None
+    print('Migrating the affiliations table of a previous version to the affiliations and author_affiliations tables')
+
+    legacy_rows = [(affiliation, joined_ids, split_legacy_affiliation_ids(joined_ids)) for affiliation, joined_ids in conn.execute(text('SELECT affiliation, Affiliation_ID FROM affiliations'))]
+    # New IDs follow the first occurrence of each text, as a new load would number them
+    legacy_rows.sort(key=lambda row: min(row[2], default=float('inf')))
+    affiliations = []
+    new_ids = {}
+    joined_new_ids = {}
+    for new_id, (affiliation, joined_ids, old_ids) in enumerate(legacy_rows, start=1):
+        affiliations.append({'Affiliation_ID': new_id, 'affiliation': affiliation})
+        joined_new_ids[str(joined_ids)] = new_id
+        for old_id in old_ids:
+            new_ids[old_id] = new_id
+
+    links = set()
+    if 'authors' in tables and 'AffiliationList' in {column['name'] for column in inspect(conn).get_columns('authors')}:
+        for author_id, affiliation_list in conn.execute(text('SELECT Author_ID, AffiliationList FROM authors WHERE AffiliationList IS NOT NULL')):
+            for old_id in split_legacy_affiliation_ids(affiliation_list):
+                if old_id in new_ids:
+                    links.add((int(author_id), new_ids[old_id]))
+        conn.execute(text('ALTER TABLE authors DROP COLUMN AffiliationList'))
+        table_columns_cache.pop('authors', None)
+        reflected_tables.pop('authors', None)
+
+    conn.execute(text('DROP TRIGGER IF EXISTS update_affiliation_ids'))
+    conn.execute(text('DROP TABLE affiliations'))
+    table_columns_cache.pop('affiliations', None)
+    reflected_tables.pop('affiliations', None)
+    author_affiliations = [{'Author_ID': author_id, 'Affiliation_ID': affiliation_id} for author_id, affiliation_id in sorted(links)]
+    return affiliations, author_affiliations, joined_new_ids
+
+def store_legacy_affiliations(conn, affiliations, author_affiliations, joined_new_ids):
+    """
+    Stores the affiliations migrated by migrate_legacy_affiliations in the new tables, and points the parsed
+    affiliations (list_of_original_ids of affiliations_parsed) to the new IDs.
+    
+    Parameters:
+    - conn: Connection whose transaction is used.
+    - affiliations (list): Affiliation_ID and text of each affiliation.
+    - author_affiliations (list): Author-affiliation links.
+    - joined_new_ids (dict): New Affiliation_ID of each joined Affiliation_ID of the previous version.
+    """
+    if len(affiliations) > 0:
+        conn.execute(text('INSERT INTO affiliations (Affiliation_ID, affiliation) VALUES (:Affiliation_ID, :affiliation)'), affiliations)
+    if len(author_affiliations) > 0:
+        conn.execute(text('INSERT OR IGNORE INTO author_affiliations (Author_ID, Affiliation_ID) VALUES (:Author_ID, :Affiliation_ID)'), author_affiliations)
+    if 'affiliations_parsed' in inspect(conn).get_table_names() and len(joined_new_ids) > 0:
+        conn.execute(text('UPDATE affiliations_parsed SET list_of_original_ids = :new_id WHERE list_of_original_ids = :joined_ids'),
+                     [{'new_id': new_id, 'joined_ids': joined_ids} for joined_ids, new_id in joined_new_ids.items()])
+
+def create_citations_table():
+    """
+    Creates the citations table: one row per reference of a publication (citing_pmid) with the cited ID and its type
+    ('pubmed', 'doi', 'pmc'...). The primary key serves the forward lookups (references of a publication) and the
+    ix_citations_cited_id index the backward ones (publications citing an ID), both as covering index lookups.
+    """
+    citations_table = """
+    CREATE TABLE IF NOT EXISTS citations (
+        citing_pmid INTEGER NOT NULL,
+        cited_id TEXT NOT NULL,
+        id_type TEXT NOT NULL,
+        PRIMARY KEY (citing_pmid, cited_id, id_type)
+    ) WITHOUT ROWID
+    """
+
+    with engine.begin() as conn:
+        conn.execute(text(citations_table))
+        conn.execute(text(secondary_indexes['ix_citations_cited_id']))
+
+def create_publication_authors_table():
+    """
+    Creates the publication_authors link table with integer keys: the authors of each publication (pmid) in order,
+    with their first/last author flags (0/1). The WITHOUT ROWID primary key keeps the rows clustered by publication for
+    paper-centric queries, and the covering ix_publication_authors_author_id index serves author-centric ones.
+    
+    When the table is added to a database that already has authors, it is filled from them.
+    """
+    publication_authors_table = """
+    CREATE TABLE publication_authors (
+        pmid INTEGER NOT NULL,
+        author_id INTEGER NOT NULL,
+        au_order SMALLINT NOT NULL,
+        is_first SMALLINT NOT NULL,
+        is_last SMALLINT NOT NULL,
+        PRIMARY KEY (pmid, au_order, author_id)
+    ) WITHOUT ROWID
+    """
+
+    with engine.begin() as conn:
+        tables = inspect(conn).get_table_names()
+        if 'publication_authors' in tables:
+            return
+        conn.execute(text(publication_authors_table))
+        if 'authors' in tables:
+            conn.execute(text('INSERT INTO publication_authors (pmid, author_id, au_order, is_first, is_last) '
+                              'SELECT CAST(PMID AS INTEGER), Author_ID, CAST(AUOrder AS INTEGER), CAST(isFirstAu AS INTEGER), CAST(isLastAu AS INTEGER) FROM authors'))
+        conn.execute(text(secondary_indexes['ix_publication_authors_author_id']))
+
+def create_publication_attributes_table():
+    """
+    Creates the publication_attributes table of the sparse attributes mode: one (pmid, attr, value) row per History_*,
+    ArticleId_* or Abstract_* key of a publication. The primary key serves the lookups of the attributes of a publication
+    and the covering ix_publication_attributes_attr index the searches by attribute (e.g. a DOI or a History_ date range),
+    except for the abstract sections (see indexed_attributes_condition).
+    The value column has no declared type, so the integer dates of the typed schema are kept as integers.
+    """
+    publication_attributes_table = """
+    CREATE TABLE IF NOT EXISTS publication_attributes (
+        pmid INTEGER NOT NULL,
+        attr TEXT NOT NULL,
+        value NOT NULL,
+        PRIMARY KEY (pmid, attr)
+    ) WITHOUT ROWID
+    """
+
+    with engine.begin() as conn:
+        conn.execute(text(publication_attributes_table))
+        conn.execute(text(secondary_indexes['ix_publication_attributes_attr']))
+
+def create_publication_texts_table():
+    """
+    Creates the tables of the compressed text mode:
+    
+    - publication_texts: One row per large text field of a publication (see is_compressed_text_column), compressed with
+      its codec (and zstd dictionary). A rowid table, so the blobs are not part of the primary key index.
+    - compression_dictionaries: The zstd dictionaries the texts were compressed with.
+    - compression_settings: One row with the codec of the database (recorded when the tables are created, with the
+      codec of the compressed text mode) and the ID of its zstd dictionary once it is trained.
+    """
+    publication_texts_table = """
+    CREATE TABLE IF NOT EXISTS publication_texts (
+        pmid INTEGER NOT NULL,
+        field TEXT NOT NULL,
+        codec TEXT NOT NULL,
+        dictionary_id INTEGER,
+        data BLOB NOT NULL,
+        PRIMARY KEY (pmid, field)
+    )
+    """
+
+    compression_dictionaries_table = """
+    CREATE TABLE IF NOT EXISTS compression_dictionaries (
+        dictionary_id INTEGER PRIMARY KEY,
+        dictionary BLOB NOT NULL
+    )
+    """
+
+    compression_settings_table = """
+    CREATE TABLE IF NOT EXISTS compression_settings (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        codec TEXT NOT NULL,
+        dictionary_id INTEGER
+    )
+    """
+
+    with engine.begin() as conn:
+        conn.execute(text(publication_texts_table))
+        conn.execute(text(compression_dictionaries_table))
+        conn.execute(text(compression_settings_table))
+        if text_compression:
+            # Kept if it is already recorded, a database keeps the codec it was created with
+            conn.execute(text('INSERT OR IGNORE INTO compression_settings (id, codec) VALUES (1, :codec)'), {'codec': text_compression})
+
+def drop_secondary_indexes():
+    """
+    Drops the secondary indexes so they are not maintained row by row while bulk loading.
+    Primary keys and unique indexes are kept, they are needed to resolve duplicates.
+    """
+    with engine.begin() as conn:
+        for index_name in secondary_indexes:
+            conn.execute(text(f'DROP INDEX IF EXISTS {index_name}'))
+
+def create_secondary_indexes():
+    """
+    Creates the secondary indexes (again) in one pass over each table, at the end of a bulk load and at the start of the
+    other runs (an interrupted bulk load leaves them dropped). Existing indexes are kept (CREATE INDEX IF NOT EXISTS).
+    Indexes of tables the database does not have (publication_attributes outside the sparse attributes mode) are skipped.
+    """
+    with engine.begin() as conn:
+        tables = inspect(conn).get_table_names()
+        for create_index in secondary_indexes.values():
+            # 'CREATE INDEX ... ON table (columns)'
+            if create_index.split(' ON ')[1].split(' ')[0] in tables:
+                conn.execute(text(create_index))
 
 
+def table_exists(table_name):
+    """
+    Returns True if the database has a table.
+    """
+    return inspect(engine).has_table(table_name)
+
+def get_table_columns(engine, table_name):
+    """
+    Returns the columns of a table, reflecting them from the database only the first time.
+    
+    Parameters:
+    - engine: SQLAlchemy engine (or connection) connected to the database.
+    - table_name: Name of the table.
+    
+    Returns:
+    - A set with the column names of the table (empty if the table does not exist, which is not cached).
+    """
+    if table_name not in table_columns_cache:
+        inspector = inspect(engine)
+        if not inspector.has_table(table_name):
+            return set()
+        table_columns_cache[table_name] = {column['name'] for column in inspector.get_columns(table_name)}
+    return table_columns_cache[table_name]
+
 def insert_data(engine, table_name, data):
     """
-    Inserts data from a pandas DataFrame into a specified table in the database. If a column is missing in the table,
-    it dynamically adds the column and retries the insertion.
+    Inserts data from a pandas DataFrame into a specified table in the database. The DataFrame's columns are
+    compared with the cached columns of the table first, any missing columns are added in a single transaction
+    and the data is then inserted once.
     
     Parameters:
     - engine: SQLAlchemy engine object connected to the database.
@@ -194,164 +999,464 @@ def insert_data(engine, table_name, data):
     
     # Standardize column names by replacing hyphens with underscores to ensure SQL compatibility.
     data.rename(columns=lambda x: x.replace('-', '_'), inplace=True)
+
+    # Add all the columns the table does not have yet before inserting
+    table_columns = get_table_columns(engine, table_name)
+    if len(table_columns) > 0:
+        missing_columns = [column for column in data.columns if column not in table_columns]
+        if len(missing_columns) > 0:
+            add_missing_columns(engine, table_name, missing_columns)
     
-    try:
-        data.to_sql(table_name, con=engine, if_exists='append', index=False)
-    except OperationalError as e:
-        # Handle the case where a column in the DataFrame does not exist in the table.
-        error_message = str(e)
-        match = re.search(r'no column named ([\w-]+)', error_message)
-        if match:
-            # If the error was due to a missing column, add it to the table.
-            missing_column = match.group(1)
-            add_missing_column(engine, table_name, missing_column)
-            # Retry inserting the data after the missing column has been added.
-            insert_data(engine, table_name, data)
-        else:
-            # If the error is something else, re-raise it
-            raise
+    # Duplicates are resolved by the table's constraints (see conflict_modes)
+    method = upsert_method(table_name) if table_name in conflict_modes else None
+    data.to_sql(table_name, con=engine, if_exists='append', index=False, method=method)
 
-def add_missing_column(engine, table_name, missing_column):
+def add_missing_columns(engine, table_name, missing_columns):
     """
-    Dynamically adds a missing column to a specified table in the database.
+    Dynamically adds missing columns to a specified table in the database, all in one transaction.
     
     Parameters:
     - engine: SQLAlchemy engine object connected to the database.
-    - table_name: Name of the table to which the column should be added.
-    - missing_column: The name of the column to be added.
+    - table_name: Name of the table to which the columns should be added.
+    - missing_columns: The names of the columns to be added.
+    """
+
+    # Execute an ALTER TABLE command for each missing column in a single transaction.
+    # The new columns are added with a data type of TEXT by default, INTEGER for the typed columns of the typed schema.
+    with connection_scope(engine) as conn:
+        for missing_column in missing_columns:
+            column_type = 'INTEGER' if typed_schema and typed_column_encoding(missing_column) is not None else 'TEXT'
+            alter_statement = f'ALTER TABLE {table_name} ADD COLUMN "{missing_column}" {column_type}'
+            conn.execute(text(alter_statement))
+    table_columns_cache[table_name].update(missing_columns)
+    # The reflected table no longer has all the columns
+    reflected_tables.pop(table_name, None)
+
+def drop_database_triggers():
+    """
+    Removes the duplicate prevention triggers created by previous versions of the database.
+    
+    Duplicates are now resolved by the primary key/unique constraints of the tables with
+    INSERT ... ON CONFLICT (see conflict_modes), without a per row EXISTS subquery.
+    """
+    with engine.begin() as conn:
+        conn.execute(text('DROP TRIGGER IF EXISTS prevent_duplicate_pmids'))
+        conn.execute(text('DROP TRIGGER IF EXISTS prevent_duplicate_authorids'))
+        conn.execute(text('DROP TRIGGER IF EXISTS update_affiliation_ids'))
+
+def set_conflict_mode(table_name, mode):
+    """
+    Sets how duplicated records are resolved when inserting in a table.
+    
+    Parameters:
+    - table_name: The name of the table, must be one of table_conflict_keys.
+    - mode: 'update' so the latest record wins or 'ignore' to keep the stored record.
+    """
+    if table_name not in table_conflict_keys:
+        raise ValueError(f"No conflict keys defined for table: {table_name}")
+    if mode not in ('update', 'ignore'):
+        raise ValueError(f"Unsupported conflict mode: {mode}")
+    conflict_modes[table_name] = mode
+
+def upsert_method(table_name):
+    """
+    Builds a pandas to_sql insertion method that resolves duplicates with the table's conflict mode.
+    
+    Rows are sent with a single executemany of INSERT ... ON CONFLICT DO UPDATE (or INSERT OR IGNORE).
+    On update, columns of the table that are not in the DataFrame are cleared, so the new record fully
+    replaces the stored one. Publications are only replaced by a record with the same or a newer PMIDVersion.
+    
+    Parameters:
+    - table_name: The name of the table the data is inserted into.
+    
+    Returns:
+    - A function with the signature expected by DataFrame.to_sql(method=...).
+    """
+    def method(pd_table, conn, keys, data_iter):
+        columns = ', '.join(f'"{key}"' for key in keys)
+        values = ', '.join(f':{key}' for key in keys)
+        if conflict_modes[table_name] == 'ignore':
+            insert_statement = f'INSERT OR IGNORE INTO {table_name} ({columns}) VALUES ({values})'
+        else:
+            conflict_keys = table_conflict_keys[table_name]
+            table_columns = get_table_columns(conn, table_name)
+            updates = ', '.join(f'"{column}" = excluded."{column}"' if column in keys else f'"{column}" = NULL'
+                                for column in sorted(table_columns) if column not in conflict_keys)
+            insert_statement = f'INSERT INTO {table_name} ({columns}) VALUES ({values}) ON CONFLICT ({", ".join(conflict_keys)}) DO UPDATE SET {updates}'
+            if table_name == 'publications' and 'PMIDVersion' in keys:
+                # Latest version wins
+                insert_statement += ' WHERE CAST(excluded.PMIDVersion AS INTEGER) >= CAST(publications.PMIDVersion AS INTEGER)'
+        rows = [dict(zip(keys, row)) for row in data_iter]
+        result = conn.execute(text(insert_statement), rows)
+        return result.rowcount
+    return method
+
+def replace_publications(publications_df, authors_df, author_affiliations_df, publication_authors_df, citations_df, attributes_df, texts_df, conn=None):
+    """
+    Prepares the authors, publication-author links, citations, attributes and texts of a file whose publications may already be stored, so the latest version of a publication wins.
+    
+    - Publications already stored with the same or an older PMIDVersion are replaced: their stored authors,
+      author-affiliation links, publication-author links, citations, attributes and texts are deleted (batched) so the new ones take their place.
+    - Publications already stored with a newer PMIDVersion (or any stored publication when duplicates of
+      publications are ignored) are kept: the authors, links, citations, attributes and texts of the file for those publications are dropped.
+    
+    Must be called before the publications of the file are stored.
+    
+    Parameters:
+    - publications_df: DataFrame containing the publications of the file.
+    - authors_df: DataFrame containing the authors of the file.
+    - author_affiliations_df: DataFrame containing the author-affiliation links of the file.
+    - publication_authors_df: DataFrame containing the publication-author links of the file.
+    - citations_df: DataFrame containing the citations of the file.
+    - attributes_df: DataFrame containing the attributes of the file (see split_sparse_attributes).
+    - texts_df: DataFrame containing the compressed texts of the file (see compress_texts).
+    - conn: Optional. Connection whose transaction is used, otherwise a new transaction is started.
+    
+    Returns:
+    - The authors, author-affiliation links, publication-author links, citations, attributes and texts DataFrames to be stored.
+    """
+    if len(publications_df) == 0:
+        return authors_df, author_affiliations_df, publication_authors_df, citations_df, attributes_df, texts_df
+
+    # tolist gives Python values to bind, also for the nullable integers of the typed schema
+    incoming_versions = {pmid: (None if pd.isna(version) else version) for pmid, version in zip(publications_df['PMID'].tolist(), publications_df['PMIDVersion'].tolist())}
+    stored_versions_query = text('SELECT PMID, PMIDVersion FROM publications WHERE PMID IN :pmids').bindparams(bindparam('pmids', expanding=True))
+    replaced = []
+    kept = set()
+    with connection_scope(conn or engine) as conn:
+        tables = inspect(conn).get_table_names()
+        if 'publications' not in tables:
+            return authors_df, author_affiliations_df, publication_authors_df, citations_df, attributes_df, texts_df
+        pmids = list(incoming_versions.keys())
+        # Look up the stored versions in chunks to stay below SQLite's bound parameter limit
+        for start in range(0, len(pmids), sql_chunk_size):
+            stored = conn.execute(stored_versions_query, {'pmids': pmids[start:start + sql_chunk_size]})
+            for pmid, stored_version in stored:
+                if conflict_modes['publications'] == 'ignore' or int(stored_version or 0) > int(incoming_versions[pmid] or 0):
+                    kept.add(pmid)
+                else:
+                    replaced.append({'PMID': pmid})
+
+        if len(replaced) > 0:
+            conn.execute(text('DELETE FROM author_affiliations WHERE Author_ID IN (SELECT Author_ID FROM authors WHERE PMID = :PMID)'), replaced)
+            conn.execute(text('DELETE FROM authors WHERE PMID = :PMID'), replaced)
+            conn.execute(text('DELETE FROM publication_authors WHERE pmid = :PMID'), replaced)
+            conn.execute(text('DELETE FROM citations WHERE citing_pmid = :PMID'), replaced)
+            if 'publication_attributes' in tables:
+                conn.execute(text('DELETE FROM publication_attributes WHERE pmid = :PMID'), replaced)
+            if 'publication_texts' in tables:
+                conn.execute(text('DELETE FROM publication_texts WHERE pmid = :PMID'), replaced)
+
+    if len(kept) > 0 and len(authors_df) > 0:
+        authors_df = authors_df[~authors_df['PMID'].isin(kept)].copy()
+        author_affiliations_df = author_affiliations_df[author_affiliations_df['Author_ID'].isin(authors_df['Author_ID'])].copy()
+    if len(kept) > 0:
+        kept_pmids = [int(pmid) for pmid in kept]
+        publication_authors_df = publication_authors_df[~publication_authors_df['pmid'].isin(kept_pmids)].copy()
+        citations_df = citations_df[~citations_df['citing_pmid'].isin(kept_pmids)].copy()
+        attributes_df = attributes_df[~attributes_df['pmid'].isin(kept_pmids)].copy()
+        texts_df = texts_df[~texts_df['pmid'].isin(kept_pmids)].copy()
+    return authors_df, author_affiliations_df, publication_authors_df, citations_df, attributes_df, texts_df
+
+def create_label_cache_table():
     """
+    Creates the table used to persist the abstract label -> section classifications across runs.
+    """
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE IF NOT EXISTS abstract_label_cache (label TEXT PRIMARY KEY, section TEXT)'))
+
+def load_label_cache(limit=None):
+    """
+    Loads the persisted abstract label classifications.
 
-    # Open a connection to the database and execute an ALTER TABLE command to add the missing column.
-    # The new column is added with a data type of TEXT by default.
+    Parameters:
+    - limit: Optional. Maximum number of labels to load.
+
+    Returns:
+    - A list of (label, section) tuples.
+    """
+    query = 'SELECT label, section FROM abstract_label_cache'
+    if limit is not None:
+        query = f'{query} LIMIT {int(limit)}'
     with engine.connect() as conn:
-        alter_statement = f'ALTER TABLE {table_name} ADD COLUMN {missing_column} TEXT'
-        conn.execute(text(alter_statement))
-
-def create_database_triggers():
-    """
-    Sets up database triggers to prevent duplicates and manage data consistency.
-    
-    This function defines and executes SQL statements to create triggers for:
-    - Preventing duplicate PMID entries in the 'publications' table.
-    - Preventing duplicate Author_ID entries in the 'authors' table.
-    - Merging Affiliation_IDs for the same affiliation in the 'affiliations' table.
-    """
-
-    #Define the trigger SQL so that on insertions in publications we merge records when there is a duplicate (EXECUTE AFTER TABLES ARE CREATED)
-    trigger_dup_publications = """
-    CREATE TRIGGER prevent_duplicate_pmids
-    BEFORE INSERT ON publications
-    FOR EACH ROW
-    WHEN EXISTS (SELECT 1 FROM publications WHERE PMID = NEW.PMID)
-    BEGIN
-        SELECT RAISE(IGNORE);
-    END;
-    """
-
-    trigger_dup_authors = """
-    CREATE TRIGGER prevent_duplicate_authorids
-    BEFORE INSERT ON authors
-    FOR EACH ROW
-    WHEN EXISTS (SELECT 1 FROM authors WHERE Author_ID = NEW.Author_ID)
-    BEGIN
-        SELECT RAISE(IGNORE);
-    END;
-    """
-
-    # trigger_dup_affiliations = """
-    # CREATE TRIGGER prevent_duplicate_affiliationids
-    # BEFORE INSERT ON affiliations
-    # FOR EACH ROW
-    # WHEN EXISTS (SELECT 1 FROM affiliations WHERE Affiliation_ID = NEW.Affiliation_ID)
-    # BEGIN
-    #     SELECT RAISE(IGNORE);
-    # END;
-    # """
-
-    trigger_merge_affiliations_ids = """
-    CREATE TRIGGER update_affiliation_ids
-    BEFORE INSERT ON affiliations
-    FOR EACH ROW
-    WHEN EXISTS (SELECT 1 FROM affiliations WHERE affiliation = NEW.affiliation)
-    BEGIN
-        UPDATE affiliations
-        SET Affiliation_ID = (SELECT GROUP_CONCAT(Affiliation_ID, ',') || ',' || NEW.Affiliation_ID
-                            FROM affiliations
-                            WHERE affiliation = NEW.affiliation)
-        WHERE affiliation = NEW.affiliation;
-        SELECT RAISE(IGNORE);
-    END;
-
-    """
-
-    # Execute the trigger SQL
+        if not inspect(conn).has_table('abstract_label_cache'):
+            return []
+        return [tuple(row) for row in conn.execute(text(query))]
+
+def store_label_cache(label_sections, conn=None):
+    """
+    Persists new abstract label classifications. Labels already stored are left untouched.
+
+    Parameters:
+    - label_sections: A list of (label, section) tuples.
+    - conn: Optional. Connection whose transaction is used, otherwise a new transaction is started.
+    """
+    if len(label_sections) == 0:
+        return
+    with connection_scope(conn or engine) as conn:
+        conn.execute(text('INSERT OR IGNORE INTO abstract_label_cache (label, section) VALUES (:label, :section)'),
+                     [{'label': label, 'section': section} for label, section in label_sections])
+
+# Parsed fields persisted in the affiliation parse cache. full_text and email are specific to each
+# affiliation string and are not cached (see parseAffiliations.py).
+affiliation_parse_cache_fields = ['department', 'institution', 'location', 'country', 'zipcode']
+
+def create_affiliation_parse_cache_table():
+    """
+    Creates the table used to persist the parsed fields of each normalized affiliation text across runs.
+    """
+    columns = ', '.join(f'{field} TEXT' for field in affiliation_parse_cache_fields)
+    with engine.begin() as conn:
+        conn.execute(text(f'CREATE TABLE IF NOT EXISTS affiliation_parse_cache (text_hash TEXT PRIMARY KEY, {columns}) WITHOUT ROWID'))
+
+def load_affiliation_parse_cache(text_hashes):
+    """
+    Looks up the parsed fields of normalized affiliation texts, in chunks of sql_chunk_size.
+
+    Parameters:
+    - text_hashes: A list of hashes of normalized affiliation texts.
+
+    Returns:
+    - A dictionary with the parsed fields of each hash found (hash -> dictionary of fields).
+    """
+    query = text(f"SELECT text_hash, {', '.join(affiliation_parse_cache_fields)} FROM affiliation_parse_cache WHERE text_hash IN :text_hashes").bindparams(bindparam('text_hashes', expanding=True))
+    cached = {}
     with engine.connect() as conn:
-        conn.execute(text(trigger_dup_publications))
-        conn.execute(text(trigger_dup_authors))
-        # conn.execute(text(trigger_dup_affiliations))
-        conn.execute(text(trigger_merge_affiliations_ids))
+        for start in range(0, len(text_hashes), sql_chunk_size):
+            for row in conn.execute(query, {'text_hashes': text_hashes[start:start + sql_chunk_size]}):
+                cached[row[0]] = dict(zip(affiliation_parse_cache_fields, row[1:]))
+    return cached
+
+def store_affiliation_parse_cache(parsed_fields):
+    """
+    Persists the parsed fields of new normalized affiliation texts. Hashes already stored are left untouched.
 
+    Parameters:
+    - parsed_fields: A dictionary with the parsed fields of each hash (hash -> dictionary of fields).
+    """
+    if len(parsed_fields) == 0:
+        return
+    columns = ', '.join(affiliation_parse_cache_fields)
+    values = ', '.join(f':{field}' for field in affiliation_parse_cache_fields)
+    with engine.begin() as conn:
+        conn.execute(text(f'INSERT OR IGNORE INTO affiliation_parse_cache (text_hash, {columns}) VALUES (:text_hash, {values})'),
+                     [{'text_hash': text_hash, **{field: fields.get(field) for field in affiliation_parse_cache_fields}} for text_hash, fields in parsed_fields.items()])
 
-def store_in_SQL(tableName,dfToStore):
+def create_watermark_table():
     """
-    Stores a DataFrame in a specified table in the SQL database. Handles dynamic column addition if necessary.
-    
+    Creates the table keeping the high-water mark of incremental jobs (the last key they processed).
+    """
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE IF NOT EXISTS watermarks (name TEXT PRIMARY KEY, last_key INTEGER)'))
+
+def get_watermark(name):
+    """
+    Returns the high-water mark of an incremental job.
+
     Parameters:
-    - tableName: The name of the table where the DataFrame should be stored.
-    - dfToStore: The pandas DataFrame containing data to be inserted into the table.
+    - name: The name of the job.
+
+    Returns:
+    - The last key processed by the job, or None if it never ran.
     """
+    with engine.connect() as conn:
+        return conn.execute(text('SELECT last_key FROM watermarks WHERE name = :name'), {'name': name}).scalar()
 
-    insert_data(engine,tableName, dfToStore)
+def set_watermark(name, last_key, conn=None):
+    """
+    Stores the high-water mark of an incremental job.
 
+    Parameters:
+    - name: The name of the job.
+    - last_key: The last key processed by the job.
+    - conn: Optional. Connection whose transaction is used, so the mark is committed with the processed data.
+    """
+    with connection_scope(conn or engine) as conn:
+        conn.execute(text('INSERT INTO watermarks (name, last_key) VALUES (:name, :last_key) ON CONFLICT(name) DO UPDATE SET last_key = excluded.last_key'),
+                     {'name': name, 'last_key': last_key})
 
-#Transform df to store in SQL
-def transform_pubications_for_SQL(df):
+def get_max_value(table_name, column_name, as_integer=False):
     """
-    Transforms a publications DataFrame for SQL storage, converting lists to comma-separated strings.
+    Returns the maximum value of a column.
 
     Parameters:
-    - df: The DataFrame containing publications data.
+    - table_name: The name of the table.
+    - column_name: The name of the column.
+    - as_integer: If True, the values are compared as integers (for integers stored in TEXT columns).
 
     Returns:
-    - The transformed DataFrame with list columns converted to comma-separated strings.
+    - The maximum value, or None if the table is empty.
     """
+    column_expression = f'CAST("{column_name}" AS INTEGER)' if as_integer else f'"{column_name}"'
+    with engine.connect() as conn:
+        return conn.execute(text(f'SELECT MAX({column_expression}) FROM {table_name}')).scalar()
 
-    df['AuthorList'] = df['AuthorList'].apply(list_to_SQL)
-    df['ReferenceList'] = df['ReferenceList'].apply(list_to_SQL)
-    return df
+def create_manifest_table():
+    """
+    Creates the ingested_files manifest: one row per XML file stored in the database, with its size and checksum
+    (to skip unchanged files), its article count, the range of author and affiliation IDs it was given and its status
+    ('loading' while it is being stored, 'loaded' once its transaction is committed).
+    """
+    with engine.begin() as conn:
+        conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS ingested_files (
+            file_name TEXT PRIMARY KEY,
+            size INTEGER,
+            checksum TEXT,
+            articles INTEGER,
+            deleted_citations INTEGER,
+            first_author_id INTEGER,
+            last_author_id INTEGER,
+            first_affiliation_id INTEGER,
+            last_affiliation_id INTEGER,
+            status TEXT,
+            loaded_at TEXT
+        )
+        """))
+
+def get_ingested_files():
+    """
+    Returns the ingested_files manifest.
+
+    Returns:
+    - A dictionary with the manifest row of each file (file name -> dictionary of columns).
+    """
+    with engine.connect() as conn:
+        return {row['file_name']: dict(row) for row in conn.execute(text('SELECT * FROM ingested_files')).mappings()}
 
-def transform_authors_for_SQL(df):
+def start_file_load(file_record):
     """
-    Transforms an authors DataFrame for SQL storage, specifically handling the AffiliationList column.
+    Records that a file is being stored (status 'loading'), committed before its data so an interrupted
+    load can be rolled back (see rollback_file_load).
 
     Parameters:
-    - df: The DataFrame containing authors data.
+    - file_record: Dictionary with the file_name, size, checksum, articles, deleted_citations and the
+      first/last author and affiliation IDs of the file.
+    """
+    columns = ['file_name', 'size', 'checksum', 'articles', 'deleted_citations', 'first_author_id', 'last_author_id', 'first_affiliation_id', 'last_affiliation_id']
+    with engine.begin() as conn:
+        conn.execute(text(f"INSERT OR REPLACE INTO ingested_files ({', '.join(columns)}, status, loaded_at) VALUES ({', '.join(':' + column for column in columns)}, 'loading', NULL)"),
+                     {column: file_record[column] for column in columns})
+
+def finish_file_load(file_name, conn):
+    """
+    Marks a file as loaded, in the transaction storing its data.
+
+    Parameters:
+    - file_name: The name of the XML file.
+    - conn: Connection of the transaction storing the data of the file.
+    """
+    conn.execute(text("UPDATE ingested_files SET status = 'loaded', loaded_at = datetime('now') WHERE file_name = :file_name"), {'file_name': file_name})
+
+def rollback_file_load(file_record):
+    """
+    Removes what an interrupted load of a file may have left (its authors, author-affiliation and publication-author
+    links and new affiliations, by their ID ranges) and its manifest row, so the file is stored again.
+    Its publications are overwritten when the file is stored again.
+
+    Parameters:
+    - file_record: The manifest row of the file.
+    """
+    with engine.begin() as conn:
+        tables = inspect(conn).get_table_names()
+        if file_record['last_author_id'] is not None and file_record['first_author_id'] <= file_record['last_author_id']:
+            author_range = {'first': file_record['first_author_id'], 'last': file_record['last_author_id']}
+            if 'author_affiliations' in tables:
+                conn.execute(text('DELETE FROM author_affiliations WHERE Author_ID BETWEEN :first AND :last'), author_range)
+            if 'publication_authors' in tables:
+                conn.execute(text('DELETE FROM publication_authors WHERE author_id BETWEEN :first AND :last'), author_range)
+            if 'authors' in tables:
+                conn.execute(text('DELETE FROM authors WHERE Author_ID BETWEEN :first AND :last'), author_range)
+        if file_record['last_affiliation_id'] is not None and file_record['first_affiliation_id'] <= file_record['last_affiliation_id'] and 'affiliations' in tables:
+            conn.execute(text('DELETE FROM affiliations WHERE Affiliation_ID BETWEEN :first AND :last'),
+                         {'first': file_record['first_affiliation_id'], 'last': file_record['last_affiliation_id']})
+        conn.execute(text('DELETE FROM ingested_files WHERE file_name = :file_name'), {'file_name': file_record['file_name']})
+
+def get_ID_counters():
+    """
+    Returns the last author and affiliation IDs used by the database, to continue numbering from them.
 
     Returns:
-    - The transformed DataFrame with the AffiliationList column converted to comma-separated strings.
+    - Tuple containing the author and the affiliation ID counters (0 for an empty database).
     """
-    df['AffiliationList'] = df['AffiliationList'].apply(list_to_SQL)
-    return df
+    with engine.connect() as conn:
+        tables = inspect(conn).get_table_names()
+        author_ids = ['(SELECT MAX(last_author_id) FROM ingested_files)']
+        affiliation_ids = ['(SELECT MAX(last_affiliation_id) FROM ingested_files)']
+        if 'authors' in tables:
+            author_ids.append('(SELECT MAX(Author_ID) FROM authors)')
+        if 'affiliations' in tables:
+            affiliation_ids.append('(SELECT MAX(Affiliation_ID) FROM affiliations)')
+        # MAX() over the subqueries, ignoring the NULLs of empty tables
+        AuthorIDCounter = max([value for value in conn.execute(text(f"SELECT {', '.join(author_ids)}")).one() if value is not None], default=0)
+        AffiliationIDCounter = max([value for value in conn.execute(text(f"SELECT {', '.join(affiliation_ids)}")).one() if value is not None], default=0)
+    return int(AuthorIDCounter), int(AffiliationIDCounter)
+
+def load_affiliation_ids():
+    """
+    Loads the affiliation dictionary (affiliation text -> Affiliation_ID) of the affiliations already stored.
+
+    Returns:
+    - The affiliation dictionary.
+    """
+    affiliation_ids = {}
+    if not inspect(engine).has_table('affiliations'):
+        return affiliation_ids
+    for each_batch in fetch_records_in_batches('affiliations', batch_size=100000):
+        affiliation_ids.update(zip(each_batch['affiliation'].values.tolist(), each_batch['Affiliation_ID'].values.tolist()))
+    return affiliation_ids
 
-def list_to_SQL(x):
+def delete_publications(pmids, conn=None):
     """
-    Converts a list to a comma-separated string, or returns the input if it is not a list.
+    Deletes publications with their authors, author-affiliation links, publication-author links, citations, attributes and texts (the DeleteCitation PMIDs of update files),
+    in batches of sql_chunk_size. Affiliations are kept, they may be shared with other authors.
 
     Parameters:
-    - x: The input value, possibly a list.
+    - pmids: The PMIDs of the publications to delete.
+    - conn: Optional. Connection whose transaction is used, otherwise a new transaction is started.
 
     Returns:
-    - A comma-separated string if the input is a list, otherwise the original input.
+    - The number of publications deleted.
     """
-    if isinstance(x, list):
-        return ', '.join(map(str, x))
-    else:
-        return x  # keep the value as is, including NaN
+    pmids = [str(pmid) for pmid in pmids]
+    deleted = 0
+    with connection_scope(conn or engine) as conn:
+        tables = inspect(conn).get_table_names()
+        if len(pmids) == 0 or 'publications' not in tables:
+            return deleted
+        for start in range(0, len(pmids), sql_chunk_size):
+            chunk = {'pmids': pmids[start:start + sql_chunk_size]}
+            conn.execute(text('DELETE FROM author_affiliations WHERE Author_ID IN (SELECT Author_ID FROM authors WHERE PMID IN :pmids)').bindparams(bindparam('pmids', expanding=True)), chunk)
+            conn.execute(text('DELETE FROM authors WHERE PMID IN :pmids').bindparams(bindparam('pmids', expanding=True)), chunk)
+            integer_chunk = {'pmids': [int(pmid) for pmid in chunk['pmids']]}
+            conn.execute(text('DELETE FROM publication_authors WHERE pmid IN :pmids').bindparams(bindparam('pmids', expanding=True)), integer_chunk)
+            conn.execute(text('DELETE FROM citations WHERE citing_pmid IN :pmids').bindparams(bindparam('pmids', expanding=True)), integer_chunk)
+            if 'publication_attributes' in tables:
+                conn.execute(text('DELETE FROM publication_attributes WHERE pmid IN :pmids').bindparams(bindparam('pmids', expanding=True)), integer_chunk)
+            if 'publication_texts' in tables:
+                conn.execute(text('DELETE FROM publication_texts WHERE pmid IN :pmids').bindparams(bindparam('pmids', expanding=True)), integer_chunk)
+            deleted += conn.execute(text('DELETE FROM publications WHERE PMID IN :pmids').bindparams(bindparam('pmids', expanding=True)), chunk).rowcount
+    return deleted
+
+
+def store_in_SQL(tableName,dfToStore,conn=None):
+    """
+    Stores a DataFrame in a specified table in the SQL database. Handles dynamic column addition if necessary.
+    
+    Parameters:
+    - tableName: The name of the table where the DataFrame should be stored.
+    - dfToStore: The pandas DataFrame containing data to be inserted into the table.
+    - conn: Optional. Connection whose transaction is used (see begin_transaction), otherwise the data is committed on its own.
+    """
+
+    insert_data(conn or engine,tableName, dfToStore)
+
 
 #READ
 def get(tableName="publications", by=['PMID'], filterLists=[[30103854, 36548]]):
     """
     Queries a table for rows matching specified conditions and returns the results as a DataFrame.
+    Kept for compatibility, see RecordReader to also get the missing IDs or to cache records.
 
     Parameters:
     - tableName: The name of the table to query.
@@ -361,83 +1466,276 @@ def get(tableName="publications", by=['PMID'], filterLists=[[30103854, 36548]]):
     Returns:
     - A pandas DataFrame containing the query results.
     """
+    result_df, missing_ids = RecordReader(tableName).get(by, filterLists)
+    return result_df
 
-    # Connect to the database
-    connection = engine.connect()
-    
-    # Get the metadata and the table
-    metadata = MetaData()
-    
-    # Reflect the table schema
-    metadata.reflect(bind=engine)
-    
-    # Get the table from the reflected metadata
-    target_table = metadata.tables.get(tableName)
-    
-    # Check if 'by' and 'filterLists' have the same length
-    if len(by) != len(filterLists):
-        raise ValueError("Length of 'by' and 'filterLists' must be the same")
-    
-    # Build a select statement with multiple WHERE clauses
-    select_statement = select(target_table)
-    for column_name, ids in zip(by, filterLists):
-        select_statement = select_statement.where(getattr(target_table.c, column_name).in_(ids))
-    
-    # Execute the select statement and fetch the result into a Pandas DataFrame
-    result_df = pd.read_sql(select_statement, connection)
-    
-    # Prepare a list to collect missing ID information
-    missing_info = []
+class RecordReader:
+    """
+    Reads records of a table by lists of values. Meant to be created once and reused: the table is reflected
+    only once (see get_reflected_table), connections are taken from the engine pool, long lists of values are
+    queried in chunks below SQLite's bound parameter limit, and the records fetched by primary key can be kept
+    in a bounded LRU cache. Publications of a database in the sparse attributes or the compressed text mode are
+    returned with their attributes and (decompressed) texts as columns, as if they were stored in the publications table.
+    """
+
+    def __init__(self, table_name="publications", cache_size=0, chunk_size=None):
+        """
+        Parameters:
+        - table_name: The name of the table to read.
+        - cache_size: Maximum number of records kept in the LRU cache, 0 disables the cache. Only lookups by
+          the primary key of the table (e.g. PMID) use the cache.
+        - chunk_size: Optional. Maximum number of values in each IN (...) list, sql_chunk_size by default.
+        """
+        self.table_name = table_name
+        self.cache_size = cache_size
+        self.chunk_size = chunk_size or sql_chunk_size
+        self.cache = OrderedDict()
+        primary_key_columns = list(get_reflected_table(table_name).primary_key.columns)
+        self.cache_key = primary_key_columns[0].name if len(primary_key_columns) == 1 else None
+        self.with_attributes = table_name == 'publications' and inspect(engine).has_table('publication_attributes')
+        self.with_texts = table_name == 'publications' and inspect(engine).has_table('publication_texts')
+
+    def get(self, by=['PMID'], filterLists=[[30103854, 36548]]):
+        """
+        Queries the table for rows matching all the conditions (column IN values for each column in 'by').
 
-    # Check and collect the IDs that were not found for each column
-    for column_name, ids in zip(by, filterLists):
-        missing_ids = set(ids) - set(result_df[column_name])
-        if missing_ids:
-            missing_info.append(f"{column_name}: {missing_ids}")
+        Parameters:
+        - by: A list of column names to filter by.
+        - filterLists: A list of lists, where each sublist contains values to filter the corresponding column in 'by'.
 
-    connection.close()
+        Returns:
+        - Tuple containing a pandas DataFrame with the query results and a dictionary with the values of each
+          column that were not found (column name -> list of values, only columns with missing values).
+        """
+        # Check if 'by' and 'filterLists' have the same length
+        if len(by) != len(filterLists):
+            raise ValueError("Length of 'by' and 'filterLists' must be the same")
 
-    return result_df
+        target_table = get_reflected_table(self.table_name)
+        filterLists = [list(dict.fromkeys(ids)) for ids in filterLists]
 
+        # Records already in the cache are not queried again
+        cached_records = []
+        if self.cache_size > 0 and by == [self.cache_key]:
+            uncached_ids = []
+            for each_id in filterLists[0]:
+                cache_id = str(each_id)
+                if cache_id in self.cache:
+                    self.cache.move_to_end(cache_id)
+                    cached_records.append(self.cache[cache_id])
+                else:
+                    uncached_ids.append(each_id)
+            filterLists = [uncached_ids]
 
-def fetch_records_in_batches(table_name, batch_size=1000):
+        # Query every combination of chunks of the lists, each record matches exactly one of them
+        chunked_lists = [[ids[start:start + self.chunk_size] for start in range(0, len(ids), self.chunk_size)] for ids in filterLists]
+        result_dfs = [pd.DataFrame(cached_records) if cached_records else pd.DataFrame(columns=[table_column.name for table_column in target_table.columns])]
+        with engine.connect() as connection:
+            for chunks in product(*chunked_lists):
+                select_statement = select(target_table)
+                for column_name, ids in zip(by, chunks):
+                    select_statement = select_statement.where(target_table.c[column_name].in_(ids))
+                fetched_df = pd.read_sql(select_statement, connection)
+                if self.with_attributes:
+                    fetched_df = self.add_attributes(fetched_df, connection)
+                if self.with_texts:
+                    fetched_df = self.add_texts(fetched_df, connection)
+                self.cache_records(fetched_df)
+                result_dfs.append(fetched_df)
+        result_df = pd.concat([each_df for each_df in result_dfs if not each_df.empty] or result_dfs[:1], ignore_index=True)
+
+        # Collect the values that were not found for each column (compared as text, PMIDs are stored as text)
+        missing_info = {}
+        for column_name, ids in zip(by, filterLists):
+            found_ids = set(result_df[column_name].astype(str))
+            missing_ids = [each_id for each_id in ids if str(each_id) not in found_ids]
+            if missing_ids:
+                missing_info[column_name] = missing_ids
+
+        return result_df, missing_info
+
+    def add_attributes(self, publications_df, connection):
+        """
+        Adds the attributes of the publications (publication_attributes) as columns, one per attribute found.
+
+        Parameters:
+        - publications_df: DataFrame with publications fetched from the table.
+        - connection: Connection used to query the attributes.
+
+        Returns:
+        - The DataFrame with the attribute columns added (NULL for the publications without the attribute).
+        """
+        if len(publications_df) == 0:
+            return publications_df
+        attributes_query = text('SELECT pmid, attr, value FROM publication_attributes WHERE pmid IN :pmids').bindparams(bindparam('pmids', expanding=True))
+        pmids = [int(pmid) for pmid in publications_df['PMID'].tolist()]
+        attributes_df = pd.DataFrame(connection.execute(attributes_query, {'pmids': pmids}).fetchall(), columns=['pmid', 'column', 'value'])
+        return self.add_columns(publications_df, pmids, attributes_df)
+
+    def add_texts(self, publications_df, connection):
+        """
+        Adds the texts of the publications (publication_texts) as columns, decompressed.
+
+        Parameters:
+        - publications_df: DataFrame with publications fetched from the table.
+        - connection: Connection used to query the texts.
+
+        Returns:
+        - The DataFrame with the text columns added (NULL for the publications without the text).
+        """
+        if len(publications_df) == 0:
+            return publications_df
+        texts_query = text('SELECT pmid, field, codec, dictionary_id, data FROM publication_texts WHERE pmid IN :pmids').bindparams(bindparam('pmids', expanding=True))
+        pmids = [int(pmid) for pmid in publications_df['PMID'].tolist()]
+        texts = [(pmid, field, decompress_text(codec, dictionary_id, data)) for pmid, field, codec, dictionary_id, data in connection.execute(texts_query, {'pmids': pmids})]
+        return self.add_columns(publications_df, pmids, pd.DataFrame(texts, columns=['pmid', 'column', 'value']))
+
+    def add_columns(self, publications_df, pmids, values_df):
+        """
+        Pivots (pmid, column, value) rows into columns of the publications.
+
+        Parameters:
+        - publications_df: DataFrame with publications fetched from the table.
+        - pmids: The PMIDs of the publications, as integers.
+        - values_df: DataFrame with the pmid, column and value of each value.
+
+        Returns:
+        - The DataFrame with a column added per column name found, sorted by name (NULL for the publications without a value).
+        """
+        if len(values_df) == 0:
+            return publications_df
+        new_columns = values_df.pivot(index='pmid', columns='column', values='value').reindex(pmids)
+        new_columns = new_columns[sorted(new_columns.columns)].astype(object).where(new_columns.notna(), None)
+        new_columns.index = publications_df.index
+        new_columns.columns.name = None
+        return pd.concat([publications_df, new_columns], axis=1)
+
+    def cache_records(self, records_df):
+        """
+        Adds fetched records to the LRU cache, evicting the least recently used ones beyond cache_size.
+
+        Parameters:
+        - records_df: DataFrame with records of the table.
+        """
+        if self.cache_size == 0 or self.cache_key is None:
+            return
+        for record in records_df.to_dict('records'):
+            cache_id = str(record[self.cache_key])
+            self.cache[cache_id] = record
+            self.cache.move_to_end(cache_id)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def clear_cache(self):
+        """
+        Empties the LRU cache, e.g. after the table has been updated.
+        """
+        self.cache.clear()
+
+def get_publications_by_attribute(attr, values):
+    """
+    Finds the publications with an attribute in a list of values (e.g. the PMIDs of a list of DOIs with 'ArticleId_doi'),
+    in a database in the sparse attributes mode. Queried in chunks with the ix_publication_attributes_attr index.
+
+    Parameters:
+    - attr: The attribute, named as its publications column would be (e.g. 'ArticleId_doi', 'History_received').
+    - values: The values to look for.
+
+    Returns:
+    - DataFrame with the pmid and value of each publication found.
+    """
+    attribute_query = text(f'SELECT pmid, value FROM publication_attributes WHERE attr = :attr AND value IN :values AND {indexed_attributes_condition}').bindparams(bindparam('values', expanding=True))
+    values = list(dict.fromkeys(values))
+    rows = []
+    with engine.connect() as conn:
+        for start in range(0, len(values), sql_chunk_size):
+            rows.extend(conn.execute(attribute_query, {'attr': attr, 'values': values[start:start + sql_chunk_size]}).fetchall())
+    return pd.DataFrame(rows, columns=['pmid', 'value'])
+
+def get_reflected_table(table_name):
+    """
+    Returns a table reflected from the database, reflecting only that table and only the first time.
+    
+    Parameters:
+    - table_name: The name of the table.
+    
+    Returns:
+    - The SQLAlchemy Table.
+    """
+    if table_name not in reflected_tables:
+        reflected_tables[table_name] = Table(table_name, MetaData(), autoload_with=engine)
+    return reflected_tables[table_name]
+
+def get_pagination_key(target_table):
+    """
+    Returns the columns used for keyset pagination of a table: its primary key or, for tables without one, the rowid.
+    
+    Parameters:
+    - target_table: The reflected SQLAlchemy Table.
+    
+    Returns:
+    - A list of SQLAlchemy columns.
+    """
+    primary_key_columns = list(target_table.primary_key.columns)
+    if len(primary_key_columns) > 0:
+        return primary_key_columns
+    return [column('rowid')]
+
+def fetch_records_in_batches(table_name, batch_size=1000, columns=None, start_after=None):
     """
     Fetches records from a specified table in batches, yielding each batch as a pandas DataFrame.
 
     This is useful for processing large tables without loading the entire table into memory.
+    Batches are paged by the primary key of the table (or the rowid) instead of LIMIT ... OFFSET,
+    so each batch is a range scan of the key index and does not rescan the rows already fetched.
 
     Parameters:
     - table_name: The name of the table from which to fetch records.
     - batch_size: The number of records to fetch in each batch.
+    - columns: Optional. The names of the columns to fetch, all the columns by default.
+    - start_after: Optional. Only records with a key greater than this value are fetched, used to resume
+      a previous run. A tuple for tables with a composite primary key.
 
     Returns:
-    - DataFrame containing a batch of records from the table.
+    - DataFrame containing a batch of records from the table, ordered by the key.
     """
 
-    # Reflect the database schema into MetaData object.
-    metadata = MetaData()
-    metadata.reflect(bind=engine)
-    # Retrieve the target table definition from the metadata.
-    target_table = metadata.tables.get(table_name)
-    # Initialize the offset for pagination.
-    offset = 0
+    # Retrieve the target table definition (reflected once and cached).
+    target_table = get_reflected_table(table_name)
+    key_columns = get_pagination_key(target_table)
+    key_names = [key_column.name for key_column in key_columns]
+    key = key_columns[0] if len(key_columns) == 1 else tuple_(*key_columns)
 
-    # Loop indefinitely to fetch records in batches.
-    while True:
-        # Build a query to fetch a batch of records, applying limit and offset for pagination.
-        batch_query = select(target_table).limit(batch_size).offset(offset)
-        batch_df = pd.read_sql(batch_query, engine)
+    if columns is None:
+        selected_columns = list(target_table.columns)
+    else:
+        selected_columns = [target_table.c[column_name] for column_name in columns]
+    # The key columns are always fetched to know where the next batch starts, and dropped if not requested.
+    selected_names = [selected_column.name for selected_column in selected_columns]
+    dropped_columns = [key_name for key_name in key_names if key_name not in selected_names]
+    selected_columns += [key_column for key_column in key_columns if key_column.name in dropped_columns]
 
-        # If no records were fetched (i.e., DataFrame is empty), stop the iteration.
-        if batch_df.empty:
-            break
+    last_key = start_after
+    with engine.connect() as connection:
+        # Loop until a batch smaller than batch_size is fetched.
+        while True:
+            # Build a query to fetch the records after the last key of the previous batch.
+            batch_query = select(*selected_columns).order_by(*key_columns).limit(batch_size)
+            if last_key is not None:
+                batch_query = batch_query.where(key > (tuple_(*last_key) if len(key_columns) > 1 else last_key))
+            batch_df = pd.read_sql(batch_query, connection)
 
-        yield batch_df  # Yield the current batch of records to the caller.
+            # If no records were fetched (i.e., DataFrame is empty), stop the iteration.
+            if batch_df.empty:
+                break
 
-        # If the fetched batch is smaller than the requested batch_size, it's the last batch.
-        if len(batch_df) < batch_size:
-            break
-        
-        # Increment the offset for the next batch.
-        offset += batch_size
+            # tolist() converts the numpy values back to python values that can be bound in the next query
+            last_key = tuple(batch_df[key_name].iloc[-1:].tolist()[0] for key_name in key_names)
+            if len(key_names) == 1:
+                last_key = last_key[0]
+
+            yield batch_df.drop(columns=dropped_columns)  # Yield the current batch of records to the caller.
 
+            # If the fetched batch is smaller than the requested batch_size, it's the last batch.
+            if len(batch_df) < batch_size:
+                break
@@ -0,0 +1,136 @@
+# records.py
+import pandas as pd
+
+
+class ColumnarTable:
+    """
+    Accumulates the records of a table column by column (one list per column) instead of as a list of dictionaries.
+
+    Records are appended as dictionaries, as they are produced by the parser, and may have different keys: a column
+    missing from a record is stored as None and a new column is backfilled with None for the previous records.
+    When key columns are given, duplicated records are merged while appending with a dictionary of the keys
+    (hash set) instead of a groupby: the first record is kept and its missing (None) values are filled from the
+    duplicates, like groupby(key).first().
+    """
+
+    __slots__ = ('columns', 'key', 'skip_null_keys', 'row_index', 'num_rows')
+
+    def __init__(self, columns=None, key=None, skip_null_keys=False):
+        """
+        Parameters:
+        - columns: Optional. Names of the columns known in advance, in order.
+        - key: Optional. Names of the columns identifying a record, duplicated records are merged.
+        - skip_null_keys: If True, records with a None key value are dropped (like groupby does with NaN keys).
+        """
+        self.columns = {column_name: [] for column_name in (columns or [])}
+        self.key = tuple(key) if key else None
+        self.skip_null_keys = skip_null_keys
+        self.row_index = {} # key -> row number
+        self.num_rows = 0
+
+    def __len__(self):
+        return self.num_rows
+
+    def add_column(self, column_name):
+        """
+        Adds a column filled with None for the records already appended.
+
+        Returns:
+        - The list of values of the new column.
+        """
+        column = [None] * self.num_rows
+        self.columns[column_name] = column
+        return column
+
+    def append(self, record):
+        """
+        Appends a record, or merges it into the stored record with the same key.
+
+        Parameters:
+        - record (dict): Column name -> value.
+        """
+        if self.key is not None:
+            key = tuple(record.get(column_name) for column_name in self.key)
+            if self.skip_null_keys and None in key:
+                return
+            row = self.row_index.get(key)
+            if row is not None:
+                # Duplicated record: keep the first value of each column, filling the missing ones
+                for column_name, value in record.items():
+                    if value is None:
+                        continue
+                    column = self.columns.get(column_name)
+                    if column is None:
+                        column = self.add_column(column_name)
+                    if column[row] is None:
+                        column[row] = value
+                return
+            self.row_index[key] = self.num_rows
+
+        for column_name, value in record.items():
+            column = self.columns.get(column_name)
+            if column is None:
+                column = self.add_column(column_name)
+            column.append(value)
+        self.num_rows += 1
+        # Columns missing from the record
+        if len(record) < len(self.columns):
+            for column in self.columns.values():
+                if len(column) < self.num_rows:
+                    column.append(None)
+
+    def get_column(self, column_name):
+        """
+        Returns the list of values of a column (None values if the column does not exist).
+        """
+        column = self.columns.get(column_name)
+        return column if column is not None else [None] * self.num_rows
+
+    def set_value(self, row, column_name, value):
+        """
+        Sets the value of a column in an appended record.
+        """
+        column = self.columns.get(column_name)
+        if column is None:
+            column = self.add_column(column_name)
+        column[row] = value
+
+    def pop_column(self, column_name):
+        """
+        Removes a column and returns its list of values.
+        """
+        column = self.columns.pop(column_name, None)
+        return column if column is not None else [None] * self.num_rows
+
+    def filter_rows(self, column_name, values):
+        """
+        Keeps only the records whose value in a column is one of the given values.
+
+        Parameters:
+        - column_name: The name of the column.
+        - values (set): The values to keep.
+        """
+        keep = [value in values for value in self.columns[column_name]]
+        if all(keep):
+            return
+        for each_column_name, column in self.columns.items():
+            self.columns[each_column_name] = [value for value, keep_row in zip(column, keep) if keep_row]
+        self.num_rows = sum(keep)
+        self.row_index = {}
+
+    def to_frame(self, first_columns=(), sort_columns=False):
+        """
+        Builds a DataFrame directly from the columns, without a list of dictionaries in between.
+
+        Parameters:
+        - first_columns: Optional. Columns placed first, in order.
+        - sort_columns: If True, the other columns are sorted by name.
+
+        Returns:
+        - The DataFrame.
+        """
+        other_columns = [column_name for column_name in self.columns if column_name not in first_columns]
+        if sort_columns:
+            other_columns = sorted(other_columns)
+        column_names = [column_name for column_name in first_columns if column_name in self.columns] + other_columns
+        return pd.DataFrame({column_name: self.columns[column_name] for column_name in column_names}, columns=column_names)
@@ -1,6 +1,11 @@
-from models.database import store_in_SQL, create_table,fetch_records_in_batches
+from models.database import store_in_SQL, create_table, fetch_records_in_batches, set_db_path, create_affiliation_parse_cache_table, load_affiliation_parse_cache, store_affiliation_parse_cache, affiliation_parse_cache_fields, create_watermark_table, get_watermark, set_watermark, get_max_value, begin_transaction
 from affiliation_parser import parse_affil
+from collections import Counter
 import pandas as pd
+import argparse # Import argparse for command-line parsing
+import multiprocessing # Import multiprocessing for parallel parsing of affiliations
+import hashlib # Import hashlib to key the parse cache
+import re
 import pdb
 
 # Define the structure of the table for storing parsed affiliations
@@ -16,32 +21,185 @@ affiliations_parsed_columns = {
     'email': 'text'
 }
 
-# Create the table for parsed affiliations in the database
-affiliations_parsed_table = create_table('AffiliationsParsed', 'affiliations_parsed', affiliations_parsed_columns)
+email_pattern = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+electronic_address_pattern = re.compile(r'electronic address\s*:', re.IGNORECASE)
 
-# Initialize a counter for new affiliation IDs
-new_aff_id = 0
+def normalize_affiliation(affiliation):
+    """
+    Normalizes an affiliation text for the parse cache: without emails, lower case, no extra spaces or trailing punctuation.
 
-# Fetch affiliations in batches and process each batch
-for each_batch in fetch_records_in_batches('affiliations', batch_size=30000):
-    parsed_data = []# Initialize a list to store parsed affiliation data
-    # Extract affiliation text and IDs into lists
-    affiliations_list = each_batch['affiliation'].values.tolist()
-    affiliation_ids = each_batch['Affiliation_ID'].values.tolist()
+    Parameters:
+    - affiliation (str): The affiliation text.
 
-    # Process each affiliation in the batch
-    for aff_id, each_affiliation in zip(affiliation_ids, affiliations_list):
+    Returns:
+    - The normalized text.
+    """
+    affiliation = electronic_address_pattern.sub(' ', email_pattern.sub(' ', affiliation))
+    return ' '.join(affiliation.lower().split()).strip(' .,;:')
+
+def affiliation_hash(affiliation):
+    """
+    Returns the parse cache key of an affiliation text, the hash of its normalized text.
+    """
+    return hashlib.sha1(normalize_affiliation(affiliation).encode('utf-8')).hexdigest()
+
+def extract_email(affiliation):
+    """
+    Returns the first email of an affiliation text, or an empty string.
+    """
+    match = email_pattern.search(affiliation)
+    return match.group(0) if match else ''
+
+def parse_affiliations(affiliations):
+    """
+    Parses a chunk of distinct affiliations (runs in the worker processes).
+
+    Parameters:
+    - affiliations (list): (hash, affiliation) tuples.
+
+    Returns:
+    - A dictionary with the fields of each parsed affiliation (hash -> dictionary of fields), the cached ones plus the
+      full_text and email returned by parse_affil for the text parsed.
+    """
+    parsed_fields = {}
+    for text_hash, each_affiliation in affiliations:
         try:
-            # Parse the affiliation and store the result
             parsed = parse_affil(each_affiliation)
-            parsed['id'] = new_aff_id
-            parsed['list_of_original_ids'] = aff_id
-            parsed_data.append(parsed)
-            new_aff_id += 1
+            parsed_fields[text_hash] = {field: parsed.get(field) for field in affiliation_parse_cache_fields + ['full_text', 'email']}
         except AttributeError:
-            print('Affiliation is empty or not a string. Removing it')    
-    
-    # Convert the list of parsed affiliations into a DataFrame and store it in the SQL database
-    parsed_df = pd.DataFrame(parsed_data)
-    store_in_SQL('affiliations_parsed', parsed_df)
-    print(parsed_df)
\ No newline at end of file
+            pass
+    return parsed_fields
+
+def parse_batch(each_batch, pool, chunk_size, stats):
+    """
+    Parses a batch of affiliations. Texts found in the parse cache are not parsed again, the distinct new
+    texts are parsed in chunks (in the pool if given) and added to the cache.
+
+    Parameters:
+    - each_batch (DataFrame): Batch of the affiliations table.
+    - pool (Pool): Process pool, or None to parse in the main process.
+    - chunk_size (int): Number of affiliations sent to a worker at once.
+    - stats (Counter): Updated with the number of affiliations 'cached', 'parsed', 'duplicate' (repeated in the batch) and 'empty'.
+
+    Returns:
+    - List of parsed affiliations (without their new id), in the order of the batch.
+    """
+    # Extract affiliation IDs and text into a list of tuples, skipping the empty ones
+    affiliations = []
+    for aff_id, each_affiliation in zip(each_batch['Affiliation_ID'].values.tolist(), each_batch['affiliation'].values.tolist()):
+        if isinstance(each_affiliation, str):
+            affiliations.append((aff_id, each_affiliation, affiliation_hash(each_affiliation)))
+        else:
+            stats['empty'] += 1
+
+    # Distinct normalized texts of the batch, only the ones missing from the cache are parsed
+    distinct_affiliations = {}
+    for aff_id, each_affiliation, text_hash in affiliations:
+        distinct_affiliations.setdefault(text_hash, each_affiliation)
+    parsed_fields = load_affiliation_parse_cache(list(distinct_affiliations.keys()))
+    to_parse = [(text_hash, each_affiliation) for text_hash, each_affiliation in distinct_affiliations.items() if text_hash not in parsed_fields]
+    chunks = [to_parse[start:start + chunk_size] for start in range(0, len(to_parse), chunk_size)]
+    # Chunks are parsed in the pool and returned in order, the main process is the only writer
+    new_fields = {}
+    for chunk_fields in (pool.imap(parse_affiliations, chunks) if pool else map(parse_affiliations, chunks)):
+        new_fields.update(chunk_fields)
+    store_affiliation_parse_cache(new_fields)
+
+    parsed_data = []
+    parsed_hashes = set()
+    for aff_id, each_affiliation, text_hash in affiliations:
+        if text_hash in new_fields:
+            stats['duplicate' if text_hash in parsed_hashes else 'parsed'] += 1
+            parsed_hashes.add(text_hash)
+            fields = new_fields[text_hash]
+        elif text_hash in parsed_fields:
+            stats['cached'] += 1
+            fields = parsed_fields[text_hash]
+        else:
+            # Could not be parsed
+            stats['empty'] += 1
+            continue
+        if text_hash in new_fields and distinct_affiliations[text_hash] == each_affiliation:
+            # The string parse_affil was given, its own full_text and email are kept
+            parsed = dict(fields)
+        else:
+            # full_text and email are specific to each string and are not cached, they are taken from the string itself
+            parsed = {field: fields[field] for field in affiliation_parse_cache_fields}
+            parsed.update(full_text=each_affiliation, email=extract_email(each_affiliation))
+        parsed['list_of_original_ids'] = aff_id
+        parsed_data.append(parsed)
+    return parsed_data
+
+def store_parsed_affiliations(parsed_data, new_aff_id, last_affiliation_id):
+    """
+    Assigns the new ids to parsed affiliations and stores them in the affiliations_parsed table. The watermark
+    is committed in the same transaction, so an interrupted run resumes after the last stored batch.
+
+    Parameters:
+    - parsed_data (list): Parsed affiliations, in the order of the affiliations table.
+    - new_aff_id (int): First id to assign.
+    - last_affiliation_id (int): Affiliation_ID of the last row of the batch, stored as the watermark.
+
+    Returns:
+    - new_aff_id (int): Updated id counter.
+    """
+    for parsed in parsed_data:
+        parsed['id'] = new_aff_id
+        new_aff_id += 1
+    with begin_transaction() as conn:
+        if len(parsed_data) > 0:
+            # Convert the list of parsed affiliations into a DataFrame and store it in the SQL database
+            parsed_df = pd.DataFrame(parsed_data)
+            store_in_SQL('affiliations_parsed', parsed_df, conn)
+        set_watermark('affiliations_parsed', last_affiliation_id, conn)
+    return new_aff_id
+
+def print_parse_stats(stats):
+    """
+    Prints how many affiliations were parsed and the parse cache hit rate.
+
+    Parameters:
+    - stats (Counter): Counts updated by parse_batch.
+    """
+    total = stats['cached'] + stats['parsed'] + stats['duplicate']
+    hit_rate = (stats['cached'] + stats['duplicate']) / total if total > 0 else 0
+    print(f"Affiliations: {total}, parsed: {stats['parsed']}, from cache: {stats['cached']}, repeated: {stats['duplicate']} (hit rate {hit_rate:.1%}), empty or not a string: {stats['empty']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parses the affiliations table into the affiliations_parsed table")
+    parser.add_argument('--db', type=str, default='PubMed_june_2024.db', help='Path of the SQLite database generated by pubmedXML2DB.py')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes parsing affiliations (1 parses them in the main process)')
+    parser.add_argument('--batch-size', type=int, default=30000, help='Number of affiliations fetched and stored at once')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='Number of affiliations sent to a worker at once')
+    args = parser.parse_args()
+
+    set_db_path(args.db)
+
+    # Create the table for parsed affiliations in the database
+    affiliations_parsed_table = create_table('AffiliationsParsed', 'affiliations_parsed', affiliations_parsed_columns)
+    create_affiliation_parse_cache_table()
+    create_watermark_table()
+
+    # Continue the IDs after the ones parsed in previous runs, and the affiliations after the watermark (stored even
+    # when no affiliation of the batches was parsed)
+    max_aff_id = get_max_value('affiliations_parsed', 'id')
+    new_aff_id = 0 if max_aff_id is None else max_aff_id + 1
+    last_affiliation_id = get_watermark('affiliations_parsed')
+    if max_aff_id is not None and last_affiliation_id is None:
+        # Table parsed before watermarks were stored, resume after the last affiliation it has
+        last_affiliation_id = get_max_value('affiliations_parsed', 'list_of_original_ids', as_integer=True)
+    if last_affiliation_id is not None:
+        print(f'Resuming after Affiliation_ID {last_affiliation_id}, next id {new_aff_id}')
+    stats = Counter()
+
+    pool = multiprocessing.Pool(args.workers) if args.workers > 1 else None
+    # Fetch affiliations in batches and process each batch
+    for each_batch in fetch_records_in_batches('affiliations', batch_size=args.batch_size, start_after=last_affiliation_id):
+        parsed_data = parse_batch(each_batch, pool, args.chunk_size, stats)
+        new_aff_id = store_parsed_affiliations(parsed_data, new_aff_id, each_batch['Affiliation_ID'].iloc[-1].item())
+        print_parse_stats(stats)
+
+    if pool:
+        pool.close()
+        pool.join()
@@ -2,22 +2,32 @@ import pdb # Import Python debugger
 import pandas as pd # Import pandas for data manipulation
 import time # Import time for performance metrics
 import argparse # Import argparse for command-line parsing
+import multiprocessing # Import multiprocessing for parallel parsing of XML files
+import itertools # Import itertools to submit the files to the pool a few at a time
+from collections import deque # Import deque for the files being parsed in parallel
 
 # Import custom functions from local modules
-from models.database import store_in_SQL, create_dynamic_tables, transform_pubications_for_SQL, transform_authors_for_SQL
-from services.XMLServices import list_XML_files, process_XML, set_XML_path
+from models.database import store_in_SQL, create_dynamic_tables, table_exists, create_affiliation_tables, drop_database_triggers, drop_secondary_indexes, replace_publications, apply_typed_schema, set_typed_schema, get_typed_schema, split_sparse_attributes, set_sparse_attributes, get_sparse_attributes, split_compressed_texts, compress_texts, set_text_compression, get_text_compression, set_conflict_mode, set_db_path, dispose_engine, begin_transaction, create_secondary_indexes
+from models.database import create_label_cache_table, store_label_cache, create_citations_table, create_publication_authors_table, create_publication_attributes_table, create_publication_texts_table, create_manifest_table, get_ingested_files, start_file_load, finish_file_load, rollback_file_load, get_ID_counters, load_affiliation_ids, delete_publications
+from services.XMLServices import list_XML_files, process_XML, set_XML_path, set_XML_backend, set_label_classifier, set_classifier_backend, shift_IDs, get_XML_checksum, get_XML_size
+from services.LabelServices import pop_label_stats, pop_label_sections
 
 
+# Files parsed in parallel or waiting to be stored, per worker (see process_files_in_parallel)
+files_in_flight_per_worker = 2
 
-def process_file(file, count, AuthorIDCounter, AffiliationIDCounter):
+def process_file(file, AuthorIDCounter, AffiliationIDCounter, affiliation_ids, streaming=False, verify_md5=False, file_record=None):
     """
     Process a single XML file to extract and store publication, author, and affiliation data in SQL.
     
     Parameters:
     - file (str): The path to the XML file to be processed.
-    - count (int): The current count of processed files, used to determine if dynamic tables need creation.
     - AuthorIDCounter (int): A global counter for assigning unique IDs to authors.
     - AffiliationIDCounter (int): A global counter for assigning unique IDs to affiliations.
+    - affiliation_ids (dict): Global affiliation text -> Affiliation_ID dictionary, updated with the new affiliations of the file.
+    - streaming (bool): If True, the XML file is streamed article by article instead of loaded whole.
+    - verify_md5 (bool): If True, the XML file is checked against its NLM '.md5' sidecar file before processing.
+    - file_record (dict): Optional. Manifest record of the file (see get_file_record), stored with the file. Its checksum is reused by verify_md5.
     
     Returns:
     - AuthorIDCounter (int): Updated author ID counter.
@@ -27,19 +37,15 @@ def process_file(file, count, AuthorIDCounter, AffiliationIDCounter):
     # Record the start time
     start_time = time.time()
     
-    publications_df, authors_df, affiliations_df,AuthorIDCounter,AffiliationIDCounter = process_XML(file,AuthorIDCounter,AffiliationIDCounter)
+    first_author_id, first_affiliation_id = AuthorIDCounter + 1, AffiliationIDCounter + 1
+    publications_df, authors_df, affiliations_df, author_affiliations_df, citations_df, publication_authors_df,AuthorIDCounter,AffiliationIDCounter,deleted_PMIDs = process_XML(file,AuthorIDCounter,AffiliationIDCounter,affiliation_ids,streaming=streaming,verify_md5=verify_md5,checksum=file_record['checksum'] if file_record is not None else None)
+    print_label_stats(*pop_label_stats())
     
-    if count ==0 :
-        create_dynamic_tables(publications_df,authors_df,affiliations_df)
-        # pdb.set_trace()
-    
-    publications_df = transform_pubications_for_SQL(publications_df)
-    authors_df = transform_authors_for_SQL(authors_df)
-    store_in_SQL('publications',publications_df)
-    store_in_SQL('authors',authors_df)
-    store_in_SQL('affiliations',affiliations_df)
-
-    count = count + 1
+    if file_record is not None:
+        file_record.update(articles=len(publications_df), deleted_citations=len(deleted_PMIDs),
+                           first_author_id=first_author_id, last_author_id=AuthorIDCounter,
+                           first_affiliation_id=first_affiliation_id, last_affiliation_id=AffiliationIDCounter)
+    store_file(publications_df, authors_df, affiliations_df, author_affiliations_df, citations_df, publication_authors_df, file_record, deleted_PMIDs, pop_label_sections())
     
     # Record the end time
     end_time = time.time()
@@ -54,25 +60,295 @@ def process_file(file, count, AuthorIDCounter, AffiliationIDCounter):
     print(f'Elapsed time: {elapsed_time_minutes:.2f} minutes')
     return AuthorIDCounter, AffiliationIDCounter
 
+def store_file(publications_df, authors_df, affiliations_df, author_affiliations_df, citations_df, publication_authors_df, file_record=None, deleted_PMIDs=[], label_sections=[]):
+    """
+    Stores the publication, author, affiliation and citation data of a processed XML file in SQL, all in one transaction.
+    
+    The file is recorded in the ingested_files manifest as 'loading' before its transaction and marked as 'loaded'
+    in it, so a file whose load was interrupted is found and rolled back on the next run.
+    
+    Parameters:
+    - publications_df (DataFrame): Publications returned by process_XML.
+    - authors_df (DataFrame): Authors returned by process_XML.
+    - affiliations_df (DataFrame): New affiliations returned by process_XML.
+    - author_affiliations_df (DataFrame): Author-affiliation links returned by process_XML.
+    - citations_df (DataFrame): Citations returned by process_XML.
+    - publication_authors_df (DataFrame): Publication-author links returned by process_XML.
+    - file_record (dict): Optional. Manifest record of the file with its ID ranges, not recorded if None.
+    - deleted_PMIDs (list): PMIDs of the DeleteCitation element of the file, deleted after storing it.
+    - label_sections (list): Abstract labels newly classified while processing the file, (label, section) tuples added to the label cache.
+    """
+    # Typed columns are encoded as integers when the typed schema mode is enabled
+    publications_df = apply_typed_schema(publications_df)
+    authors_df = apply_typed_schema(authors_df)
+    # The abstracts, OtherAbtract and CoiStatement go to publication_texts in the compressed text mode
+    publications_df, texts_df = split_compressed_texts(publications_df)
+    # The open-ended History_*, ArticleId_* and Abstract_* keys go to publication_attributes in the sparse attributes mode
+    publications_df, attributes_df = split_sparse_attributes(publications_df)
+    # The tables are created from the first file with publications stored in the database, whatever its position in the run
+    if len(publications_df) > 0 and not table_exists('publications'):
+        create_dynamic_tables(publications_df,authors_df)
+        # pdb.set_trace()
+    if len(texts_df) > 0:
+        texts_df = compress_texts(texts_df)
+    
+    if file_record is not None:
+        start_file_load(file_record)
+    with begin_transaction() as conn:
+        if len(publications_df) > 0:
+            # The latest version of a publication wins, its previously stored authors, links, citations and attributes are replaced
+            authors_df, author_affiliations_df, publication_authors_df, citations_df, attributes_df, texts_df = replace_publications(publications_df, authors_df, author_affiliations_df, publication_authors_df, citations_df, attributes_df, texts_df, conn)
+            store_in_SQL('publications',publications_df,conn)
+            store_in_SQL('authors',authors_df,conn)
+            store_in_SQL('affiliations',affiliations_df,conn)
+            store_in_SQL('author_affiliations',author_affiliations_df,conn)
+            store_in_SQL('publication_authors',publication_authors_df,conn)
+            store_in_SQL('citations',citations_df,conn)
+            if len(attributes_df) > 0:
+                store_in_SQL('publication_attributes',attributes_df,conn)
+            if len(texts_df) > 0:
+                store_in_SQL('publication_texts',texts_df,conn)
+        if len(deleted_PMIDs) > 0:
+            print(f'Deleted citations: {delete_publications(deleted_PMIDs, conn)} of {len(deleted_PMIDs)}')
+        store_label_cache(label_sections, conn)
+        if file_record is not None:
+            finish_file_load(file_record['file_name'], conn)
+
+def get_file_record(file):
+    """
+    Returns the manifest record identifying a file: its name, size and MD5 checksum.
+    
+    Parameters:
+    - file (str): The XML file name.
+    
+    Returns:
+    - Dictionary with the file_name, size and checksum of the file.
+    """
+    return {'file_name': file, 'size': get_XML_size(file), 'checksum': get_XML_checksum(file)}
+
+def is_file_loaded(file_record, ingested_files):
+    """
+    Checks if a file was already loaded and has not changed since.
+    
+    Parameters:
+    - file_record (dict): Record of the file returned by get_file_record.
+    - ingested_files (dict): The ingested_files manifest (see get_ingested_files).
+    
+    Returns:
+    - True if the manifest has the file as 'loaded' with the same size and checksum.
+    """
+    loaded = ingested_files.get(file_record['file_name'])
+    return loaded is not None and loaded['status'] == 'loaded' and loaded['size'] == file_record['size'] and loaded['checksum'] == file_record['checksum']
+
+def print_label_stats(label_stats, unknown_labels):
+    """
+    Prints how the abstract labels of a file were resolved, including the most common labels that needed the classifier.
+    
+    Parameters:
+    - label_stats (Counter): Labels resolved per method ('nlm_category', 'dictionary', 'classifier').
+    - unknown_labels (Counter): Unknown labels sent to the classifier.
+    """
+    print(f"Abstract labels: {label_stats['nlm_category']} by NlmCategory, {label_stats['dictionary']} by dictionary, {label_stats['classifier']} by classifier")
+    if len(unknown_labels) > 0:
+        print(f'Unknown abstract labels: {unknown_labels.most_common(10)}')
+
+def init_worker(xml_path, db_path, label_classifier, classifier_backend, onnx_model_path, xml_backend='etree'):
+    """
+    Initializes a worker process of the parsing pool.
+    
+    Parameters:
+    - xml_path (str): Path to the pubmed XML files.
+    - db_path (str): Path of the SQLite database (workers only use it for the label cache).
+    - label_classifier (str): How abstract labels are classified ('model' or 'none').
+    - classifier_backend (str): Inference backend of the label classifier ('torch', 'int8' or 'onnx').
+    - onnx_model_path (str): Directory of an exported ONNX model, or None.
+    - xml_backend (str): XML parser backend ('lxml' or 'etree').
+    """
+    set_XML_path(xml_path)
+    set_XML_backend(xml_backend)
+    set_label_classifier(label_classifier)
+    set_classifier_backend(classifier_backend, onnx_model_path)
+    # Connections inherited from the parent process must not be reused in the worker
+    dispose_engine()
+    set_db_path(db_path)
+
+def parse_file(task):
+    """
+    Parses a single XML file in a worker process. IDs are numbered from 0 with an empty affiliation
+    dictionary, the writer moves them to their final values (see shift_IDs). Workers only read the label cache,
+    the labels they classify are returned to be persisted by the writer.
+    
+    Parameters:
+    - task (tuple): The XML file name, the streaming and verify_md5 options and the checksum of the file (reused by verify_md5).
+    
+    Returns:
+    - Tuple containing the file name, the DataFrames for publications, authors, affiliations, author-affiliation links, citations and publication-author links,
+      the number of author IDs used by the file, the PMIDs to delete, the elapsed time in seconds, the label statistics and the newly classified labels.
+    """
+    file, streaming, verify_md5, checksum = task
+    start_time = time.time()
+    publications_df, authors_df, affiliations_df, author_affiliations_df, citations_df, publication_authors_df, num_authors, _, deleted_PMIDs = process_XML(file,0,0,streaming=streaming,verify_md5=verify_md5,checksum=checksum)
+    return file, publications_df, authors_df, affiliations_df, author_affiliations_df, citations_df, publication_authors_df, num_authors, deleted_PMIDs, time.time() - start_time, pop_label_stats(), pop_label_sections()
+
+def process_files_in_parallel(xml_path, db_path, file_records, workers, AuthorIDCounter, AffiliationIDCounter, affiliation_ids, streaming=False, verify_md5=False, label_classifier='model', classifier_backend='torch', onnx_model_path=None, xml_backend='etree'):
+    """
+    Parses XML files in a pool of worker processes and stores the results from a single writer (this process).
+    
+    Results are consumed in file order and the IDs of each file are shifted by the running counters,
+    so the database is identical to the one produced by processing the files one after another.
+    At most files_in_flight_per_worker * workers files are parsed or waiting to be stored at a time, so memory
+    does not grow with the number of files when the writer is slower than the workers.
+    
+    Parameters:
+    - xml_path (str): Path to the pubmed XML files.
+    - db_path (str): Path of the SQLite database.
+    - file_records (list): Manifest records of the XML files to be processed (see get_file_record), in order.
+    - workers (int): Number of worker processes used for parsing.
+    - AuthorIDCounter (int): A global counter for assigning unique IDs to authors.
+    - AffiliationIDCounter (int): A global counter for assigning unique IDs to affiliations.
+    - affiliation_ids (dict): Global affiliation text -> Affiliation_ID dictionary, only used by the writer.
+    - streaming (bool): If True, the XML files are streamed article by article instead of loaded whole.
+    - verify_md5 (bool): If True, the XML files are checked against their NLM '.md5' sidecar files before processing.
+    - label_classifier (str): How abstract labels are classified in the workers ('model' or 'none').
+    - classifier_backend (str): Inference backend of the label classifier in the workers ('torch', 'int8' or 'onnx').
+    - onnx_model_path (str): Directory of an exported ONNX model, or None.
+    - xml_backend (str): XML parser backend of the workers ('lxml' or 'etree').
+    
+    Returns:
+    - AuthorIDCounter (int): Updated author ID counter.
+    - AffiliationIDCounter (int): Updated affiliation ID counter.
+    """
+    tasks = [(file_record['file_name'], streaming, verify_md5, file_record['checksum']) for file_record in file_records]
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(xml_path, db_path, label_classifier, classifier_backend, onnx_model_path, xml_backend)) as pool:
+        # Files are submitted in order and their results consumed in the same order, which keeps the ID assignment
+        # deterministic. A new file is only submitted once the oldest one has been taken by the writer
+        pending_tasks = iter(tasks)
+        in_flight = deque(pool.apply_async(parse_file, (task,)) for task in itertools.islice(pending_tasks, files_in_flight_per_worker * workers))
+        for count, file_record in enumerate(file_records):
+            result = in_flight.popleft().get()
+            for task in itertools.islice(pending_tasks, 1):
+                in_flight.append(pool.apply_async(parse_file, (task,)))
+            each_XML_file, publications_df, authors_df, affiliations_df, author_affiliations_df, citations_df, publication_authors_df, num_authors, deleted_PMIDs, parse_time, label_stats, label_sections = result
+            print(count)
+            print(each_XML_file)
+            print(f'AuthorIDCounter: {AuthorIDCounter}, AffiliationIDCounter: {AffiliationIDCounter}')
+            print_label_stats(*label_stats)
+            start_time = time.time()
+            first_author_id, first_affiliation_id = AuthorIDCounter + 1, AffiliationIDCounter + 1
+            authors_df, affiliations_df, author_affiliations_df, publication_authors_df, AffiliationIDCounter = shift_IDs(authors_df, affiliations_df, author_affiliations_df, publication_authors_df, AuthorIDCounter, affiliation_ids, AffiliationIDCounter)
+            AuthorIDCounter += num_authors
+            file_record.update(articles=len(publications_df), deleted_citations=len(deleted_PMIDs),
+                               first_author_id=first_author_id, last_author_id=AuthorIDCounter,
+                               first_affiliation_id=first_affiliation_id, last_affiliation_id=AffiliationIDCounter)
+            store_file(publications_df, authors_df, affiliations_df, author_affiliations_df, citations_df, publication_authors_df, file_record, deleted_PMIDs, label_sections)
+            print(f'Parse time: {parse_time / 60:.2f} minutes, store time: {(time.time() - start_time) / 60:.2f} minutes')
+    return AuthorIDCounter, AffiliationIDCounter
+
 if __name__ == "__main__":
     #PATH FOR DEBUG: '/storage/geneGinie/ncbi_ftp_data/pubmed/XML'
     parser = argparse.ArgumentParser(description="Pubmed XML parser. Generates a sqlite database from XML pubmed files")
     parser.add_argument('xml_path', type=str, help='Path to pubmed XML files')
+    parser.add_argument('--db', type=str, default='PubMed_june_2024.db', help='Path of the SQLite database to generate')
+    parser.add_argument('--bulk-load', action='store_true', help='Bulk load profile: tuned SQLite PRAGMAs (no fsync, large cache, mmap) and secondary indexes created at the end. Meant for initial loads')
+    parser.add_argument('--journal-mode', choices=['WAL', 'OFF'], default='WAL', help='SQLite journal mode used by --bulk-load')
+    parser.add_argument('--xml-backend', choices=['etree', 'lxml'], default='etree', help='XML parser backend. lxml is faster, xml.etree.ElementTree is used if lxml is not installed. Both give the same output')
+    parser.add_argument('--typed-schema', action='store_true', help='Store PMIDs, dates (YYYYMMDD), counts and flags as integers. Only used when the database is created, existing databases keep their schema')
+    parser.add_argument('--sparse-attributes', action='store_true', help='Store the History_*, ArticleId_* and Abstract_* keys in a (pmid, attr, value) side table, with a fixed set of publications columns. Only used when the database is created, existing databases keep their schema')
+    parser.add_argument('--compress-text', choices=['zlib', 'zstd'], default=None, help='Store the abstracts, OtherAbtract and CoiStatement compressed in a separate blob table, with zlib or zstd with a trained dictionary. Only used when the database is created, existing databases keep their schema')
+    parser.add_argument('--streaming', action='store_true', help='Stream articles with iterparse instead of loading each XML tree in memory')
+    parser.add_argument('--verify-md5', action='store_true', help="Check each XML file against NLM's .md5 sidecar file before processing it")
+    parser.add_argument('--label-classifier', choices=['model', 'none'], default='model', help="Classify abstract section labels with the zero-shot model, or 'none' to skip section labelling without loading torch")
+    parser.add_argument('--classifier-backend', choices=['torch', 'int8', 'onnx'], default='torch', help='Inference backend of the label classifier: full precision torch, dynamically quantized int8 or ONNX Runtime')
+    parser.add_argument('--onnx-model', type=str, default=None, help='Directory of an exported ONNX model for --classifier-backend onnx (exported on load if not given)')
+    parser.add_argument('--duplicates', choices=['update', 'ignore'], default='update', help="How a publication already in the database is handled: 'update' so the latest PMIDVersion wins, or 'ignore' to keep the stored one")
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used to parse XML files. Storing is always done by a single writer')
     args = parser.parse_args()
 
     set_XML_path(args.xml_path)
-    #Data Id Global Trackers (for Authors and Affiliations) Incremented when a new author or affiliation is added
-    AuthorIDCounter = 0
-    AffiliationIDCounter = 0
+    xml_backend = set_XML_backend(args.xml_backend)
+    set_db_path(args.db, bulk=args.bulk_load, journal_mode=args.journal_mode)
+    set_conflict_mode('publications', args.duplicates)
+    # An existing database keeps the schema mode it was created with
+    typed_schema = get_typed_schema()
+    if typed_schema is None:
+        typed_schema = args.typed_schema
+    elif typed_schema != args.typed_schema:
+        print(f"The database was created {'with' if typed_schema else 'without'} --typed-schema, keeping its schema")
+    set_typed_schema(typed_schema)
+    sparse_attributes = get_sparse_attributes()
+    if sparse_attributes is None:
+        sparse_attributes = args.sparse_attributes
+    elif sparse_attributes != args.sparse_attributes:
+        print(f"The database was created {'with' if sparse_attributes else 'without'} --sparse-attributes, keeping its schema")
+    set_sparse_attributes(sparse_attributes)
+    text_compression = get_text_compression()
+    if text_compression is None:
+        text_compression = args.compress_text
+    elif text_compression is False:
+        if args.compress_text is not None:
+            print('The database was created without --compress-text, keeping its schema')
+        text_compression = None
+    elif args.compress_text is not None and args.compress_text != text_compression:
+        print(f'The database was created with --compress-text {text_compression}, keeping its codec')
+    text_compression = set_text_compression(text_compression)
+    set_label_classifier(args.label_classifier)
+    set_classifier_backend(args.classifier_backend, args.onnx_model)
 
-    # Filter only the XML files
-    xml_files = list_XML_files()
+    # Files whose load was interrupted are rolled back, they are loaded again below
+    create_manifest_table()
+    # The label cache is only read by the worker processes, the writer stores the labels they classify
+    create_label_cache_table()
+    # Databases created before the citations and publication_authors tables get them too (deletions can come before any publication is stored)
+    create_citations_table()
+    create_publication_authors_table()
+    if sparse_attributes:
+        create_publication_attributes_table()
+    if text_compression:
+        create_publication_texts_table()
+    # The publications and authors tables are created from the first file with publications (see store_file),
+    # the rest of the set up is done here so existing databases get it whatever the files of this run hold
+    create_affiliation_tables()
+    drop_database_triggers()
+    if args.bulk_load:
+        drop_secondary_indexes()
+    else:
+        # Indexes left dropped by an interrupted bulk load are created again
+        create_secondary_indexes()
+    for file_record in get_ingested_files().values():
+        if file_record['status'] != 'loaded':
+            print(f"Rolling back the interrupted load of {file_record['file_name']}")
+            rollback_file_load(file_record)
+    ingested_files = get_ingested_files()
+
+    #Data Id Global Trackers (for Authors and Affiliations) Incremented when a new author or affiliation is added. They continue from the IDs already in the database
+    AuthorIDCounter, AffiliationIDCounter = get_ID_counters()
+    #Affiliation dictionary (affiliation text -> Affiliation_ID) so each distinct affiliation is stored once
+    affiliation_ids = load_affiliation_ids()
+
+    # Filter only the XML files (plain or gzipped), sorted so IDs are assigned in a deterministic order
+    xml_files = sorted(list_XML_files())
+    # Files already loaded and unchanged (same size and checksum) are skipped
+    file_records = []
+    for each_XML_file in xml_files:
+        file_record = get_file_record(each_XML_file)
+        if is_file_loaded(file_record, ingested_files):
+            print(f'{each_XML_file} already loaded, skipping')
+        else:
+            file_records.append(file_record)
 
     count = 0
     #  ['pubmed23n0001.xml','pubmed23n0189.xml']
-    for each_XML_file in xml_files[:5]:
-        print(count)
-        print(each_XML_file)
-        print(f'AuthorIDCounter: {AuthorIDCounter}, AffiliationIDCounter: {AffiliationIDCounter}')
-        AuthorIDCounter, AffiliationIDCounter = process_file(each_XML_file,count,AuthorIDCounter,AffiliationIDCounter)
-        count = count + 1
\ No newline at end of file
+    if args.workers > 1:
+        AuthorIDCounter, AffiliationIDCounter = process_files_in_parallel(args.xml_path,args.db,file_records,args.workers,AuthorIDCounter,AffiliationIDCounter,affiliation_ids,streaming=args.streaming,verify_md5=args.verify_md5,label_classifier=args.label_classifier,classifier_backend=args.classifier_backend,onnx_model_path=args.onnx_model,xml_backend=xml_backend)
+    else:
+        for file_record in file_records:
+            each_XML_file = file_record['file_name']
+            print(count)
+            print(each_XML_file)
+            print(f'AuthorIDCounter: {AuthorIDCounter}, AffiliationIDCounter: {AffiliationIDCounter}')
+            AuthorIDCounter, AffiliationIDCounter = process_file(each_XML_file,AuthorIDCounter,AffiliationIDCounter,affiliation_ids,streaming=args.streaming,verify_md5=args.verify_md5,file_record=file_record)
+            count = count + 1
+
+    if args.bulk_load:
+        # Secondary indexes were not maintained during the load, build them in one pass
+        create_secondary_indexes()
@@ -0,0 +1,310 @@
+from collections import OrderedDict, Counter # Importing for the LRU label cache and label statistics
+import re # Importing for label normalization
+
+from models.database import load_label_cache
+
+# Classification pipelines from Hugging Face Transformers per backend, loaded on first use (see get_classifier)
+classifiers = {}
+classifier_model = "facebook/bart-large-mnli"
+
+# Inference backend of the classifier: 'torch' (full precision), 'int8' (dynamically quantized torch model)
+# or 'onnx' (ONNX Runtime session, requires optimum[onnxruntime])
+classifier_backends = ('torch', 'int8', 'onnx')
+classifier_backend = 'torch'
+# Optional directory with an already exported ONNX model, otherwise the model is exported when loaded
+onnx_model_path = None
+
+# 'model' classifies abstract labels with the zero-shot model, 'none' skips section labelling
+label_classifier = 'model'
+
+# Sections abstract labels are classified into
+candidate_labels = ['Introduction','Purpose','Conclusion','Results','Methods','UNLABELLED']
+
+# NLM structured abstract categories (NlmCategory attribute of AbstractText) -> section.
+# 'UNASSIGNED' is left out on purpose, those labels are resolved from the label text.
+nlm_category_sections = {
+    'BACKGROUND': 'Introduction',
+    'OBJECTIVE': 'Purpose',
+    'METHODS': 'Methods',
+    'RESULTS': 'Results',
+    'CONCLUSIONS': 'Conclusion',
+}
+
+# Normalized label (see normalize_label) -> section, following NLM's structured abstract label mapping
+label_dictionary_sections = {
+    'Introduction': ['BACKGROUND', 'BACKGROUNDS', 'INTRODUCTION', 'CONTEXT', 'RATIONALE', 'BACKGROUND AND AIMS',
+                     'BACKGROUND AND AIM', 'BACKGROUND AND OBJECTIVES', 'BACKGROUND AND OBJECTIVE', 'BACKGROUND AND PURPOSE',
+                     'BACKGROUND AND CONTEXT', 'INTRODUCTION AND OBJECTIVES', 'INTRODUCTION AND AIMS', 'STUDY BACKGROUND'],
+    'Purpose': ['OBJECTIVE', 'OBJECTIVES', 'AIM', 'AIMS', 'PURPOSE', 'PURPOSES', 'GOAL', 'GOALS', 'AIM OF THE STUDY',
+                'AIMS OF THE STUDY', 'PURPOSE OF THE STUDY', 'PURPOSE OF REVIEW', 'STUDY OBJECTIVE', 'STUDY OBJECTIVES',
+                'STUDY AIM', 'STUDY AIMS', 'OBJECTIVE AND METHODS', 'AIMS AND OBJECTIVES', 'HYPOTHESIS', 'QUESTION'],
+    'Methods': ['METHODS', 'METHOD', 'MATERIALS AND METHODS', 'MATERIAL AND METHODS', 'METHODS AND MATERIALS',
+                'METHODOLOGY', 'DESIGN', 'STUDY DESIGN', 'DESIGN AND METHODS', 'DESIGN AND SETTING', 'SETTING', 'SETTINGS',
+                'PARTICIPANTS', 'PATIENTS', 'PATIENTS AND METHODS', 'SUBJECTS', 'SUBJECTS AND METHODS', 'INTERVENTION',
+                'INTERVENTIONS', 'MEASUREMENTS', 'MAIN OUTCOME MEASURES', 'MAIN OUTCOMES AND MEASURES',
+                'DESIGN SETTING AND PARTICIPANTS', 'DESIGN SETTING PARTICIPANTS', 'EXPERIMENTAL DESIGN', 'APPROACH',
+                'SEARCH METHODS', 'SEARCH STRATEGY', 'SELECTION CRITERIA', 'DATA COLLECTION AND ANALYSIS', 'DATA SOURCES',
+                'STUDY SELECTION', 'DATA EXTRACTION', 'DATA SYNTHESIS', 'EXPOSURE', 'EXPOSURES', 'METHODS AND RESULTS'],
+    'Results': ['RESULTS', 'RESULT', 'FINDINGS', 'FINDING', 'MAIN RESULTS', 'KEY RESULTS', 'PRINCIPAL FINDINGS',
+                'KEY FINDINGS', 'MAIN FINDINGS', 'OUTCOMES', 'MEASUREMENTS AND MAIN RESULTS', 'RESULTS AND DISCUSSION'],
+    'Conclusion': ['CONCLUSION', 'CONCLUSIONS', 'CONCLUSIONS AND RELEVANCE', 'CONCLUSION AND RELEVANCE',
+                   'CONCLUSIONS AND IMPLICATIONS', 'CONCLUSION AND IMPLICATIONS', 'AUTHORS CONCLUSIONS', 'INTERPRETATION',
+                   'DISCUSSION', 'DISCUSSION AND CONCLUSION', 'DISCUSSION AND CONCLUSIONS', 'SUMMARY', 'IMPLICATIONS',
+                   'CLINICAL RELEVANCE', 'CLINICAL SIGNIFICANCE', 'SIGNIFICANCE', 'PRACTICAL IMPLICATIONS',
+                   'CONCLUSIONS AND CLINICAL RELEVANCE', 'SUMMARY AND CONCLUSIONS'],
+    'UNLABELLED': ['UNLABELLED', 'UNLABELED', 'ABSTRACT'],
+}
+label_dictionary = {label: section for section, labels in label_dictionary_sections.items() for label in labels}
+
+# How many AbstractText labels were resolved by each method, and the labels that needed the classifier
+label_stats = Counter()
+unknown_labels = Counter()
+
+# In memory label -> section cache, kept in least recently used order
+label_cache = OrderedDict()
+label_cache_size = 10000
+label_cache_loaded = False
+# Labels classified since the last pop_label_sections call, persisted by the writer with the file they come from
+new_label_sections = []
+
+# Number of labels sent together to the classifier
+label_batch_size = 16
+
+
+def set_label_classifier(mode):
+    """
+    Sets how abstract labels are classified into sections.
+
+    Parameters:
+    - mode (str): 'model' to classify labels with the zero-shot model, 'none' to skip section labelling.
+      With 'none' torch and transformers are never imported.
+    """
+    global label_classifier
+    if mode not in ('model', 'none'):
+        raise ValueError(f"Unsupported label classifier: {mode}")
+    label_classifier = mode
+
+def set_classifier_backend(backend, model_path=None):
+    """
+    Sets the inference backend used by the zero-shot classifier.
+
+    Parameters:
+    - backend (str): 'torch' for the full precision model, 'int8' for a dynamically quantized model
+      or 'onnx' for an ONNX Runtime session.
+    - model_path (str): Optional. Directory of an already exported ONNX model (only used by the 'onnx' backend).
+    """
+    global classifier_backend, onnx_model_path
+    if backend not in classifier_backends:
+        raise ValueError(f"Unsupported classifier backend: {backend}")
+    classifier_backend = backend
+    onnx_model_path = model_path
+
+def load_classifier(backend):
+    """
+    Loads the zero-shot classification pipeline for a backend. torch, transformers and onnxruntime are imported here only.
+
+    Parameters:
+    - backend (str): 'torch', 'int8' or 'onnx'.
+
+    Returns:
+    - A Hugging Face zero-shot classification pipeline.
+    """
+    from transformers import pipeline # Importing from Hugging Face's Transformers for NLP tasks
+    if backend == 'torch':
+        return pipeline("zero-shot-classification", model=classifier_model)
+
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(classifier_model)
+    if backend == 'int8':
+        import torch
+        from transformers import AutoModelForSequenceClassification
+        model = AutoModelForSequenceClassification.from_pretrained(classifier_model)
+        # Linear layers hold most of the weights and compute, their weights are stored in int8
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif backend == 'onnx':
+        from optimum.onnxruntime import ORTModelForSequenceClassification
+        if onnx_model_path is not None:
+            model = ORTModelForSequenceClassification.from_pretrained(onnx_model_path)
+        else:
+            model = ORTModelForSequenceClassification.from_pretrained(classifier_model, export=True)
+    else:
+        raise ValueError(f"Unsupported classifier backend: {backend}")
+    return pipeline("zero-shot-classification", model=model, tokenizer=tokenizer)
+
+def get_classifier(backend=None):
+    """
+    Returns the zero-shot classification pipeline, loading the model on first use.
+
+    Parameters:
+    - backend (str): Optional. The backend to use, defaults to the one set with set_classifier_backend.
+
+    Returns:
+    - The Hugging Face zero-shot classification pipeline.
+    """
+    backend = backend or classifier_backend
+    if backend not in classifiers:
+        classifiers[backend] = load_classifier(backend)
+    return classifiers[backend]
+
+def set_label_cache_size(new_size):
+    """
+    Sets the maximum number of labels kept in the in memory cache.
+
+    Parameters:
+    - new_size (int): The new maximum number of cached labels.
+    """
+    global label_cache_size
+    label_cache_size = new_size
+    while len(label_cache) > label_cache_size:
+        label_cache.popitem(last=False)
+
+def cache_label(label, section):
+    """
+    Adds a label to the in memory cache, evicting the least recently used labels past label_cache_size.
+
+    Parameters:
+    - label (str): The abstract label.
+    - section (str): The section the label was classified into.
+    """
+    label_cache[label] = section
+    label_cache.move_to_end(label)
+    while len(label_cache) > label_cache_size:
+        label_cache.popitem(last=False)
+
+def warm_label_cache():
+    """
+    Loads the labels classified in previous runs from the database into the in memory cache (only once per process).
+    Only reads the database, the abstract_label_cache table is created by the main process (see create_label_cache_table).
+    """
+    global label_cache_loaded
+    if label_cache_loaded:
+        return
+    for label, section in load_label_cache(limit=label_cache_size):
+        cache_label(label, section)
+    label_cache_loaded = True
+
+def normalize_label(label):
+    """
+    Normalizes an abstract label for the dictionary lookup: upper case, '&' as 'AND', no punctuation or extra spaces.
+
+    Parameters:
+    - label (str): The abstract label, e.g. 'Materials & methods:'.
+
+    Returns:
+    - The normalized label, e.g. 'MATERIALS AND METHODS'.
+    """
+    label = label.upper().replace('&', ' AND ')
+    label = re.sub(r'[^\w\s]', ' ', label)
+    return ' '.join(label.split())
+
+def map_label(label, nlm_category=None):
+    """
+    Resolves an abstract label to its section without the classifier, using the NlmCategory attribute first
+    and the normalized label dictionary second.
+
+    Parameters:
+    - label (str): The abstract label.
+    - nlm_category (str): Optional. The NlmCategory attribute of the AbstractText.
+
+    Returns:
+    - A tuple with the section (one of candidate_labels) and the method used ('nlm_category' or 'dictionary'),
+      or (None, None) if the label is unknown.
+    """
+    if nlm_category in nlm_category_sections:
+        return nlm_category_sections[nlm_category], 'nlm_category'
+    section = label_dictionary.get(normalize_label(label))
+    if section is not None:
+        return section, 'dictionary'
+    return None, None
+
+def resolve_labels(labels):
+    """
+    Resolves abstract labels to sections. Known labels are mapped deterministically (see map_label) and only
+    the truly unknown ones are sent to the classifier (see classify_labels). Counts are kept in label_stats.
+
+    Parameters:
+    - labels (list): (label, nlm_category) tuples, one per labelled AbstractText.
+
+    Returns:
+    - Dictionary mapping each (label, nlm_category) tuple to its section.
+    """
+    sections = {}
+    methods = {}
+    for key in labels:
+        if key not in methods:
+            section, method = map_label(*key)
+            methods[key] = method or 'classifier'
+            if section is not None:
+                sections[key] = section
+        label_stats[methods[key]] += 1
+        if methods[key] == 'classifier':
+            unknown_labels[key[0]] += 1
+
+    # Only the labels that could not be mapped go to the (cached, batched) classifier
+    unknown = [key for key, method in methods.items() if method == 'classifier']
+    if len(unknown) > 0:
+        classified = classify_labels([label for label, _ in unknown])
+        for key in unknown:
+            sections[key] = classified[key[0]]
+    return sections
+
+def pop_label_stats():
+    """
+    Returns the label resolution counts gathered since the last call and resets them.
+
+    Returns:
+    - A tuple with a Counter of labels resolved per method ('nlm_category', 'dictionary', 'classifier')
+      and a Counter of the unknown labels sent to the classifier.
+    """
+    stats = (label_stats.copy(), unknown_labels.copy())
+    label_stats.clear()
+    unknown_labels.clear()
+    return stats
+
+def pop_label_sections():
+    """
+    Returns the labels classified since the last call and resets them. They are persisted by the process storing the
+    file (see store_label_cache), so worker processes never write to the database.
+
+    Returns:
+    - A list of (label, section) tuples.
+    """
+    label_sections = list(new_label_sections)
+    new_label_sections.clear()
+    return label_sections
+
+def classify_labels(labels):
+    """
+    Classifies abstract labels into sections.
+
+    Labels are looked up in the cache first; all the misses are sent to the classifier in a single
+    batched call and the results are added to the cache and to the labels to persist (see pop_label_sections).
+
+    Parameters:
+    - labels (iterable): The abstract labels to classify.
+
+    Returns:
+    - Dictionary mapping each label to its section (one of candidate_labels).
+    """
+    warm_label_cache()
+    sections = {}
+    misses = []
+    for label in set(labels):
+        if label in label_cache:
+            label_cache.move_to_end(label)
+            sections[label] = label_cache[label]
+        else:
+            misses.append(label)
+
+    if len(misses) > 0:
+        results = get_classifier()(misses, candidate_labels=candidate_labels, batch_size=label_batch_size)
+        # A single sequence returns a single result instead of a list
+        if isinstance(results, dict):
+            results = [results]
+        new_sections = [(label, result['labels'][0]) for label, result in zip(misses, results)]
+        for label, section in new_sections:
+            sections[label] = section
+            cache_label(label, section)
+        new_label_sections.extend(new_sections)
+
+    return sections
@@ -1,13 +1,27 @@
 import xml.etree.ElementTree as ET # Importing for XML parsing
 import os # Importing for interacting with the file system
+import gzip # Importing for reading compressed XML files
+import hashlib # Importing for checksum verification
+import re # Importing for regular expressions
+import itertools # Importing to chain the article and deletion elements
+from xml.sax.saxutils import escape # Importing to escape article titles without serializing them
 import pandas as pd # Importing pandas for data manipulation
 import pdb # Import Python debugger
-from transformers import pipeline # Importing from Hugging Face's Transformers for NLP tasks
+from models.records import ColumnarTable # Columnar accumulators for the parsed records
+from services.LabelServices import resolve_labels, set_label_classifier, set_classifier_backend # Abstract label classification (cached and batched)
+import services.LabelServices as LabelServices
 
 # XML_path = '/storage/geneGinie/ncbi_ftp_data/pubmed/XML' 
 
-# Initialize the classification pipeline from Hugging Face Transformers
-classify = pipeline("zero-shot-classification", model="facebook/bart-large-mnli")
+# XML parser backend: 'etree' (xml.etree.ElementTree, always available) or 'lxml'
+XML_backends = ['etree', 'lxml']
+XML_backend = 'etree'
+# lxml.etree module, imported by set_XML_backend('lxml') only
+lxml_etree = None
+# Characters escaped in attribute values by XML_inner_string, besides &, < and > (as ElementTree does)
+attribute_entities = {'"': '&quot;', '\r': '&#13;', '\n': '&#10;', '\t': '&#09;'}
+# Compiled lxml XPath objects of the paths used by find_all (path -> XPath)
+compiled_paths = {}
 
 
 def set_XML_path(new_path):
@@ -20,21 +34,185 @@ def set_XML_path(new_path):
     global XML_path
     XML_path = new_path
 
+def set_XML_backend(backend):
+    """
+    Sets the XML parser backend. Both backends produce the same output (nested markup is serialized by
+    XML_inner_string, not by the backend).
+    
+    Parameters:
+    - backend (str): 'lxml' to parse with lxml (C-level iterparse filtered by tag, compiled XPath and huge_tree
+      support) or 'etree' for xml.etree.ElementTree. If lxml is not installed, ElementTree is used instead.
+    
+    Returns:
+    - The backend in use.
+    """
+    global XML_backend, lxml_etree
+    if backend not in XML_backends:
+        raise ValueError(f"Unsupported XML backend: {backend}")
+    if backend == 'lxml' and lxml_etree is None:
+        try:
+            from lxml import etree # Importing lxml only when it is used
+            lxml_etree = etree
+        except ImportError:
+            print('lxml is not installed, falling back to xml.etree.ElementTree')
+            backend = 'etree'
+    XML_backend = backend
+    compiled_paths.clear()
+    return XML_backend
+
+def find_all(element, path):
+    """
+    Returns the elements matching a path, with a compiled XPath object when the lxml backend is used.
+    
+    Parameters:
+    - element (Element): The element the path is relative to.
+    - path (str): ElementPath expression that is also valid XPath (e.g. 'ArticleId' or './AffiliationInfo/Affiliation').
+    
+    Returns:
+    - List of matching elements, in document order.
+    """
+    if XML_backend == 'lxml':
+        xpath = compiled_paths.get(path)
+        if xpath is None:
+            xpath = compiled_paths[path] = lxml_etree.XPath(path)
+        return xpath(element)
+    return element.findall(path)
+
+def child_elements(element):
+    """
+    Returns the children of an element by tag, so several children are looked up with a single pass
+    over the element instead of one find per tag (each find costs a path evaluation, especially with lxml).
+    
+    Parameters:
+    - element (Element): The parent element.
+    
+    Returns:
+    - Dictionary tag -> first child with that tag, like element.find(tag).
+    """
+    children = {}
+    for child in element:
+        if child.tag not in children:
+            children[child.tag] = child
+    return children
+
+def local_name(name):
+    """
+    Returns a tag or attribute name without its namespace ('{http://www.w3.org/1998/Math/MathML}mi' -> 'mi').
+    """
+    return name.rsplit('}', 1)[-1]
+
+def XML_inner_string(element):
+    """
+    Serializes the content of an element (its text and nested tags, without the element's own tags and tail) the way
+    ElementTree does, with either backend. Namespaces are dropped: namespaced tags such as MathML are written with their
+    local name and without declarations, which ElementTree and lxml would otherwise write with different prefixes.
+    
+    Parameters:
+    - element (Element): The element whose content is serialized.
+    
+    Returns:
+    - The XML text of the content of the element.
+    """
+    parts = []
+    if element.text:
+        parts.append(escape(element.text))
+    for child in element:
+        # Comments and processing instructions are dropped by both parsers, lxml ones are skipped in case they are kept
+        if isinstance(child.tag, str):
+            tag = local_name(child.tag)
+            attributes = ''.join(f' {local_name(name)}="{escape(value, attribute_entities)}"' for name, value in child.attrib.items())
+            if child.text or len(child) > 0:
+                parts.append(f'<{tag}{attributes}>{XML_inner_string(child)}</{tag}>')
+            else:
+                parts.append(f'<{tag}{attributes} />')
+        if child.tail:
+            parts.append(escape(child.tail))
+    return ''.join(parts)
+
 def list_XML_files():
     """
     Lists all XML files in the specified directory set by XML_path.
     
     Returns:
-    - List of filenames that end with '.xml'
+    - List of filenames that end with '.xml' or '.xml.gz'
     """
     all_files = os.listdir(XML_path)
-    xml_files = [file for file in all_files if file.endswith('.xml')]
+    xml_files = [file for file in all_files if file.endswith(('.xml', '.xml.gz'))]
     return xml_files
 
+def open_XML(file):
+    """
+    Opens an XML file in binary mode, decompressing it on the fly if it is gzipped.
+    
+    Parameters:
+    - file (str): Filename of the XML file, either '.xml' or '.xml.gz'.
+    
+    Returns:
+    - A binary file object that can be fed directly to the XML parser.
+    """
+    if file.endswith('.gz'):
+        return gzip.open(f'{XML_path}/{file}', 'rb')
+    return open(f'{XML_path}/{file}', 'rb')
+
+def get_XML_checksum(file):
+    """
+    Computes the MD5 checksum of an XML file as stored on disk (compressed bytes for '.gz' files).
+    
+    Parameters:
+    - file (str): Filename of the XML file.
+    
+    Returns:
+    - The hexadecimal MD5 checksum.
+    """
+    md5 = hashlib.md5()
+    with open(f'{XML_path}/{file}', 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def get_XML_size(file):
+    """
+    Returns the size in bytes of an XML file as stored on disk.
+    """
+    return os.path.getsize(f'{XML_path}/{file}')
+
+def verify_XML_checksum(file, checksum=None):
+    """
+    Verifies an XML file against the '.md5' sidecar file distributed by NLM (e.g. 'pubmed24n0001.xml.gz.md5').
+    
+    Parameters:
+    - file (str): Filename of the XML file to verify.
+    - checksum (str): Optional. MD5 checksum of the file already computed (see get_XML_checksum), so it is not hashed again.
+    
+    Returns:
+    - True if the checksum matches, False if there is no sidecar file to check against.
+    
+    Raises:
+    - ValueError if the checksum does not match.
+    """
+    md5_file = f'{XML_path}/{file}.md5'
+    if not os.path.exists(md5_file):
+        print(f"No MD5 file found for {file}, skipping checksum verification")
+        return False
+
+    # Sidecar format is 'MD5(pubmed24n0001.xml.gz)= <hash>', md5sum's '<hash>  <file>' is accepted too
+    with open(md5_file) as f:
+        match = re.search(r'\b([0-9a-fA-F]{32})\b', f.read())
+    if match is None:
+        raise ValueError(f"Could not read an MD5 checksum from {md5_file}")
+    expected = match.group(1).lower()
+
+    # Hash the file as stored on disk (compressed bytes for '.gz' files)
+    if checksum is None:
+        checksum = get_XML_checksum(file)
+    if checksum != expected:
+        raise ValueError(f"MD5 mismatch for {file}: expected {expected}, got {checksum}")
+    return True
+
 #LOAD
 def load_XML(file='pubmed23n1226.xml'):
     """
-    Loads an XML file and returns its root element.
+    Loads an XML file and returns its root element. Gzipped files are decompressed while parsing.
     
     Parameters:
     - file (str): Filename of the XML file to be loaded.
@@ -43,69 +221,270 @@ def load_XML(file='pubmed23n1226.xml'):
     - The root of the XML tree or None if an error occurs.
     """
     try:
-        tree = ET.parse(f'{XML_path}/{file}')
+        with open_XML(file) as xml_file:
+            if XML_backend == 'lxml':
+                # Comments and processing instructions are dropped like ElementTree does
+                parser = lxml_etree.XMLParser(huge_tree=True, remove_comments=True, remove_pis=True)
+                tree = lxml_etree.parse(xml_file, parser)
+            else:
+                tree = ET.parse(xml_file)
         return tree.getroot()
     except Exception as e:
         print(f"Error loading XML: {e}")
         return None
+
+def iter_XML(file='pubmed23n1226.xml'):
+    """
+    Streams the PubmedArticle (and DeleteCitation) elements of an XML file one at a time using iterparse.
+    
+    Each article is cleared from the root once the caller is done with it, together with any
+    siblings parsed before it, so memory stays flat no matter how big the file is.
+    
+    Parameters:
+    - file (str): Filename of the XML file to be streamed. Gzipped files are decompressed while parsing.
+    
+    Yields:
+    - PubmedArticle and DeleteCitation elements, one at a time.
+    """
+    if XML_backend == 'lxml':
+        yield from iter_XML_lxml(file)
+        return
+    with open_XML(file) as xml_file:
+        context = ET.iterparse(xml_file, events=('start', 'end'))
+        # The first event is the start of the root element (PubmedArticleSet)
+        _, root = next(context)
+        for event, element in context:
+            if event == 'end' and element.tag in ('PubmedArticle', 'DeleteCitation'):
+                yield element
+                # The article has been consumed, drop it and everything before it from the root
+                root.clear()
+    
+def iter_XML_lxml(file):
+    """
+    lxml version of iter_XML. The tag filtering is done by lxml's iterparse, so only the PubmedArticle
+    and DeleteCitation elements reach Python.
+    
+    Parameters:
+    - file (str): Filename of the XML file to be streamed.
+    
+    Yields:
+    - PubmedArticle and DeleteCitation elements, one at a time.
+    """
+    with open_XML(file) as xml_file:
+        context = lxml_etree.iterparse(xml_file, events=('end',), tag=('PubmedArticle', 'DeleteCitation'), huge_tree=True, remove_comments=True, remove_pis=True)
+        for _, element in context:
+            yield element
+            # The article has been consumed, drop it and everything before it from the root
+            element.clear(keep_tail=True)
+            while element.getprevious() is not None:
+                del element.getparent()[0]
     
 #Process
-def process_XML( XML,AuthorIDCounter,AffiliationIDCounter,):
+def process_XML( XML,AuthorIDCounter,AffiliationIDCounter,affiliation_ids=None,streaming=False,verify_md5=False,checksum=None):
     """
     Processes an XML file to extract publications, authors, and affiliations information.
     
     Parameters:
     - XML (str): The path to the XML file.
     - AuthorIDCounter (int): A counter for assigning unique IDs to authors.
-    - AffiliationIDCounter (int): A counter for assigning unique IDs to affiliations.
+    - AffiliationIDCounter (int): A counter for assigning unique IDs to affiliations (the last ID assigned).
+    - affiliation_ids (dict): Affiliation text -> Affiliation_ID of the affiliations already stored. New affiliations
+      found in the file are added to it. If None, an empty dictionary is used.
+    - streaming (bool): If True, articles are streamed with iterparse instead of loading the whole tree in memory.
+    - verify_md5 (bool): If True, the file is checked against its NLM '.md5' sidecar before being processed.
+    - checksum (str): Optional. MD5 checksum of the file already computed (e.g. for the ingested_files manifest), reused by the verification.
     
     Returns:
-    - Tuple containing DataFrames for publications, authors, affiliations, and updated counters.
+    - Tuple containing DataFrames for publications, authors, new affiliations, author-affiliation links, citations
+      (citing_pmid, cited_id, id_type) and publication-author links (pmid, author_id, au_order, is_first, is_last), updated counters, and the list of PMIDs to delete (DeleteCitation element of update files).
     """
 
-    # Initialize lists to hold data
-    publications_list = []
-    affiliations_list = []
-    authors_list = []
+    # Initialize the columnar tables to hold data. Duplicated publications (PMID) and authors (PMID and names) are
+    # merged while appending, records without a key are dropped
+    publications_table = ColumnarTable(key=['PMID'], skip_null_keys=True)
+    affiliations_table = ColumnarTable(columns=['Affiliation_ID','affiliation'])
+    authors_table = ColumnarTable(columns=['PMID','ForeName','LastName','Initials'], key=['PMID','ForeName','LastName','Initials'], skip_null_keys=True)
+    author_affiliations_table = ColumnarTable(columns=['Author_ID','Affiliation_ID'])
+    publication_authors_table = ColumnarTable(columns=['pmid','author_id','au_order','is_first','is_last'])
+    # References repeated in a publication are stored once
+    citations_table = ColumnarTable(columns=['citing_pmid','cited_id','id_type'], key=['citing_pmid','cited_id','id_type'], skip_null_keys=True)
+    deleted_PMIDs = []
+    if affiliation_ids is None:
+        affiliation_ids = {}
+
+    if verify_md5:
+        verify_XML_checksum(XML, checksum)
    
-   # Load the XML and get the root
-    xml_root = load_XML(XML)
-
-    # Initialize empty DataFrames for publications, authors, and affiliations
-    affiliations_df =pd.DataFrame()
+    if streaming:
+        # Stream the articles one at a time, each one is freed after being transformed
+        pubmed_articles = iter_XML(XML)
+    else:
+        # Load the XML and get the root
+        xml_root = load_XML(XML)
+        pubmed_articles = itertools.chain(xml_root.iter('PubmedArticle'), xml_root.iter('DeleteCitation'))
+
+    # Initialize empty DataFrames for publications and authors
     publications_df = pd.DataFrame()
     authors_df = pd.DataFrame()
     
     # Loop through each publication in the XML file
-    for pubmed_article in xml_root.iter('PubmedArticle'):
+    for pubmed_article in pubmed_articles:
+        if pubmed_article.tag == 'DeleteCitation':
+            # Update files list the PMIDs of citations removed from PubMed
+            deleted_PMIDs.extend(pmid.text for pmid in pubmed_article.findall('PMID'))
+            continue
         # Parse and transform the publication data
         pub_dict = parse_publication(pubmed_article)
-        pub_dict, affiliations_list, authors_list, AuthorIDCounter , AffiliationIDCounter = transform_XML(pub_dict, affiliations_list, authors_list,XML,AuthorIDCounter,AffiliationIDCounter)
-        #Appended parsed data to the list
-        publications_list.append(pub_dict)
-    
-    # Convert lists to DataFrames
-    publications_df = pd.DataFrame(publications_list).sort_index(axis=1)
-    # Group by PMID to remove duplicates
-    publications_df = publications_df.groupby(['PMID'], as_index=False).first() 
-
-    if len(affiliations_list) > 0:
-        #For afiliations we group the ids together of the same affilition before storing in database
-        affiliations_df = pd.DataFrame(affiliations_list).sort_index(axis=1)
-        affiliations_df = affiliations_df.groupby('affiliation')['Affiliation_ID'].apply(lambda x: ','.join(map(str, x))).reset_index()[['Affiliation_ID','affiliation']]
-    if len(authors_list) > 0:
-        authors_df = pd.DataFrame(authors_list).sort_index(axis=1)
-        #Remove Duplicates
-        authors_df = authors_df.groupby(['PMID','ForeName','LastName','Initials'], as_index=False).first()
-    
-    return publications_df, authors_df, affiliations_df, AuthorIDCounter, AffiliationIDCounter
+        pub_dict, affiliations_table, authors_table, author_affiliations_table, publication_authors_table, AuthorIDCounter , AffiliationIDCounter = transform_XML(pub_dict, affiliations_table, authors_table, author_affiliations_table, publication_authors_table,XML,AuthorIDCounter,AffiliationIDCounter,affiliation_ids)
+        #Appended parsed data to the table
+        publications_table.append(pub_dict)
+
+    # One row per reference of each publication (the references of the first record of a duplicated publication are kept)
+    for pmid, citations in zip(publications_table.get_column('PMID'), publications_table.pop_column('Citations')):
+        if citations is not None:
+            citing_pmid = int(pmid)
+            for cited_id, id_type in citations:
+                citations_table.append({'citing_pmid': citing_pmid, 'cited_id': cited_id, 'id_type': id_type})
+
+    # Store the abstract sections of each publication under their keys
+    abstract_sections = publications_table.pop_column('AbstractSections')
+    if LabelServices.label_classifier == 'none':
+        # No section labelling, all the abstract texts are stored together under 'Abstract'
+        resolved_abstracts = [merge_abstract_sections({'AbstractSections': sections}) for sections in abstract_sections]
+    else:
+        # Resolve all the abstract labels of the file at once (unknown labels are classified in one batch) and store each section under its key
+        labels = [(label, nlm_category) for sections in abstract_sections for label, nlm_category, _ in sections if label]
+        label_sections = resolve_labels(labels)
+        resolved_abstracts = [resolve_abstract_sections({'AbstractSections': sections}, label_sections) for sections in abstract_sections]
+    for row, abstracts in enumerate(resolved_abstracts):
+        for key, abstract_text in abstracts.items():
+            publications_table.set_value(row, key, abstract_text)
+    
+    # Build the DataFrames from the columns, already free of duplicates
+    if len(publications_table) > 0:
+        publications_df = publications_table.to_frame(first_columns=['PMID'], sort_columns=True)
+    if len(authors_table) > 0:
+        authors_df = authors_table.to_frame(first_columns=['PMID','ForeName','LastName','Initials'], sort_columns=True)
+    #Keep the links of the authors that survived the duplicate removal
+    stored_author_ids = set(authors_table.get_column('Author_ID'))
+    author_affiliations_table.filter_rows('Author_ID', stored_author_ids)
+    publication_authors_table.filter_rows('author_id', stored_author_ids)
+    #Affiliations are already unique, each distinct text was given an ID the first time it was seen
+    affiliations_df = affiliations_table.to_frame()
+    author_affiliations_df = author_affiliations_table.to_frame()
+    citations_df = citations_table.to_frame()
+    publication_authors_df = publication_authors_table.to_frame()
+    
+    return publications_df, authors_df, affiliations_df, author_affiliations_df, citations_df, publication_authors_df, AuthorIDCounter, AffiliationIDCounter, deleted_PMIDs
+
+def shift_IDs(authors_df, affiliations_df, author_affiliations_df, publication_authors_df, author_offset, affiliation_ids, AffiliationIDCounter):
+    """
+    Moves the IDs of a file processed with counters starting at 0 and an empty affiliation dictionary to their final values.
     
+    Used when files are processed in parallel: author IDs are shifted once the number of authors of the previous
+    files is known, and the file's affiliations are looked up in (or added to) the global affiliation dictionary,
+    so the result is identical to processing the files one after another.
+    
+    Parameters:
+    - authors_df (DataFrame): Authors returned by process_XML.
+    - affiliations_df (DataFrame): Affiliations returned by process_XML, with IDs local to the file.
+    - author_affiliations_df (DataFrame): Author-affiliation links returned by process_XML.
+    - publication_authors_df (DataFrame): Publication-author links returned by process_XML.
+    - author_offset (int): Value of the author counter before this file.
+    - affiliation_ids (dict): Global affiliation text -> Affiliation_ID dictionary, new affiliations are added to it.
+    - AffiliationIDCounter (int): Value of the affiliation counter before this file.
+    
+    Returns:
+    - Tuple containing the DataFrames for authors, new affiliations, author-affiliation links and publication-author
+      links with their final IDs, and the updated affiliation counter.
+    """
+
+    if len(authors_df) > 0:
+        authors_df['Author_ID'] = authors_df['Author_ID'] + author_offset
+    publication_authors_df['author_id'] = publication_authors_df['author_id'] + author_offset
+
+    # Local affiliation IDs follow the order in which affiliations were first seen, as in a serial run
+    local_to_global = {}
+    new_affiliations = []
+    for local_id, affiliation in zip(affiliations_df['Affiliation_ID'], affiliations_df['affiliation']):
+        global_id = affiliation_ids.get(affiliation)
+        if global_id is None:
+            AffiliationIDCounter += 1
+            global_id = AffiliationIDCounter
+            affiliation_ids[affiliation] = global_id
+            new_affiliations.append({'Affiliation_ID': global_id, 'affiliation': affiliation})
+        local_to_global[local_id] = global_id
+    affiliations_df = pd.DataFrame(new_affiliations, columns=['Affiliation_ID','affiliation'])
+    author_affiliations_df = pd.DataFrame({'Author_ID': author_affiliations_df['Author_ID'] + author_offset,
+                                           'Affiliation_ID': author_affiliations_df['Affiliation_ID'].map(local_to_global)},
+                                          columns=['Author_ID','Affiliation_ID'])
+    return authors_df, affiliations_df, author_affiliations_df, publication_authors_df, AffiliationIDCounter
+
+def resolve_abstract_sections(parsed_output, label_sections):
+    """
+    Stores the abstract sections collected by transform_XML under their Abstract_* keys.
+    
+    Parameters:
+    - parsed_output (dict): A publication returned by transform_XML, its 'AbstractSections' entry is removed.
+    - label_sections (dict): Mapping from (label, nlm_category) to section, as returned by resolve_labels.
+    
+    Returns:
+    - The publication dictionary with the abstract keys added.
+    """
+    for label, nlm_category, abstract_text in parsed_output.pop('AbstractSections'):
+        key = 'Abstract'
+        if label:
+            section = label_sections[(label, nlm_category)]
+            if section != 'UNLABELLED':
+                key = f"Abstract_{section}"
+        parsed_output[key] = abstract_text
+    return parsed_output
+
+def merge_abstract_sections(parsed_output):
+    """
+    Stores all the abstract sections collected by transform_XML together under 'Abstract', without labelling them.
+    
+    Parameters:
+    - parsed_output (dict): A publication returned by transform_XML, its 'AbstractSections' entry is removed.
+    
+    Returns:
+    - The publication dictionary with the 'Abstract' key added.
+    """
+    abstract_texts = [abstract_text for _, _, abstract_text in parsed_output.pop('AbstractSections') if abstract_text]
+    if len(abstract_texts) > 0:
+        parsed_output['Abstract'] = ' '.join(abstract_texts)
+    return parsed_output
+
 #PARSE PUBLICATION DATA
+# Handler table of parse_publication: tag -> (key in the parsed dictionary, how the element is kept, walk its children).
+# 'first' keeps the first element with the tag, 'all' keeps all of them and 'references' keeps the ArticleIdList
+# elements of the references. Only the children of MedlineCitation, Article and PubmedData are walked, the rest
+# of the article (authors, abstract, references...) is never visited here.
+publication_handlers = {
+    'MedlineCitation': ('MedlineCitation', 'first', True),
+    'PubmedData': ('PubmedData', 'first', True),
+    'Article': ('Article', 'first', True),
+    'DateCompleted': ('date_completed', 'first', False),
+    'PublicationStatus': ('PublicationStatus', 'first', False),
+    'CoiStatement': ('CoiStatement', 'first', False),
+    'MedlineJournalInfo': ('MedlineJournalInfo', 'first', False),
+    'Journal': ('Journal', 'first', False),
+    'ArticleIdList': ('ArticleIdList', 'first', False), # PubmedData/ArticleIdList, the ones of the references are not walked
+    'DataBankList': ('DataBankList', 'first', False),
+    'OtherID': ('OtherID', 'all', False),
+    'ReferenceList': ('reference_list', 'references', False),
+    # 'SupplMeshList': ('SupplMeshList', 'all', False), TODO
+    # 'DateRevised': ('DateRevised', 'first', False), Add to PubvMedArticle Parsing
+}
+
 def parse_publication(pub_XML_element):
 
     """
         Parses publication data from a given XML element into a dictionary.
         
+        The article is walked once from the top, each child element is dispatched on its tag through
+        publication_handlers instead of searching the whole subtree once per piece.
+        
         Parameters:
         - pub_XML_element (Element): The XML element to parse.
         
@@ -113,51 +492,54 @@ def parse_publication(pub_XML_element):
         - Dictionary containing parsed publication data.
         """
 
-    xml_dict = {}
+    xml_dict = {key: ([] if kind != 'first' else None) for key, kind, _ in publication_handlers.values()}
 
     ## Get different XML pieces
-    xml_dict['date_completed'] = pub_XML_element.find('.//DateCompleted')
-    # xml_dict['Abstract'] = pub_XML_element.find('.//Abstract')
-    xml_dict['reference_list'] = pub_XML_element.findall('.//ReferenceList//ArticleIdList')
-
-    # Additional XML pieces
-    xml_dict['PublicationStatus'] = pub_XML_element.find('.//PublicationStatus')
-    # xml_dict['SupplMeshList'] = pub_XML_element.findall('.//SupplMeshList') TODO
-    # xml_dict['DateRevised'] = pub_XML_element.find('.//DateRevised') Add to PubvMedArticle Parsing 
-    xml_dict['MedlineCitation'] = pub_XML_element.find('MedlineCitation')
-    xml_dict['PubmedData'] = pub_XML_element.find('.//PubmedData')
-    xml_dict['CoiStatement'] = pub_XML_element.find('.//CoiStatement')
-    xml_dict['MedlineJournalInfo'] = pub_XML_element.find('.//MedlineJournalInfo')
-    xml_dict['Journal'] = pub_XML_element.find('.//Journal')
-    xml_dict['ArticleIdList'] = pub_XML_element.find('.//PubmedData/ArticleIdList')
-    xml_dict['DataBankList'] = pub_XML_element.find('.//DataBankList')
-    # xml_dict['PMID'] = pub_XML_element.find('.//PMID')
-    xml_dict['OtherID'] = pub_XML_element.findall('.//OtherID')  # Note: Update the path based on actual XML structure
-    xml_dict['Article'] = pub_XML_element.find('.//Article')
+    containers = [pub_XML_element]
+    while len(containers) > 0:
+        for element in containers.pop():
+            handler = publication_handlers.get(element.tag)
+            if handler is None:
+                continue
+            key, kind, walk_children = handler
+            if kind == 'first':
+                if xml_dict[key] is None:
+                    xml_dict[key] = element
+            elif kind == 'all':
+                xml_dict[key].append(element)
+            else:
+                xml_dict[key].extend(element.iter('ArticleIdList'))
+            if walk_children:
+                containers.append(element)
 
     return xml_dict
 
 #TRANSFORM
-def transform_XML(publications_dict, all_affiliations_list, all_authors_list,XML_file_name,AuthorIDCounter,AffiliationIDCounter):
+def transform_XML(publications_dict, all_affiliations_list, all_authors_list, all_author_affiliations_list, all_publication_authors_list,XML_file_name,AuthorIDCounter,AffiliationIDCounter,affiliation_ids):
     """
     Transforms detailed publication data from a dictionary into structured formats suitable for database storage or further processing.
     
     Parameters:
     - publications_dict (dict): A dictionary containing detailed publication data extracted from an XML file.
-    - all_affiliations_list (list): A list that accumulates all affiliation data processed across different publications.
-    - all_authors_list (list): A list that accumulates all author data processed across different publications.
+    - all_affiliations_list (ColumnarTable): Accumulates the new (distinct) affiliations found across different publications.
+    - all_authors_list (ColumnarTable): Accumulates all author data processed across different publications.
+    - all_author_affiliations_list (ColumnarTable): Accumulates the (Author_ID, Affiliation_ID) links.
+    - all_publication_authors_list (ColumnarTable): Accumulates the publication-author links (pmid, author_id, au_order, is_first, is_last).
     - XML_file_name (str): The name of the XML file being processed, used for tracking and logging.
     - AuthorIDCounter (int): A counter used to assign unique IDs to each author processed, ensuring data integrity.
-    - AffiliationIDCounter (int): Similar to AuthorIDCounter, but for affiliations, ensuring each is uniquely identified.
+    - AffiliationIDCounter (int): Similar to AuthorIDCounter, but for distinct affiliation texts.
+    - affiliation_ids (dict): Affiliation text -> Affiliation_ID dictionary, so each distinct affiliation is stored once.
     
     Returns:
     - A tuple containing:
         - A dictionary with transformed publication data.
-        - Updated lists of all affiliations and authors with newly added entries from the current processing.
+        - Updated tables of affiliations, authors, author-affiliation links and publication-author links with newly added entries from the current processing.
         - Updated counters for both authors and affiliations, reflecting the latest state after processing.
     """
     
     parsed_output = {}
+    #(label, NlmCategory, text) of each AbstractText, resolved into Abstract_* keys once the labels of the file are classified
+    parsed_output['AbstractSections'] = []
     
 
     # Process GeneSymbol
@@ -170,8 +552,9 @@ def transform_XML(publications_dict, all_affiliations_list, all_authors_list,XML
 
     # Process MedlineCitation for essential publication metadata, including the PubMed ID (PMID) and its version.
     if publications_dict['MedlineCitation'] is not None:
+        medline_citation_children = child_elements(publications_dict['MedlineCitation'])
         #PMID_VERSION
-        pmid_tag = publications_dict['MedlineCitation'].find('./PMID')
+        pmid_tag = medline_citation_children.get('PMID')
         parsed_output['PMID'] = pmid_tag.text
         parsed_output['PMIDVersion'] = pmid_tag.get('Version')
         #dateCompleted
@@ -179,11 +562,11 @@ def transform_XML(publications_dict, all_affiliations_list, all_authors_list,XML
         #dateRevised
 
         ##Processing for other abstracts, extracting language and type attributes, and concatenating all abstract texts.
-        other_abstract = publications_dict['MedlineCitation'].find('./OtherAbstract')
+        other_abstract = medline_citation_children.get('OtherAbstract')
         if other_abstract is not None:
             parsed_output['OtherAbtractLanguage'] = other_abstract.get('Language')
             parsed_output['OtherAbtractType'] = other_abstract.get('Type')
-            other_abstract_texts = other_abstract.findall('./AbstractText')
+            other_abstract_texts = find_all(other_abstract, 'AbstractText')
             full_other_abstract = ''            
             for each_abstract in other_abstract_texts:
                 #too complex to create categories since the labels are in original language
@@ -195,18 +578,20 @@ def transform_XML(publications_dict, all_affiliations_list, all_authors_list,XML
     # Process Journal - Inside Article in XML but done here
     # Process Journal metadata, extracting ISSN, journal issue details, and publication date.
     if publications_dict['Journal'] is not None:
-        issn = publications_dict['Journal'].find('./ISSN')
+        journal_children = child_elements(publications_dict['Journal'])
+        issn = journal_children.get('ISSN')
         if issn is not None:
             parsed_output['Journal_ISSN'] = issn.text.strip()
             parsed_output['Journal_ISSN_Type'] = issn.get('IssnType')
 
-        journal_issue = publications_dict['Journal'].find('./JournalIssue')
+        journal_issue = journal_children.get('JournalIssue')
         if journal_issue is not None:
-            volume = journal_issue.find('./Volume')
+            journal_issue_children = child_elements(journal_issue)
+            volume = journal_issue_children.get('Volume')
             if volume is not None:
                 parsed_output['Journal_JournalIssue_Volume'] = volume.text.strip()
 
-            issue = journal_issue.find('./Issue')
+            issue = journal_issue_children.get('Issue')
             if issue is not None:
                 parsed_output['Journal_JournalIssue_Issue'] = issue.text.strip()
 
@@ -214,33 +599,34 @@ def transform_XML(publications_dict, all_affiliations_list, all_authors_list,XML
             if cited_medium:
                 parsed_output['Journal_JournalIssue_CitedMedium'] = cited_medium.strip()
 
-            pub_date = journal_issue.find('./PubDate')
+            pub_date = journal_issue_children.get('PubDate')
             if pub_date is not None:
-                year = pub_date.find('./Year')
+                pub_date_children = child_elements(pub_date)
+                year = pub_date_children.get('Year')
                 if year is not None:
                     parsed_output['Journal_JournalIssue_PubDate_Year'] = year.text.strip()
 
-                month = pub_date.find('./Month')
+                month = pub_date_children.get('Month')
                 if month is not None:
                     parsed_output['Journal_JournalIssue_PubDate_Month'] = month.text.strip()
 
-                day = pub_date.find('./Day')
+                day = pub_date_children.get('Day')
                 if day is not None:
                     parsed_output['Journal_JournalIssue_PubDate_Day'] = day.text.strip()
 
-                season = pub_date.find('./Season')
+                season = pub_date_children.get('Season')
                 if season is not None:
                     parsed_output['Journal_JournalIssue_PubDate_Season'] = season.text.strip()
 
-                medline_date = pub_date.find('./MedlineDate')
+                medline_date = pub_date_children.get('MedlineDate')
                 if medline_date is not None:
                     parsed_output['Journal_JournalIssue_PubDate_MedlineDate'] = medline_date.text.strip()
 
-        title = publications_dict['Journal'].find('./Title')
+        title = journal_children.get('Title')
         if title is not None:
             parsed_output['Journal_Title'] = title.text.strip()
 
-        iso_abbreviation = publications_dict['Journal'].find('./ISOAbbreviation')
+        iso_abbreviation = journal_children.get('ISOAbbreviation')
         if iso_abbreviation is not None:
             parsed_output['Journal_ISOAbbreviation'] = iso_abbreviation.text.strip()
 
@@ -251,13 +637,17 @@ def transform_XML(publications_dict, all_affiliations_list, all_authors_list,XML
         year = 0
         month = 0
         day = 0
+        article_children = child_elements(publications_dict['Article'])
 
         #article title
         #Extract the entire content inside the ArticleTitle tag, including nested tags
-        article_title = ET.tostring(publications_dict['Article'].find('./ArticleTitle'), encoding='unicode', method='xml')
-        
-        # Remove the opening and closing ArticleTitle tags
-        article_title = article_title.replace('<ArticleTitle>', '').replace('</ArticleTitle>', '').strip()
+        article_title_element = article_children.get('ArticleTitle')
+        if len(article_title_element) == 0:
+            # No nested tags (most titles), the escaped text is what the serialization would give
+            article_title = escape(article_title_element.text or '')
+        else:
+            article_title = XML_inner_string(article_title_element)
+        article_title = article_title.strip()
 
         # Clean up escape characters like \n, \t, etc.
         article_title = ' '.join(article_title.split())
@@ -276,7 +666,7 @@ def transform_XML(publications_dict, all_affiliations_list, all_authors_list,XML
         parsed_output['ArticleTitle'] = article_title
 
         #Language
-        language = publications_dict['Article'].find('./Language')
+        language = article_children.get('Language')
         if language is not None:
             parsed_output['Language'] = language.text
         
@@ -284,47 +674,38 @@ def transform_XML(publications_dict, all_affiliations_list, all_authors_list,XML
         parsed_output['Article_PubModel'] = publications_dict['Article'].get('PubModel')
         
         #article date
-        article_date = publications_dict['Article'].find('./ArticleDate')
+        article_date = article_children.get('ArticleDate')
         if article_date is not None:
-            year = article_date.find('./Year').text
-            month = article_date.find('./Month').text
-            day = article_date.find('./Day').text
+            article_date_children = child_elements(article_date)
+            year = article_date_children.get('Year').text
+            month = article_date_children.get('Month').text
+            day = article_date_children.get('Day').text
         if year != 0:
             parsed_output['ArticleDate'] = f'{year}-{month}-{day}'
         
         #MedlinePgn
-        MedlinePgn = publications_dict['Article'].find('./Pagination/MedlinePgn')
+        pagination = article_children.get('Pagination')
+        MedlinePgn = pagination.find('MedlinePgn') if pagination is not None else None
         if MedlinePgn is not None:
             parsed_output['Article_MedlinePgn'] = MedlinePgn.text
         
         #ELocationID
-        ELocationID = publications_dict['Article'].find('./ELocationID')
+        ELocationID = article_children.get('ELocationID')
         if ELocationID is not None:
             parsed_output['Article_ELocationID'] = ELocationID.text
         
         #Abstract
-        Abstract = publications_dict['Article'].find('./Abstract')
+        Abstract = article_children.get('Abstract')
         if Abstract is not None:
-            all_abstract_texts = Abstract.findall('./AbstractText')
-            abstract_text = ''
+            all_abstract_texts = find_all(Abstract, 'AbstractText')
             for each_abstract in all_abstract_texts:
-                #TODO STORE IN THE PROPER LABEL WOULD NEED TO CREATE THE PROPER DICTIONARY FOR THIS WITH ALL FILES
+                #Labels are resolved for the whole file at once in process_XML (see resolve_abstract_sections)
                 label = each_abstract.get('Label')
-                if label:
-                    # pdb.set_trace()
-                    candidate_labels = ['Introduction','Purpose','Conclusion','Results','Methods','UNLABELLED']
-                    key = classify(label, candidate_labels = candidate_labels)
-                    key = key['labels'][0]
-                    if key == 'UNLABELLED':
-                        key = 'Abstract'
-                    else:
-                        key = f"Abstract_{key}" 
-                else:
-                    key = 'Abstract'
-                parsed_output[key] = each_abstract.text
+                nlm_category = each_abstract.get('NlmCategory')
+                parsed_output['AbstractSections'].append((label, nlm_category, each_abstract.text))
 
         #Publication Types
-        # pubTypes =   publications_dict['Article'].find('./PublicationTypeList')
+        # pubTypes =   article_children.get('PublicationTypeList')
         # parsed_output['PublicationTypes'] = []
         # if pubTypes is not None:
         #     for pubType in pubTypes:
@@ -333,10 +714,10 @@ def transform_XML(publications_dict, all_affiliations_list, all_authors_list,XML
         # pdb.set_trace()
 
         #Authors
-        AuthorList = publications_dict['Article'].find('./AuthorList')
+        AuthorList = article_children.get('AuthorList')
         if AuthorList is not None:
-            #List to store author IDs for this publication
-            this_publication_author_list = []
+            #Integer PMID of the publication-author links
+            pmid = int(parsed_output['PMID'])
             author_list_complete = AuthorList.get('CompleteYN')
             this_publication_num_authors = len(AuthorList)
             this_author_order = 0
@@ -346,56 +727,60 @@ def transform_XML(publications_dict, all_affiliations_list, all_authors_list,XML
                 this_author_order += 1 #Increment author Order
                 isFirstAu = (this_author_order == 1) #Tag First Author
                 isLastAu = (this_author_order == this_publication_num_authors) #Tag Last Author
+                author_children = child_elements(author)
                 try:
-                    last_name = author.find('LastName').text
+                    last_name = author_children.get('LastName').text
                 except AttributeError:
                     last_name = None
                 try:
-                    fore_name = author.find('ForeName').text
+                    fore_name = author_children.get('ForeName').text
                 except AttributeError:
                     fore_name = None
                 try:
-                    initials = author.find('Initials').text
+                    initials = author_children.get('Initials').text
                 except AttributeError:
                     initials = None
 
                 #If we find a name
                 if last_name is not None or fore_name is not None or initials is not None:
-                    affiliations = author.findall('./AffiliationInfo/Affiliation')
-                    if len(affiliations) > 0 :
-                        #List to store affiliations for this author in this publication
-                        this_author_affiliation_list = []
-                        for each_affiliation in affiliations:
-                            # pdb.set_trace()
+                    affiliations = find_all(author, './AffiliationInfo/Affiliation')
+                    #IDs of the affiliations of this author in this publication (an affiliation repeated by the author is linked once)
+                    this_author_affiliation_ids = {}
+                    for each_affiliation in affiliations:
+                        affiliation = each_affiliation.text
+                        if affiliation is None:
+                            continue
+                        affiliation_id = affiliation_ids.get(affiliation)
+                        if affiliation_id is None:
+                            #First time this affiliation text is seen, give it an ID and store it
                             AffiliationIDCounter += 1
-                            affiliation = each_affiliation.text
-                            #Store affiliations details in all_affiliations list
-                            all_affiliations_list.append({'Affiliation_ID':AffiliationIDCounter,'affiliation':affiliation})
-                            #add id to author list
-                            this_author_affiliation_list.append(AffiliationIDCounter)
-                    else:
-                        this_author_affiliation_list = float("nan")
+                            affiliation_id = AffiliationIDCounter
+                            affiliation_ids[affiliation] = affiliation_id
+                            all_affiliations_list.append({'Affiliation_ID':affiliation_id,'affiliation':affiliation})
+                        this_author_affiliation_ids[affiliation_id] = True
+                    for affiliation_id in this_author_affiliation_ids:
+                        all_author_affiliations_list.append({'Author_ID':AuthorIDCounter,'Affiliation_ID':affiliation_id})
                     
                     # Store author details in all_author list
-                    all_authors_list.append({'PMID': parsed_output['PMID'] ,'Author_ID': AuthorIDCounter, 'LastName': last_name, 'ForeName': fore_name, 'Initials': initials, 'AffiliationList':this_author_affiliation_list, 'AUOrder':this_author_order, 'isFirstAu':isFirstAu, 'isLastAu':isLastAu})
-                    # Store author details and their ID in the authors_data list
-                    this_publication_author_list.append(AuthorIDCounter)
+                    all_authors_list.append({'PMID': parsed_output['PMID'] ,'Author_ID': AuthorIDCounter, 'LastName': last_name, 'ForeName': fore_name, 'Initials': initials, 'AUOrder':this_author_order, 'isFirstAu':isFirstAu, 'isLastAu':isLastAu})
+                    # Link the author to the publication with integer keys
+                    all_publication_authors_list.append({'pmid': pmid, 'author_id': AuthorIDCounter, 'au_order': this_author_order, 'is_first': int(isFirstAu), 'is_last': int(isLastAu)})
                 #Store values in publication dictionary
                 parsed_output['CompleteYN'] = author_list_complete
-                parsed_output['AuthorList'] = this_publication_author_list
                 parsed_output['Num_Authors'] = this_publication_num_authors
     
     #Transform PubmedData
     if publications_dict['PubmedData'] is not None:
         #History
-        history = publications_dict['PubmedData'].findall('./History/PubMedPubDate')
+        history = find_all(publications_dict['PubmedData'], './History/PubMedPubDate')
         if history is not None and len(history) > 0:
             # pdb.set_trace()
             for each_date in history:
                 key = f'History_{each_date.get("PubStatus")}'
-                year = each_date.find('./Year').text
-                month = each_date.find('./Month').text
-                day = each_date.find('./Day').text
+                each_date_children = child_elements(each_date)
+                year = each_date_children.get('Year').text
+                month = each_date_children.get('Month').text
+                day = each_date_children.get('Day').text
                 if year != 0:
                     parsed_output[key] = f'{year}-{month}-{day}'
                 
@@ -404,21 +789,22 @@ def transform_XML(publications_dict, all_affiliations_list, all_authors_list,XML
     if publications_dict['MedlineJournalInfo'] is not None:
 
         # Extracting each piece of information and adding it to parsed_output with a specific key
-        country = publications_dict['MedlineJournalInfo'].find('./Country')
+        medline_journal_info_children = child_elements(publications_dict['MedlineJournalInfo'])
+        country = medline_journal_info_children.get('Country')
         if country is not None:
             parsed_output['MedlineJournalInfo_Country'] = country.text.strip()
 
-        medline_ta = publications_dict['MedlineJournalInfo'].find('./MedlineTA')
+        medline_ta = medline_journal_info_children.get('MedlineTA')
         if medline_ta is not None:
             if medline_ta.text is not None:
                 parsed_output['MedlineJournalInfo_MedlineTA'] = medline_ta.text.strip()
 
-        nlm_unique_id = publications_dict['MedlineJournalInfo'].find('./NlmUniqueID')
+        nlm_unique_id = medline_journal_info_children.get('NlmUniqueID')
         if nlm_unique_id is not None:
             if nlm_unique_id.text is not None:
                 parsed_output['MedlineJournalInfo_NlmUniqueID'] = nlm_unique_id.text.strip()
 
-        issn_linking = publications_dict['MedlineJournalInfo'].find('./ISSNLinking')
+        issn_linking = medline_journal_info_children.get('ISSNLinking')
         if issn_linking is not None:
             if issn_linking.text is not None:
                 parsed_output['MedlineJournalInfo_ISSNLinking'] = issn_linking.text.strip()
@@ -426,7 +812,7 @@ def transform_XML(publications_dict, all_affiliations_list, all_authors_list,XML
     # Transform ArticleIdList
     if publications_dict['ArticleIdList'] is not None:
         # pdb.set_trace()
-        for article_id in publications_dict['ArticleIdList'].findall('./ArticleId'):
+        for article_id in find_all(publications_dict['ArticleIdList'], 'ArticleId'):
             id_type = article_id.get('IdType')
             if id_type:
                 if article_id.text is not None:
@@ -462,15 +848,16 @@ def transform_XML(publications_dict, all_affiliations_list, all_authors_list,XML
 
     # pdb.set_trace()
     if len(publications_dict['reference_list']) > 0:
-        reference_list = []
+        #(cited ID, ID type) of each ArticleId of the references, stored in the citations table by process_XML
+        citations = []
         for each_reference in publications_dict['reference_list']:
-            reference_list.append([reference.text for reference in each_reference.findall('./*')])
-        #Flatten list
-        reference_list = [item for sublist in reference_list for item in sublist]
-        # pdb.set_trace()
-        parsed_output['ReferenceList'] = reference_list
+            for reference in each_reference:
+                if reference.text is not None:
+                    citations.append((reference.text.strip(), reference.get('IdType')))
+        if len(citations) > 0:
+            parsed_output['Citations'] = citations
 
     #Add the file Name to the record
     parsed_output['XML_file_name'] = XML_file_name
     
-    return parsed_output, all_affiliations_list, all_authors_list, AuthorIDCounter, AffiliationIDCounter
\ No newline at end of file
+    return parsed_output, all_affiliations_list, all_authors_list, all_author_affiliations_list, all_publication_authors_list, AuthorIDCounter, AffiliationIDCounter
\ No newline at end of file
@@ -0,0 +1,62 @@
+import os
+import pandas as pd
+import pytest
+
+from services.XMLServices import process_XML, set_XML_path, set_XML_backend, set_label_classifier
+
+fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+table_names = ['publications', 'authors', 'affiliations', 'author_affiliations', 'citations', 'publication_authors']
+
+
+def process_fixture(xml_file, backend, streaming):
+    """
+    Processes a fixture file with a parser backend, without classifying the abstract labels.
+    """
+    set_XML_path(fixtures_path)
+    set_label_classifier('none')
+    assert set_XML_backend(backend) == backend
+    return process_XML(xml_file, 0, 0, {}, streaming=streaming)
+
+
+@pytest.fixture(autouse=True)
+def reset_XML_backend():
+    yield
+    set_XML_backend('etree')
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+@pytest.mark.parametrize('xml_file', ['pubmed_markup.xml', 'pubmed_markup_gz.xml.gz'])
+def test_backends_give_identical_output(xml_file, streaming):
+    pytest.importorskip('lxml')
+    etree_result = process_fixture(xml_file, 'etree', streaming)
+    lxml_result = process_fixture(xml_file, 'lxml', streaming)
+    for name, etree_df, lxml_df in zip(table_names, etree_result[:6], lxml_result[:6]):
+        pd.testing.assert_frame_equal(etree_df, lxml_df, obj=name)
+    # Counters and deleted PMIDs
+    assert etree_result[6:] == lxml_result[6:]
+
+
+@pytest.mark.parametrize('backend', ['etree', 'lxml'])
+def test_streaming_and_gzip_give_identical_output(backend):
+    if backend == 'lxml':
+        pytest.importorskip('lxml')
+    reference = process_fixture('pubmed_markup.xml', backend, False)
+    for xml_file, streaming in [('pubmed_markup.xml', True), ('pubmed_markup_gz.xml.gz', False), ('pubmed_markup_gz.xml.gz', True)]:
+        result = process_fixture(xml_file, backend, streaming)
+        pd.testing.assert_frame_equal(reference[0].drop(columns='XML_file_name'), result[0].drop(columns='XML_file_name'), obj='publications')
+        for name, reference_df, result_df in zip(table_names[1:], reference[1:6], result[1:6]):
+            pd.testing.assert_frame_equal(reference_df, result_df, obj=name)
+        assert reference[6:] == result[6:]
+
+
+@pytest.mark.parametrize('backend', ['etree', 'lxml'])
+def test_article_title_markup(backend):
+    if backend == 'lxml':
+        pytest.importorskip('lxml')
+    titles = process_fixture('pubmed_markup.xml', backend, False)[0].set_index('PMID')['ArticleTitle']
+    # Namespaces are dropped, MathML is kept with its local tag names
+    assert titles['9000001'] == 'Effect of <math display="inline"><msup><mi>x</mi><mn>2</mn></msup><mo>&lt;</mo><mi>y</mi></math> on growth.'
+    # Nested tags, empty tags and escaped attributes as ElementTree writes them, without the enclosing brackets
+    assert titles['9000002'] == 'Levels of <i>Ca<sup>2+</sup></i> &amp; <b>Mg<sub>x</sub></b> in <i>E. coli<sup /></i> <span class="a&quot;b">cells</span>'
+    # Comments and processing instructions are dropped
+    assert titles['9000003'] == 'A title split by a comment and a processing instruction.'